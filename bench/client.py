@@ -0,0 +1,161 @@
+import http.client
+import itertools
+import multiprocessing
+import socket
+import ssl
+import statistics
+import threading
+import time
+
+READ_CHUNK = 64 * 1024
+
+
+def _client_thread(host, port, paths, deadline, keep_alive, offset, results):
+    latencies = []
+    errors = 0
+    received = 0
+    headers = {} if keep_alive else {"Connection": "close"}
+    conn = None
+    for path in itertools.islice(itertools.cycle(paths), offset, None):
+        if time.monotonic() >= deadline:
+            break
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(host, port, timeout=10)
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            while True:
+                chunk = response.read(READ_CHUNK)
+                if not chunk:
+                    break
+                received += len(chunk)
+            if response.status >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+            if not keep_alive or response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if conn is not None:
+                conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    results.append((latencies, errors, received))
+
+
+def _client_process(host, port, paths, duration, threads, keep_alive, index):
+    deadline = time.monotonic() + duration
+    results = []
+    workers = [
+        threading.Thread(
+            target=_client_thread,
+            args=(host, port, paths, deadline, keep_alive, index * threads + i, results),
+        )
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    latencies = [lat for result in results for lat in result[0]]
+    return latencies, sum(r[1] for r in results), sum(r[2] for r in results)
+
+
+def run_load(host, port, paths, duration, connections, processes, keep_alive):
+    """Hit ``paths`` round robin from ``connections`` concurrent clients.
+
+    The clients are spread over several processes so the load generator isn't
+    held back by a single interpreter's GIL.
+    """
+    processes = max(1, min(processes, connections))
+    per_process = [connections // processes] * processes
+    for i in range(connections % processes):
+        per_process[i] += 1
+
+    ctx = multiprocessing.get_context("fork")
+    started = time.perf_counter()
+    with ctx.Pool(processes) as pool:
+        parts = pool.starmap(
+            _client_process,
+            [
+                (host, port, paths, duration, threads, keep_alive, i)
+                for i, threads in enumerate(per_process)
+            ],
+        )
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(lat for part in parts for lat in part[0])
+    errors = sum(part[1] for part in parts)
+    received = sum(part[2] for part in parts)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "bytes_received": received,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": percentile(latencies, 100),
+        },
+    }
+
+
+def measure_handshakes(host, port, count):
+    """Time ``count`` full and ``count`` resumed TLS handshakes, one at a time.
+
+    Each full handshake is followed by a request, so that the server's TLS 1.3
+    session ticket has arrived before the session is reused for the resumed one.
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    full, resumed = [], []
+    reused = 0
+    for _ in range(count):
+        session = None
+        for timings in (full, resumed):
+            with socket.create_connection((host, port), timeout=10) as sock:
+                start = time.perf_counter()
+                tls = context.wrap_socket(
+                    sock, server_hostname=host, session=session
+                )
+                timings.append(time.perf_counter() - start)
+                with tls:
+                    tls.sendall(
+                        f"GET / HTTP/1.1\r\nHost: {host}\r\n"
+                        "Connection: close\r\n\r\n".encode()
+                    )
+                    while tls.recv(READ_CHUNK):
+                        pass
+                    if session is not None:
+                        reused += tls.session_reused
+                    session = tls.session
+    return {
+        "handshakes": count,
+        "resumed_ratio": round(reused / count, 3) if count else None,
+        "full_ms": _summary(full),
+        "resumed_ms": _summary(resumed),
+    }
+
+
+def _summary(values):
+    if not values:
+        return None
+    return {
+        "p50": round(statistics.median(values) * 1000, 3),
+        "mean": round(statistics.fmean(values) * 1000, 3),
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return round(sorted_values[index] * 1000, 3)
@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from .client import measure_handshakes, run_load
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each scenario names the server's content (routed static files, or a --sdir
+# tree the benchmark builds) and the paths the clients cycle through.
+SCENARIOS = {
+    "static": {
+        "sdir": False,
+        "paths": ["/", "/about", "/ping", "/css/style.css", "/js/index.js"],
+    },
+    "listing": {"sdir": True, "paths": ["/", "/many/"]},
+    "large": {"sdir": True, "paths": ["/large.bin"]},
+    "mixed": {
+        "sdir": True,
+        "paths": ["/", "/small.html", "/many/", "/small.html", "/large.bin"],
+    },
+}
+
+
+def build_tree(root, large_mib):
+    with open(os.path.join(root, "small.html"), "w") as f:
+        f.write("<html><body>" + "hello " * 200 + "</body></html>")
+    with open(os.path.join(root, "large.bin"), "wb") as f:
+        for _ in range(large_mib):
+            f.write(os.urandom(1024 * 1024))
+    many = os.path.join(root, "many")
+    os.mkdir(many)
+    for i in range(2000):
+        open(os.path.join(many, f"file-{i:05d}.txt"), "w").close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+def peak_rss_kb(pid):
+    """Peak resident set size of ``pid`` and its children, from /proc (Linux)."""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total or None
+
+
+def start_server(port, engine, workers, directory, extra_args):
+    cmd = [sys.executable, "main.py", "-p", str(port), "-e", engine]
+    if workers:
+        cmd += ["-w", str(workers)]
+    if directory:
+        cmd += ["-sd", directory]
+    cmd += extra_args
+    proc = subprocess.Popen(
+        cmd, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(port)
+    except RuntimeError:
+        proc.kill()
+        raise
+    return proc
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_matrix(args):
+    tree = tempfile.mkdtemp(prefix="http-bench-")
+    results = []
+    try:
+        build_tree(tree, args.large_mib)
+        for engine in args.engines:
+            for scenario_name in args.scenarios:
+                scenario = SCENARIOS[scenario_name]
+                for keep_alive in args.keepalive:
+                    port = free_port()
+                    proc = start_server(
+                        port,
+                        engine,
+                        args.workers,
+                        tree if scenario["sdir"] else None,
+                        args.server_args,
+                    )
+                    try:
+                        stats = run_load(
+                            "127.0.0.1",
+                            port,
+                            scenario["paths"],
+                            args.duration,
+                            args.connections,
+                            args.processes,
+                            keep_alive,
+                        )
+                        stats["peak_rss_kb"] = peak_rss_kb(proc.pid)
+                    finally:
+                        stop_server(proc)
+                    result = {
+                        "engine": engine,
+                        "workers": args.workers,
+                        "scenario": scenario_name,
+                        "keep_alive": keep_alive,
+                        **stats,
+                    }
+                    print_result(result)
+                    results.append(result)
+    finally:
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+
+def make_certificate(directory):
+    """A throwaway self-signed certificate for the TLS runs, made with openssl."""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes"]
+        + ["-subj", "/CN=localhost", "-days", "1"]
+        + ["-keyout", keyfile, "-out", certfile],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def run_tls(args):
+    """Measure full and resumed handshake times against each engine."""
+    tmp = tempfile.mkdtemp(prefix="http-bench-tls-")
+    results = []
+    try:
+        certfile, keyfile = make_certificate(tmp)
+        for engine in args.engines:
+            tls_port = free_port()
+            proc = start_server(
+                free_port(),
+                engine,
+                args.workers,
+                None,
+                ["--certfile", certfile, "--keyfile", keyfile]
+                + ["--tls-port", str(tls_port)]
+                + args.server_args,
+            )
+            try:
+                wait_for_port(tls_port)
+                stats = measure_handshakes("127.0.0.1", tls_port, args.tls_handshakes)
+            finally:
+                stop_server(proc)
+            result = {"engine": engine, "workers": args.workers, **stats}
+            print(
+                f"{engine:>8} w={args.workers} tls handshake "
+                f"full p50={stats['full_ms']['p50']}ms "
+                f"resumed p50={stats['resumed_ms']['p50']}ms "
+                f"resumed={stats['resumed_ratio']:.0%}",
+                flush=True,
+            )
+            results.append(result)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def result_key(result):
+    return (
+        result["engine"],
+        result["workers"],
+        result["scenario"],
+        result["keep_alive"],
+    )
+
+
+def print_result(result, baseline=None):
+    line = (
+        f"{result['engine']:>8} w={result['workers']} {result['scenario']:>8} "
+        f"keepalive={'on ' if result['keep_alive'] else 'off'} "
+        f"{result['rps']:>9.1f} req/s  p50={result['latency_ms']['p50']}ms "
+        f"p95={result['latency_ms']['p95']}ms p99={result['latency_ms']['p99']}ms "
+        f"errors={result['errors']} rss={result['peak_rss_kb']}KiB"
+    )
+    if baseline:
+        change = (result["rps"] - baseline["rps"]) / baseline["rps"] * 100
+        line += f"  ({change:+.1f}% req/s vs baseline)"
+    print(line, flush=True)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        print_result(result, baseline.get(result_key(result)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="Load test the server engines and record the results as JSON.",
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        default=["threaded", "asyncio"],
+        choices=["threaded", "asyncio"],
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS)
+    )
+    parser.add_argument(
+        "--keepalive",
+        nargs="+",
+        default=["on", "off"],
+        choices=["on", "off"],
+        help="run with persistent connections, fresh connections, or both",
+    )
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=5, help="seconds per run")
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--large-mib", dest="large_mib", type=int, default=8)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="earlier JSON output to compare against")
+    parser.add_argument(
+        "--server-args",
+        dest="server_args",
+        default="",
+        help="extra options passed to main.py, e.g. \"--cache-size 0\"",
+    )
+    parser.add_argument(
+        "--tls",
+        action="store_true",
+        help="also time full and resumed TLS handshakes (needs openssl)",
+    )
+    parser.add_argument(
+        "--tls-handshakes", dest="tls_handshakes", type=int, default=200
+    )
+    args = parser.parse_args(argv)
+    args.keepalive = [mode == "on" for mode in args.keepalive]
+    args.server_args = args.server_args.split()
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_matrix(args)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "duration_s": args.duration,
+            "connections": args.connections,
+            "server_args": args.server_args,
+        },
+        "results": results,
+    }
+    if args.tls:
+        report["tls"] = run_tls(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
@@ -4,4 +4,12 @@ routes = route_list(
     route("/", "index.html"),
     route("/about", "aboutme.html"),
     route("/ping", "pong.html"),
+    # Forward everything under /api/ to an app tier, with
+    # `from server.proxy import upstream`:
+    # route("/api/*", upstream("http://10.0.0.5:8080", "http://10.0.0.6:8080")),
 )
+
+# Cache-Control per route, overriding server.CACHE_CONTROL_BY_EXT.
+cache_control = {
+    "/ping": "no-store",
+}
@@ -0,0 +1,217 @@
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+from .utils import logger
+
+FORMATS = ("common", "combined", "json")
+# Records are written in batches of at most this many lines, at least every
+# FLUSH_INTERVAL seconds while requests are coming in.
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 0.5
+# Records waiting for the writer beyond this are dropped and counted rather
+# than letting a stalled disk grow the queue without bound.
+MAX_PENDING = 100_000
+
+_STOP = object()
+
+
+class AccessLog:
+    """Access log written by a background thread.
+
+    ``log`` only puts the request's raw fields on a queue; the writer thread
+    formats them in Common/Combined Log Format or JSON, writes them a batch at
+    a time and rotates the file by size and/or age. Successful requests can be
+    sampled with ``sample_rate``; 4xx and 5xx responses are always kept.
+    """
+
+    def __init__(
+        self,
+        path="-",
+        fmt="combined",
+        max_bytes=0,
+        rotate_interval=0,
+        backups=5,
+        sample_rate=1.0,
+    ):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown access log format {fmt!r}")
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._stream = None
+        self._rollover_at = 0
+        self._time_cache = (None, "")
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start(self):
+        """Start the writer thread. Call once per process, after any fork."""
+        if not self.enabled or self._thread is not None:
+            return
+        self._open()
+        self._thread = threading.Thread(
+            target=self._run, name="access-log", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Write out everything queued so far and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._close()
+
+    def log(self, client_address, req_headers, status, size, duration):
+        """Queue one request. ``req_headers`` is None for unparseable requests."""
+        if self._thread is None:
+            return
+        if status < 400 and random.random() >= self.sample_rate:
+            return
+        if self._queue.qsize() >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self._queue.put(
+            (time.time(), client_address[0], req_headers, status, size, duration)
+        )
+
+    def _run(self):
+        while True:
+            try:
+                record = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            batch = []
+            while record is not _STOP:
+                batch.append(record)
+                if len(batch) >= BATCH_SIZE:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write("".join(self._format(r) for r in batch))
+            if record is _STOP:
+                return
+
+    def _format(self, record):
+        timestamp, host, req_headers, status, size, duration = record
+        if req_headers is None:
+            method = path = query = protocol = referer = agent = ""
+        else:
+            method = req_headers.get("method", "")
+            path = req_headers.get("path", "")
+            query = req_headers.get("query", "")
+            protocol = req_headers.get("http_version", "")
+            metadata = req_headers.get("metadata", {})
+            referer = metadata.get("referer", "")
+            agent = metadata.get("user-agent", "")
+        if query:
+            path = f"{path}?{query}"
+
+        if self.fmt == "json":
+            return (
+                json.dumps(
+                    {
+                        "time": time.strftime(
+                            "%Y-%m-%dT%H:%M:%S%z", time.localtime(timestamp)
+                        ),
+                        "remote_addr": host,
+                        "method": method,
+                        "path": path,
+                        "protocol": protocol,
+                        "status": status,
+                        "bytes": size,
+                        "referer": referer,
+                        "user_agent": agent,
+                        "duration_ms": round(duration * 1000, 3),
+                    }
+                )
+                + "\n"
+            )
+
+        request_line = f"{method} {path} {protocol}" if method else ""
+        line = (
+            f'{host} - - [{self._clf_time(timestamp)}] "{_quote(request_line)}" '
+            f"{status} {size or '-'}"
+        )
+        if self.fmt == "combined":
+            line += f' "{_quote(referer) or "-"}" "{_quote(agent) or "-"}"'
+        return line + "\n"
+
+    def _clf_time(self, timestamp):
+        second = int(timestamp)
+        if self._time_cache[0] != second:
+            self._time_cache = (
+                second,
+                time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(second)),
+            )
+        return self._time_cache[1]
+
+    def _open(self):
+        if self.path == "-":
+            self._stream = sys.stdout
+            return
+        self._stream = open(self.path, "a", encoding="utf-8")
+        if self.rotate_interval:
+            self._rollover_at = time.time() + self.rotate_interval
+
+    def _close(self):
+        if self._stream is not None and self._stream is not sys.stdout:
+            self._stream.close()
+        self._stream = None
+
+    def _write(self, text):
+        try:
+            if self.path != "-":
+                self._maybe_rotate(len(text))
+            self._stream.write(text)
+            self._stream.flush()
+        except (OSError, ValueError) as e:
+            logger.error(f"Access log write failed: {e}")
+
+    def _maybe_rotate(self, incoming):
+        try:
+            on_disk = os.stat(self.path)
+        except FileNotFoundError:
+            on_disk = None
+        # Another worker process, or logrotate, moved the file away: follow it.
+        if on_disk is None or on_disk.st_ino != os.fstat(self._stream.fileno()).st_ino:
+            self._close()
+            self._open()
+            return
+        due = self.rotate_interval and time.time() >= self._rollover_at
+        full = self.max_bytes and on_disk.st_size + incoming > self.max_bytes
+        if not (due or full):
+            return
+        self._close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+
+def _quote(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+access_log = AccessLog()
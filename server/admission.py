@@ -0,0 +1,116 @@
+import math
+import threading
+import time
+
+from .error_pages import error_page
+from .response import Response
+
+RETRY_AFTER = 1
+# Idle clients' rate limit buckets are dropped once this many are tracked.
+MAX_TRACKED_CLIENTS = 10_000
+
+
+class Admission:
+    """Connection limits and per-client rate limiting.
+
+    ``admit`` runs once per accepted connection and ``allow_request`` once per
+    request. Both answer straight away, so an overloaded server turns excess
+    clients away with a 503 or 429 instead of queueing them until they time
+    out. A limit of 0 turns that check off.
+    """
+
+    def __init__(
+        self,
+        max_connections=0,
+        max_queue=0,
+        max_per_ip=0,
+        rate=0,
+        burst=0,
+        retry_after=RETRY_AFTER,
+    ):
+        self.max_connections = max_connections
+        self.max_queue = max_queue
+        self.max_per_ip = max_per_ip
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.active = 0
+        self.per_ip = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self._rejections = {}
+
+    def admit(self, ip, queued=0):
+        """Count a new connection in, or return why it is refused.
+
+        Returns None when admitted, else ``(status, reason, retry_after)``.
+        Every admitted connection must be given back with ``release``.
+        """
+        with self.lock:
+            if self.max_connections and self.active >= self.max_connections:
+                return 503, "max_connections", self.retry_after
+            if self.max_queue and queued >= self.max_queue:
+                return 503, "max_queue", self.retry_after
+            open_here = self.per_ip.get(ip, 0)
+            if self.max_per_ip and open_here >= self.max_per_ip:
+                return 429, "max_per_ip", self.retry_after
+            self.active += 1
+            self.per_ip[ip] = open_here + 1
+        return None
+
+    def release(self, ip):
+        with self.lock:
+            self.active -= 1
+            open_here = self.per_ip.get(ip, 1) - 1
+            if open_here:
+                self.per_ip[ip] = open_here
+            else:
+                self.per_ip.pop(ip, None)
+
+    def allow_request(self, ip):
+        """Take a token from ``ip``'s bucket.
+
+        Returns 0 when the request may go ahead, otherwise the whole seconds
+        until a token is available again.
+        """
+        if not self.rate:
+            return 0
+        burst = self.burst or self.rate
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(ip, (burst, now))
+            tokens = min(burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self.buckets[ip] = (tokens - 1, now)
+                if len(self.buckets) > MAX_TRACKED_CLIENTS:
+                    self._prune(now, burst)
+                return 0
+            self.buckets[ip] = (tokens, now)
+        return max(1, math.ceil((1 - tokens) / self.rate))
+
+    def _prune(self, now, burst):
+        """Forget clients whose buckets have refilled; they are back to default."""
+        self.buckets = {
+            ip: (tokens, last)
+            for ip, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate < burst
+        }
+
+    def rejection(self, status, retry_after, keep_alive=False):
+        """The whole encoded 503/429 response, built once per status and delay."""
+        key = (status, retry_after, keep_alive)
+        data = self._rejections.get(key)
+        if data is None:
+            response = rejection_response(status, retry_after)
+            data = response.head(keep_alive) + response.body
+            self._rejections[key] = data
+        return data
+
+
+def rejection_response(status, retry_after):
+    return Response(
+        status, error_page(status), "text/html", headers={"Retry-After": retry_after}
+    )
+
+
+admission = Admission()
@@ -0,0 +1,682 @@
+import asyncio
+import collections
+import errno
+import signal
+import socket
+import time
+
+from . import http2, server as engine
+from .access_log import access_log
+from .admission import admission
+from .handoff import spawn_successor
+from .metrics import metrics
+from .parser import BYTES_RECV_AMT, HTTPError, RequestParser, RequestTimeout
+from .response import CONTINUE, LAST_CHUNK, BodyError, encode_chunk
+from .tls import HANDSHAKE_TIMEOUT, count_handshake
+from .upload import UPLOAD_CHUNK_SIZE, accept_upload
+
+logger = engine.logger
+
+# The parser's header and body limits, the StreamReader buffer limit and the
+# write high-water mark bound the memory held per connection, however many
+# connections are open.
+STREAM_LIMIT = 64 * 1024
+WRITE_HIGH_WATER = 64 * 1024
+# Large in-memory bodies, e.g. mapped files, are written this much at a time
+# so the transport never copies them whole into its buffer.
+BODY_SLICE = 256 * 1024
+
+# Resolved when the server is told to stop, and the tasks of the connections
+# still open, to be drained.
+_draining = None
+_connections = set()
+
+
+def serve_asyncio(sock, directory=None, tls_sock=None, handoff=False):
+    """Serve connections from the listening sockets on one asyncio event loop.
+
+    SIGTERM and SIGINT close the listeners and drain the open connections.
+    With ``handoff``, SIGUSR2 passes the listeners to a new server process.
+    """
+    access_log.start()
+    engine.watch_site()
+    try:
+        asyncio.run(_serve(sock, directory, tls_sock, handoff))
+    except KeyboardInterrupt:
+        logger.info("Server terminated by user")
+    finally:
+        logger.info(f"File cache stats: {engine.file_cache.stats()}")
+        access_log.stop()
+
+
+async def _serve(sock, directory, tls_sock, handoff):
+    global _draining
+
+    async def on_connect(reader, writer):
+        task = asyncio.current_task()
+        _connections.add(task)
+        try:
+            await handle_connection(reader, writer, directory)
+        except asyncio.CancelledError:
+            # Cut at the end of a drain; asyncio would log it as an error.
+            pass
+        finally:
+            _connections.discard(task)
+
+    loop = asyncio.get_running_loop()
+    _draining = loop.create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        # Pre-fork workers ignore SIGINT and leave it to the master.
+        if signal.getsignal(signum) is not signal.SIG_IGN:
+            loop.add_signal_handler(signum, _stop)
+    if handoff:
+        listeners = [s for s in (sock, tls_sock) if s is not None]
+        loop.add_signal_handler(signal.SIGUSR2, spawn_successor, listeners)
+    servers = []
+    if sock is not None:
+        servers.append(
+            await asyncio.start_server(
+                on_connect, sock=sock, limit=STREAM_LIMIT, backlog=1024
+            )
+        )
+    if tls_sock is not None:
+        servers.append(
+            await asyncio.start_server(
+                on_connect,
+                sock=tls_sock,
+                limit=STREAM_LIMIT,
+                backlog=1024,
+                ssl=engine.tls_context,
+                ssl_handshake_timeout=HANDSHAKE_TIMEOUT,
+            )
+        )
+    try:
+        await _draining
+    finally:
+        for server in servers:
+            server.close()
+    await drain_connections()
+
+
+def _stop():
+    if not _draining.done():
+        logger.info("Server terminated by user")
+        _draining.set_result(None)
+        return
+    # Told again while draining: stop waiting for the rest.
+    for task in _connections:
+        task.cancel()
+
+
+async def drain_connections():
+    """Let open connections finish for up to GRACEFUL_TIMEOUT, then cut the rest.
+
+    Idle keep-alive connections close at once, see ``wait_for_request``.
+    """
+    if not _connections:
+        return
+    logger.info(f"Draining {len(_connections)} connections")
+    _, pending = await asyncio.wait(set(_connections), timeout=engine.GRACEFUL_TIMEOUT)
+    if pending:
+        logger.warning(f"Closed {len(pending)} connections that were still open")
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+
+
+async def wait_for_request(reader, size=BYTES_RECV_AMT):
+    """Read the start of the next keep-alive request; None once draining.
+
+    Returns b"" when the client closed the connection, and raises
+    asyncio.TimeoutError after KEEPALIVE_TIMEOUT.
+    """
+    read = asyncio.ensure_future(reader.read(size))
+    try:
+        done, _ = await asyncio.wait(
+            (read, _draining),
+            timeout=engine.KEEPALIVE_TIMEOUT,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        # Unread data stays in the reader, so nothing is lost by cancelling.
+        if not read.done():
+            read.cancel()
+    if read in done:
+        return read.result()
+    if not done:
+        raise asyncio.TimeoutError
+    return None
+
+
+async def read_request(reader, writer, parser, clock):
+    """Read one request, leaving pipelined bytes in the parser.
+
+    Returns None when the client closed the connection, and raises
+    RequestTimeout when the request misses its deadline.
+    """
+    request_data = parser.next_request()
+    while request_data is None:
+        if parser.expects_continue():
+            writer.write(CONTINUE)
+        phase, timeout = clock.remaining(parser)
+        if phase is None:
+            timeout = engine.KEEPALIVE_TIMEOUT
+        elif timeout <= 0:
+            raise RequestTimeout(phase)
+        try:
+            data = await asyncio.wait_for(reader.read(BYTES_RECV_AMT), timeout)
+        except asyncio.TimeoutError:
+            if phase is None:
+                raise
+            raise RequestTimeout(phase)
+        if not data:
+            return None
+        parser.feed(data)
+        request_data = parser.next_request()
+    clock.reset()
+    return request_data
+
+
+async def lingering_close(reader, writer):
+    """Drain the rest of a refused request so closing doesn't reset the reply."""
+    try:
+        if writer.can_write_eof():
+            writer.write_eof()
+        drained = 0
+        while drained < engine.LINGER_MAX_BYTES:
+            data = await asyncio.wait_for(
+                reader.read(STREAM_LIMIT), engine.LINGER_TIMEOUT
+            )
+            if not data:
+                break
+            drained += len(data)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+
+async def handle_connection(reader, writer, directory=None):
+    client_address = writer.get_extra_info("peername")
+    writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+    # asyncio only disables Nagle for sockets created with proto=IPPROTO_TCP.
+    writer.get_extra_info("socket").setsockopt(
+        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+    )
+    ssl_object = writer.get_extra_info("ssl_object")
+    if ssl_object is not None:
+        count_handshake(ssl_object)
+    refused = admission.admit(client_address[0])
+    if refused is not None:
+        await reject_connection(reader, writer, *refused)
+        return
+    parser = RequestParser(stream_body=engine.body_limit)
+    clock = engine.RequestClock()
+    served = 0
+    metrics.add("http_active_connections", 1)
+    try:
+        if engine.HTTP2 and ssl_object is not None:
+            if ssl_object.selected_alpn_protocol() == "h2":
+                await handle_http2(reader, writer, client_address, directory)
+                return
+        while served < engine.MAX_KEEPALIVE_REQUESTS:
+            if served and not parser.has_data():
+                data = await wait_for_request(reader)
+                if not data:
+                    break
+                parser.feed(data)
+            try:
+                request_data = await read_request(reader, writer, parser, clock)
+            except HTTPError as err:
+                logger.error(
+                    f"{client_address[0]} {err.status_code} {engine.get_status_texts(err.status_code)}, message: {err}"
+                )
+                if isinstance(err, RequestTimeout):
+                    engine.count_cut(err.reason)
+                response = engine.error_response(err.status_code)
+                await send_http_response(writer, response, False)
+                access_log.log(
+                    client_address, None, err.status_code, response.bytes_sent, 0
+                )
+                await lingering_close(reader, writer)
+                break
+            if request_data is None:
+                break
+            if engine.HTTP2 and not served and http2.is_preface(request_data):
+                preface = http2.PREFACE[: http2.PREFACE_REQUEST_LENGTH]
+                await handle_http2(
+                    reader,
+                    writer,
+                    client_address,
+                    directory,
+                    preface + bytes(parser.buffer),
+                )
+                break
+            served += 1
+
+            req_headers = request_data["headers"]
+            keep_alive = (
+                engine.is_keep_alive(req_headers)
+                and served < engine.MAX_KEEPALIVE_REQUESTS
+            )
+            started = time.perf_counter()
+            complete = True
+            if "body_stream" in request_data:
+                if engine.proxy_target(req_headers["path"]) is not None:
+                    response, complete = await forward_body(
+                        reader, writer, client_address, request_data, clock
+                    )
+                else:
+                    response, complete = await receive_upload(
+                        reader, writer, client_address, request_data, clock
+                    )
+                    response.route = "upload"
+                parser.feed(request_data["body_stream"].leftover)
+            else:
+                response = await dispatch(request_data, client_address, directory)
+            dispatched = time.perf_counter()
+            if not (complete and engine.delimit_stream(response, req_headers)):
+                keep_alive = False
+            if _draining.done():
+                keep_alive = False
+            sent = await send_http_response(
+                writer,
+                response,
+                keep_alive,
+                head_only=req_headers.get("method") == "HEAD",
+            )
+            engine.record_request(
+                client_address,
+                request_data,
+                response,
+                dispatched - started,
+                time.perf_counter() - dispatched,
+            )
+            if not complete:
+                await lingering_close(reader, writer)
+            if not (sent and keep_alive):
+                break
+
+    except asyncio.TimeoutError:
+        if served == 0:
+            engine.count_cut("idle")
+            logger.info(f"Connection Timeout for client {client_address[0]}")
+    except ConnectionError:
+        logger.info(f"Connection reset by client {client_address[0]}")
+    finally:
+        metrics.add("http_active_connections", -1)
+        admission.release(client_address[0])
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def handle_http2(reader, writer, client_address, directory=None, data=b""):
+    """Serve an HTTP/2 connection until it closes or goes idle.
+
+    This task reads and dispatches; a second one writes whatever the session
+    has framed, so responses keep flowing while more requests arrive.
+    """
+    session = http2.HTTP2Session()
+    wake = asyncio.Event()
+    sender = asyncio.create_task(_send_http2(writer, session, wake, client_address))
+    responding = set()
+    try:
+        while not session.closed:
+            if data:
+                for stream_id, request_data in session.receive(data):
+                    task = asyncio.create_task(
+                        _respond(
+                            session,
+                            wake,
+                            stream_id,
+                            request_data,
+                            client_address,
+                            directory,
+                        )
+                    )
+                    responding.add(task)
+                    task.add_done_callback(responding.discard)
+                wake.set()
+            busy = session.busy()
+            try:
+                if busy:
+                    data = await asyncio.wait_for(
+                        reader.read(STREAM_LIMIT), engine.SEND_TIMEOUT
+                    )
+                else:
+                    # None when draining: closing sends GOAWAY.
+                    data = await wait_for_request(reader, STREAM_LIMIT)
+            except asyncio.TimeoutError:
+                engine.count_cut("send_timeout" if busy else "idle")
+                break
+            if not data or sender.done():
+                break
+    finally:
+        sender.cancel()
+        for task in responding:
+            task.cancel()
+        session.close()
+        try:
+            writer.write(session.pump())
+            await asyncio.wait_for(writer.drain(), engine.LINGER_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+
+async def _respond(session, wake, stream_id, request_data, client_address, directory):
+    started = time.perf_counter()
+    response = await dispatch(request_data, client_address, directory)
+    if session.closed:
+        response.close()
+        return
+    if response.stream_blocks:
+        response.stream = _ThreadedChunks(response.stream, wake)
+    session.respond(stream_id, request_data, response, time.perf_counter() - started)
+    wake.set()
+
+
+class _ThreadedChunks:
+    """A blocking body iterator read ahead on executor threads for HTTP/2.
+
+    Iterating yields the chunks read so far, then None while the next one is
+    still on its way; ``wake`` is set whenever one arrives. At most MAX_AHEAD
+    chunks are buffered, so a slow client holds back the upstream.
+    """
+
+    MAX_AHEAD = 4
+
+    def __init__(self, chunks, wake):
+        self.chunks = chunks
+        self.wake = wake
+        self.ready = collections.deque()
+        self.room = asyncio.Event()
+        self.room.set()
+        self.done = False
+        self.closing = False
+        self.error = None
+        self.task = asyncio.ensure_future(self._fill())
+
+    async def _fill(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self.room.wait()
+                if self.closing:
+                    break
+                chunk = await loop.run_in_executor(None, next, self.chunks, None)
+                if chunk is None:
+                    break
+                self.ready.append(chunk)
+                if len(self.ready) >= self.MAX_AHEAD:
+                    self.room.clear()
+                self.wake.set()
+        except BodyError as e:
+            self.error = e
+        finally:
+            # Only closed here, never while a thread is inside next().
+            self.chunks.close()
+            self.done = True
+            self.wake.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.ready:
+            self.room.set()
+            return self.ready.popleft()
+        if self.error is not None:
+            raise self.error
+        if self.done:
+            raise StopIteration
+        return None
+
+    def close(self):
+        self.closing = True
+        self.room.set()
+
+
+async def _send_http2(writer, session, wake, client_address):
+    try:
+        while True:
+            out = session.pump()
+            if out:
+                writer.write(out)
+                await asyncio.wait_for(writer.drain(), engine.SEND_TIMEOUT)
+            for stream in session.take_finished():
+                engine.record_request(
+                    client_address,
+                    stream.request,
+                    stream.response,
+                    stream.file_seconds,
+                    stream.send_seconds(),
+                )
+            if not out:
+                wake.clear()
+                await wake.wait()
+    except asyncio.TimeoutError:
+        engine.count_cut("send_timeout")
+        # Closing the transport ends the read loop too.
+        writer.close()
+    except ConnectionError:
+        writer.close()
+
+
+async def receive_upload(reader, writer, client_address, request_data, clock):
+    """Stream an upload body to disk; see server.receive_upload.
+
+    Chunks are written as they arrive, the final fsync and rename run on an
+    executor thread.
+    """
+    response = engine.rate_limited(client_address)
+    if response is not None:
+        return response, False
+    body = request_data["body_stream"]
+    destination, response = accept_upload(request_data["headers"], engine.site.static)
+    if response is not None:
+        return response, False
+    try:
+        async for chunk in read_body(reader, writer, request_data, clock):
+            destination.write(chunk)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, destination.finish), True
+    except HTTPError as err:
+        destination.abort()
+        logger.error(
+            f"{client_address[0]} {err.status_code} {engine.get_status_texts(err.status_code)}, message: {err}"
+        )
+        if isinstance(err, RequestTimeout):
+            engine.count_cut(err.reason)
+        return engine.error_response(err.status_code), False
+    except (ConnectionError, asyncio.CancelledError):
+        destination.abort()
+        raise
+    except OSError as oe:
+        destination.abort()
+        logger.error(f"Upload from {client_address[0]} failed: {oe}")
+        return engine.error_response(507 if oe.errno == errno.ENOSPC else 500), False
+    finally:
+        request_data["size"] += body.consumed
+
+
+async def read_body(reader, writer, request_data, clock):
+    """Yield the pieces of a streamed request body; see server.read_body."""
+    body = request_data["body_stream"]
+    if request_data["expect_continue"]:
+        writer.write(CONTINUE)
+    data = body.buffered
+    while True:
+        if data:
+            chunk = body.feed(data)
+            if chunk:
+                yield chunk
+        if body.done:
+            return
+        timeout = clock.body_remaining(body.consumed)
+        if timeout <= 0:
+            raise RequestTimeout("body")
+        try:
+            data = await asyncio.wait_for(reader.read(UPLOAD_CHUNK_SIZE), timeout)
+        except asyncio.TimeoutError:
+            raise RequestTimeout("body")
+        if not data:
+            raise ConnectionResetError("Connection closed during the request body")
+
+
+async def forward_body(reader, writer, client_address, request_data, clock):
+    """Dispatch a proxied request, copying its body upstream as it arrives.
+
+    The upstream is driven from an executor thread, which reads the body
+    through this loop. Returns ``(response, complete)``.
+    """
+    body = request_data["body_stream"]
+    request_data["body_chunks"] = _iterate_from_thread(
+        read_body(reader, writer, request_data, clock), asyncio.get_running_loop()
+    )
+    try:
+        response = await dispatch(request_data, client_address)
+    except HTTPError as err:
+        logger.error(
+            f"{client_address[0]} {err.status_code} {engine.get_status_texts(err.status_code)}, message: {err}"
+        )
+        if isinstance(err, RequestTimeout):
+            engine.count_cut(err.reason)
+        return engine.error_response(err.status_code), False
+    finally:
+        request_data["size"] += body.consumed
+    return response, body.done
+
+
+def _iterate_from_thread(chunks, loop):
+    """Iterate the async generator ``chunks`` from a thread other than ``loop``'s."""
+    while True:
+        chunk = asyncio.run_coroutine_threadsafe(_next_chunk(chunks), loop).result()
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def _next_chunk(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def reject_connection(reader, writer, status, reason, retry_after):
+    metrics.inc("http_rejected_total", (("reason", reason),))
+    try:
+        writer.write(admission.rejection(status, retry_after))
+        await lingering_close(reader, writer)
+    finally:
+        writer.close()
+
+
+async def dispatch(request_data, client_address, directory=None):
+    """Run dispatch_request on an executor thread.
+
+    Besides upstream requests it may read or compress a file, scan a
+    directory or fsync an upload, none of which may hold up the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, engine.dispatch_request, request_data, client_address, directory
+    )
+
+
+async def send_http_response(writer, response, keep_alive=True, head_only=False):
+    """Write ``response``, returning False if the client didn't take it in time."""
+    try:
+        head = response.head(keep_alive)
+        response.bytes_sent = len(head) + (0 if head_only else response.body_length())
+        timeout = engine.send_deadline(response.bytes_sent) - time.monotonic()
+        await asyncio.wait_for(
+            write_response(writer, response, head, head_only),
+            None if timeout == float("inf") else timeout,
+        )
+        if response.stream is not None and not head_only:
+            await write_stream(writer, response)
+        return True
+    except asyncio.TimeoutError:
+        engine.count_cut("send_timeout")
+        logger.info(f"Send timeout for client {writer.get_extra_info('peername')[0]}")
+        return False
+    except BodyError as e:
+        logger.error(
+            f"Response to {writer.get_extra_info('peername')[0]} cut short: {e}"
+        )
+        return False
+    except ConnectionError:
+        raise
+    except Exception:
+        logger.exception(
+            f"Response to {writer.get_extra_info('peername')[0]} failed"
+        )
+        return False
+    finally:
+        response.close()
+
+
+async def write_stream(writer, response):
+    """Write a streamed body, draining after every chunk.
+
+    Blocking streams, such as a proxied body, are advanced on an executor
+    thread. Only the writes are timed out, with a deadline per chunk, so a
+    slow upstream doesn't count against the client.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        if response.stream_blocks:
+            chunk = await loop.run_in_executor(None, next, response.stream, None)
+        else:
+            chunk = next(response.stream, None)
+        if chunk is None:
+            break
+        if not chunk:
+            continue
+        response.count += len(chunk)
+        if response.chunked:
+            chunk = encode_chunk(chunk)
+        await drain_chunk(writer, response, chunk)
+    if response.chunked:
+        await drain_chunk(writer, response, LAST_CHUNK)
+
+
+async def drain_chunk(writer, response, chunk):
+    writer.write(chunk)
+    response.bytes_sent += len(chunk)
+    timeout = engine.send_deadline(len(chunk)) - time.monotonic()
+    await asyncio.wait_for(writer.drain(), None if timeout == float("inf") else timeout)
+
+
+async def write_response(writer, response, head, head_only):
+    if head_only:
+        writer.write(head)
+    elif response.segments is not None:
+        writer.write(head)
+        for segment in response.segments:
+            if isinstance(segment, tuple):
+                await send_file_body(writer, response.file, *segment)
+            else:
+                await write_body(writer, segment)
+    elif response.file is not None:
+        writer.write(head)
+        await send_file_body(writer, response.file, response.offset, response.count)
+    elif len(response.body) <= engine.COALESCE_MAX_BYTES:
+        writer.write(head + response.body)
+    else:
+        writer.write(head)
+        await write_body(writer, response.body)
+    await writer.drain()
+
+
+async def write_body(writer, body):
+    for start in range(0, len(body), BODY_SLICE):
+        writer.write(body[start : start + BODY_SLICE])
+        await writer.drain()
+
+
+async def send_file_body(writer, file, offset, count):
+    await writer.drain()
+    # Zero-copy where the transport allows it, chunked reads otherwise.
+    await asyncio.get_running_loop().sendfile(writer.transport, file, offset, count)
@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import OrderedDict
+
+from .utils import get_mime_type, get_validator_headers
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+
+class CacheEntry:
+    """A cached static file: its bytes plus the headers that describe them."""
+
+    def __init__(self, path, body, st, content_type):
+        self.path = path
+        self.body = body
+        self.ino = st.st_ino
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.headers = {
+            "Content-Type": content_type,
+            "Content-Length": st.st_size,
+            **get_validator_headers(st),
+        }
+        # Encoded bodies keyed by content-coding, e.g. "gzip".
+        self.variants = {}
+
+    @property
+    def nbytes(self):
+        return len(self.body) + sum(len(v) for v in self.variants.values())
+
+    def is_fresh(self, st):
+        return (
+            self.ino == st.st_ino
+            and self.mtime_ns == st.st_mtime_ns
+            and self.size == st.st_size
+        )
+
+
+class FileCache:
+    """Thread-safe LRU cache of small static files, keyed by resolved path.
+
+    Every lookup costs one stat() to revalidate the entry against the file on
+    disk. Files larger than ``max_entry_bytes`` are never cached and are left to
+    the sendfile path, and least recently used entries are evicted once the
+    cache holds more than ``max_bytes``.
+    """
+
+    def __init__(
+        self, max_bytes=CACHE_MAX_BYTES, max_entry_bytes=CACHE_MAX_ENTRY_BYTES
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Return a fresh entry for ``path``, loading it on a miss.
+
+        Returns None when the file is too large to cache. Raises OSError when
+        the file cannot be opened, like open() would.
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.is_fresh(st):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if entry is not None:
+                self._remove(path)
+
+        if st.st_size > self.max_entry_bytes or self.max_bytes <= 0:
+            return None
+
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            body = f.read(self.max_entry_bytes + 1)
+        if len(body) != st.st_size:
+            # Changed while we were reading it, let the caller stream it.
+            return None
+
+        entry = CacheEntry(path, body, st, get_mime_type(path))
+        with self.lock:
+            if path in self.entries:
+                self._remove(path)
+            self.entries[path] = entry
+            self.total_bytes += entry.nbytes
+            self._evict()
+        return entry
+
+    def add_variant(self, entry, coding, body):
+        with self.lock:
+            if coding in entry.variants:
+                return
+            entry.variants[coding] = body
+            if self.entries.get(entry.path) is entry:
+                self.total_bytes += len(body)
+                self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, path):
+        entry = self.entries.pop(path)
+        self.total_bytes -= entry.nbytes
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry.nbytes
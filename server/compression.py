@@ -0,0 +1,146 @@
+import gzip
+import logging
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .utils import get_mime_type
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter(
+    "[%(asctime)s] %(levelname)s: %(message)s at line %(lineno)d in %(module)s"
+)
+
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(formatter)
+
+logger.addHandler(console_handler)
+
+# Bodies smaller than this gain little and cost a round trip through zlib.
+MIN_COMPRESS_SIZE = 256
+COMPRESSION_LEVEL = 6
+
+# Content-codings in order of preference, with the sibling file suffix that
+# holds a pre-compressed copy and the level used when precompressing.
+CODINGS = {"gzip": (".gz", 9)}
+if zstandard is not None:
+    CODINGS = {"zstd": (".zst", 19), **CODINGS}
+if brotli is not None:
+    CODINGS = {"br": (".br", 11), **CODINGS}
+
+COMPRESSIBLE_MIME_TYPES = {
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+}
+
+
+def is_compressible(mime_type):
+    return mime_type.startswith("text/") or mime_type in COMPRESSIBLE_MIME_TYPES
+
+
+def accepted_codings(accept_encoding):
+    """The codings we support that ``Accept-Encoding`` allows, best first.
+
+    Ties are broken by our own preference order in CODINGS.
+    """
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        if coding:
+            weights[coding] = q
+
+    wildcard = weights.get("*", 0)
+    order = list(CODINGS)
+    accepted = [c for c in order if weights.get(c, wildcard) > 0]
+    return sorted(accepted, key=lambda c: -weights.get(c, wildcard))
+
+
+def compress(data, coding, level=None):
+    level = COMPRESSION_LEVEL if level is None else level
+    if coding == "gzip":
+        return gzip.compress(data, compresslevel=min(max(level, 1), 9), mtime=0)
+    if coding == "br":
+        return brotli.compress(data, quality=min(max(level, 0), 11))
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=min(max(level, 1), 22)).compress(data)
+    raise ValueError(f"Unsupported content-coding {coding}")
+
+
+def find_precompressed(path, codings):
+    """Return (coding, sibling path) for the best fresh pre-compressed sibling.
+
+    A sibling older than the file it was made from is stale and ignored.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    for coding in codings:
+        sibling = path + CODINGS[coding][0]
+        try:
+            if os.stat(sibling).st_mtime_ns >= mtime:
+                return coding, sibling
+        except OSError:
+            continue
+    return None
+
+
+def precompress_tree(root):
+    """Write .gz/.br/.zst siblings for every compressible file under ``root``.
+
+    Files whose siblings are already newer than them are skipped, and each
+    sibling is written to a temporary file and renamed into place so a
+    request never sees half of one.
+    """
+    suffixes = tuple(suffix for suffix, _ in CODINGS.values())
+    written = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(suffixes):
+                continue
+            path = os.path.join(dirpath, name)
+            if not is_compressible(get_mime_type(path)):
+                continue
+            st = os.stat(path)
+            if st.st_size < MIN_COMPRESS_SIZE:
+                continue
+
+            data = None
+            for coding, (suffix, level) in CODINGS.items():
+                sibling = path + suffix
+                try:
+                    if os.stat(sibling).st_mtime_ns >= st.st_mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                tmp_path = f"{sibling}.tmp{os.getpid()}"
+                with open(tmp_path, "wb") as f:
+                    f.write(compress(data, coding, level))
+                os.replace(tmp_path, sibling)
+                written += 1
+
+    logger.info(f"Precompressed {written} files under {root}")
+    return written
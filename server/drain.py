@@ -0,0 +1,87 @@
+import select
+import socket
+import threading
+import time
+
+# How often wait() checks whether the last connections have closed.
+POLL_INTERVAL = 0.1
+
+
+class Drain:
+    """The open connections of one threaded server process, for shutting down.
+
+    Connections register themselves while they are open. Once ``start`` is
+    called, ``wait_readable`` stops waiting for keep-alive requests, so idle
+    connections close at once while busy ones finish their response. ``wait``
+    gives them until a deadline, then ``cut`` shuts down whatever is left.
+    """
+
+    def __init__(self):
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self._wake_r = self._wake_w = None
+
+    def open(self):
+        """Set up the wake-up socket; called by each process that serves."""
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_w.setblocking(False)
+
+    def draining(self):
+        return self.event.is_set()
+
+    def add(self, client_socket):
+        with self.lock:
+            self.connections.add(client_socket)
+
+    def discard(self, client_socket):
+        with self.lock:
+            self.connections.discard(client_socket)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def start(self):
+        self.event.set()
+        if self._wake_w is not None:
+            # Never read, so the socket stays readable for every later wait.
+            try:
+                self._wake_w.send(b"\0")
+            except OSError:
+                pass
+
+    def wait_readable(self, client_socket, timeout):
+        """Wait for data on ``client_socket``.
+
+        Returns True once it is readable and False if draining started first.
+        Raises socket.timeout after ``timeout`` seconds, as recv() would.
+        """
+        poller = select.poll()
+        poller.register(client_socket, select.POLLIN)
+        if self._wake_r is not None:
+            poller.register(self._wake_r, select.POLLIN)
+        ready = poller.poll(timeout * 1000)
+        if not ready:
+            raise socket.timeout("timed out")
+        fileno = client_socket.fileno()
+        return any(fd == fileno for fd, _ in ready)
+
+    def wait(self, timeout, queued=lambda: 0):
+        """Wait up to ``timeout`` seconds for every connection to close.
+
+        ``queued`` counts accepted connections not yet registered.
+        """
+        deadline = time.monotonic() + timeout
+        while (self.connections or queued()) and time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+
+    def cut(self):
+        """Shut down the connections still open; returns how many there were."""
+        with self.lock:
+            remaining = list(self.connections)
+        for client_socket in remaining:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return len(remaining)
@@ -0,0 +1,42 @@
+import os
+
+from .utils import STATUS_TEXTS, create_error_page, logger
+
+# Pre-rendered bodies for every 4xx and 5xx status, keyed by status code.
+_pages = {}
+
+
+def load_error_pages(directory=None):
+    """Render every error page once, preferring ``<directory>/<code>.html``.
+
+    Called at import with the built-in pages and again by configure() when
+    --error-pages names a directory of custom ones.
+    """
+    global _pages
+    pages = {}
+    for code in STATUS_TEXTS:
+        if code < 400:
+            continue
+        page = None
+        if directory:
+            path = os.path.join(directory, f"{code}.html")
+            try:
+                with open(path, "rb") as f:
+                    page = f.read()
+            except FileNotFoundError:
+                pass
+            except OSError as oe:
+                logger.warning(f"Could not read error page {path}: {oe}")
+        pages[code] = page if page is not None else create_error_page(code).encode()
+    _pages = pages
+
+
+def error_page(code):
+    """The HTML body for ``code``, as bytes."""
+    page = _pages.get(code)
+    if page is None:
+        page = create_error_page(code).encode()
+    return page
+
+
+load_error_pages()
@@ -0,0 +1,83 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+from .utils import logger
+
+# systemd socket activation (sd_listen_fds): LISTEN_FDS sockets from fd 3 on,
+# meant for the process whose pid is LISTEN_PID.
+SD_LISTEN_FDS_START = 3
+# Set by spawn_successor for the new process: the listening fds it inherits,
+# and the process to stop once it is serving.
+HANDOFF_FDS = "SERVER_LISTEN_FDS"
+HANDOFF_PID = "SERVER_HANDOFF_PID"
+
+_successor = None
+
+
+def inherited_listeners():
+    """Listening sockets passed in by systemd or a previous server, by port.
+
+    Raises OSError or ValueError when the environment names unusable fds.
+    """
+    fds = []
+    if os.environ.get("LISTEN_PID") == str(os.getpid()):
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+        fds = range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count)
+    elif os.environ.get(HANDOFF_FDS):
+        fds = [int(fd) for fd in os.environ[HANDOFF_FDS].split(",")]
+    # Not for the processes this one starts.
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES", HANDOFF_FDS):
+        os.environ.pop(name, None)
+
+    listeners = {}
+    for fd in fds:
+        sock = socket.socket(fileno=fd)
+        address = sock.getsockname()
+        if sock.type != socket.SOCK_STREAM or not isinstance(address, tuple):
+            logger.warning(f"Ignoring inherited fd {fd}: not a TCP socket")
+            sock.close()
+            continue
+        listeners[address[1]] = sock
+    return listeners
+
+
+def spawn_successor(listeners):
+    """Start the server again, from the code on disk, handing it ``listeners``.
+
+    The new process gets the same command line and accepts on the same
+    sockets, so the port is never closed. This one keeps serving until the
+    successor has started up and stops it with SIGTERM; if the successor
+    fails instead, nothing changes.
+    """
+    global _successor
+    if _successor is not None and _successor.poll() is None:
+        logger.warning(f"Server {_successor.pid} is already taking over")
+        return
+    fds = [sock.fileno() for sock in listeners]
+    env = dict(os.environ)
+    env[HANDOFF_PID] = str(os.getpid())
+    if fds:
+        env[HANDOFF_FDS] = ",".join(str(fd) for fd in fds)
+    try:
+        _successor = subprocess.Popen(
+            [sys.executable, *sys.orig_argv[1:]], env=env, pass_fds=fds
+        )
+    except OSError as oe:
+        logger.error(f"Could not start a new server: {oe}")
+        return
+    logger.info(f"Handing the listening sockets over to server {_successor.pid}")
+
+
+def retire_predecessor():
+    """Stop the server that handed its sockets over, now that this one serves."""
+    pid = os.environ.pop(HANDOFF_PID, None)
+    if not pid:
+        return
+    logger.info(f"Taking over from server {pid}")
+    try:
+        os.kill(int(pid), signal.SIGTERM)
+    except (ProcessLookupError, ValueError):
+        pass
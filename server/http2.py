@@ -0,0 +1,351 @@
+import time
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+from . import parser as request_parser
+from .error_pages import error_page
+from .response import BodyError, Response
+
+# Sent by the client to open an HTTP/2 connection. Without TLS the HTTP/1
+# parser reads its first 18 bytes as a "PRI * HTTP/2.0" request with no
+# headers, which is how prior-knowledge h2c connections are recognised.
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+PREFACE_REQUEST_LENGTH = 18
+MAX_CONCURRENT_STREAMS = 100
+# Body bytes read from a file per DATA frame, and the most bytes one pump()
+# call frames before handing them to the engine to write.
+FILE_CHUNK_SIZE = 64 * 1024
+PUMP_MAX_BYTES = 256 * 1024
+# Connection-specific HTTP/1 headers, forbidden in HTTP/2 responses.
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+def available():
+    return h2 is not None
+
+
+def is_preface(request_data):
+    """True for the request the HTTP/1 parser makes of the h2c preface."""
+    req_headers = request_data["headers"]
+    return (
+        req_headers.get("method") == "PRI"
+        and req_headers.get("path") == "*"
+        and req_headers.get("http_version") == "HTTP/2.0"
+    )
+
+
+class _Stream:
+    """A response being framed onto one stream."""
+
+    __slots__ = ("request", "response", "chunks", "pending", "file_seconds", "sent_at")
+
+    def __init__(self, request, response, chunks, file_seconds):
+        self.request = request
+        self.response = response
+        self.chunks = chunks
+        # The unsent part of the current chunk: empty while the next one is not
+        # ready yet, None once the body is exhausted.
+        self.pending = memoryview(b"")
+        self.file_seconds = file_seconds
+        self.sent_at = time.perf_counter()
+
+    def send_seconds(self):
+        return time.perf_counter() - self.sent_at
+
+
+class HTTP2Session:
+    """The HTTP/2 side of one connection, independent of how bytes move.
+
+    The engine feeds received bytes to ``receive``, which returns the requests
+    whose streams have completed, in the same form RequestParser produces.
+    Their responses go back through ``respond``, and ``pump`` frames them
+    round-robin across streams within the peer's flow-control windows, so a
+    large file never holds up the small ones sharing the connection. The
+    engine writes what ``pump`` returns and reports finished streams from
+    ``take_finished``.
+
+    A body iterator may yield None when its next chunk is not ready yet; the
+    stream is then skipped until a later ``pump`` finds data.
+    """
+
+    def __init__(self):
+        config = h2.config.H2Configuration(client_side=False, header_encoding=None)
+        self.conn = h2.connection.H2Connection(config=config)
+        self.conn.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: MAX_CONCURRENT_STREAMS,
+                h2.settings.SettingCodes.MAX_HEADER_LIST_SIZE: (
+                    request_parser.MAX_HEADER_SIZE
+                ),
+            },
+        )
+        self.conn.initiate_connection()
+        self.closed = False
+        self._incoming = {}
+        self._outgoing = {}
+        self._finished = []
+        self._out = bytearray(self.conn.data_to_send())
+
+    def busy(self):
+        """True while any stream is still being received or answered."""
+        return bool(self._incoming or self._outgoing)
+
+    def receive(self, data):
+        """Process bytes from the client.
+
+        Returns ``(stream_id, request_data)`` for each request completed by
+        them. Requests refused outright, e.g. for an oversized body, are
+        answered here and only show up in ``take_finished``.
+        """
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            # h2 has already queued the GOAWAY.
+            self.closed = True
+            self._out += self.conn.data_to_send()
+            return []
+        ready = []
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self._start_request(event)
+            elif isinstance(event, h2.events.DataReceived):
+                self._receive_body(event)
+            elif isinstance(event, h2.events.StreamEnded):
+                request = self._incoming.pop(event.stream_id, None)
+                if request is not None:
+                    request["size"] += len(request["body"])
+                    request["body"] = bytes(request["body"])
+                    ready.append((event.stream_id, request))
+            elif isinstance(event, h2.events.StreamReset):
+                self._incoming.pop(event.stream_id, None)
+                self._finish(event.stream_id)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.closed = True
+        self._out += self.conn.data_to_send()
+        return ready
+
+    def respond(self, stream_id, request, response, file_seconds=0.0):
+        """Queue ``response`` on ``stream_id``; HEAD requests get headers only."""
+        headers = [(":status", str(response.status_code))]
+        for name, value in response.headers.items():
+            name = name.lower()
+            if name not in HOP_BY_HOP_HEADERS:
+                headers.append((name, str(value)))
+        head_only = request["headers"].get("method") == "HEAD"
+        chunks = iter(()) if head_only else _body_chunks(response)
+        stream = _Stream(request, response, chunks, file_seconds)
+        self._outgoing[stream_id] = stream
+        if not self._refill(stream_id, stream):
+            return
+        try:
+            self.conn.send_headers(
+                stream_id, headers, end_stream=stream.pending is None
+            )
+        except h2.exceptions.StreamClosedError:
+            self._finish(stream_id)
+            return
+        self._flush(stream)
+        if stream.pending is None:
+            self._finish(stream_id)
+
+    def pump(self, limit=PUMP_MAX_BYTES):
+        """Frame queued response bodies; returns the bytes to write, maybe b""."""
+        progress = True
+        while progress and self._outgoing and len(self._out) < limit:
+            progress = False
+            for stream_id, stream in list(self._outgoing.items()):
+                if not stream.pending:
+                    if not self._refill(stream_id, stream):
+                        continue
+                    if stream.pending is None:
+                        # The body ran out while waiting for its next chunk.
+                        self._send_data(stream_id, stream, b"")
+                        progress = True
+                        continue
+                    if not stream.pending:
+                        continue
+                size = min(
+                    self.conn.local_flow_control_window(stream_id),
+                    self.conn.max_outbound_frame_size,
+                )
+                if size <= 0:
+                    continue
+                piece = stream.pending[:size]
+                stream.pending = stream.pending[size:]
+                if not stream.pending and not self._refill(stream_id, stream):
+                    continue
+                self._send_data(stream_id, stream, piece)
+                progress = True
+        data = bytes(self._out)
+        self._out.clear()
+        return data
+
+    def take_finished(self):
+        """Streams answered since the last call, for metrics and the access log."""
+        finished, self._finished = self._finished, []
+        return finished
+
+    def close(self):
+        """Send GOAWAY and release every open response."""
+        if not self.closed:
+            self.closed = True
+            self.conn.close_connection()
+            self._out += self.conn.data_to_send()
+        for stream_id in list(self._outgoing):
+            self._finish(stream_id)
+        self._incoming.clear()
+
+    def _start_request(self, event):
+        started = time.perf_counter()
+        pseudo = {}
+        metadata = {}
+        size = 0
+        for name, value in event.headers:
+            size += len(name) + len(value)
+            name = name.decode("latin-1")
+            if name.startswith(":"):
+                pseudo[name] = value
+                continue
+            value = value.decode("latin-1")
+            if name in metadata:
+                separator = "; " if name == "cookie" else ", "
+                metadata[name] += separator + value
+            else:
+                metadata[name] = value
+        if ":authority" in pseudo:
+            metadata.setdefault("host", pseudo[":authority"].decode("latin-1"))
+        target = pseudo.get(":path", b"")
+        try:
+            target = target.decode("utf-8")
+        except UnicodeDecodeError:
+            target = ""
+        path, _, query = target.partition("?")
+        request = {
+            "headers": {
+                "method": pseudo.get(":method", b"").decode("latin-1"),
+                "path": path,
+                "query": query,
+                "http_version": "HTTP/2",
+                "metadata": metadata,
+            },
+            "body": bytearray(),
+            "size": size,
+            "parse_seconds": time.perf_counter() - started,
+        }
+        if not path:
+            self._refuse(event.stream_id, request, 400)
+        elif len(target) > request_parser.MAX_URI_LENGTH:
+            self._refuse(event.stream_id, request, 414)
+        elif size > request_parser.MAX_HEADER_SIZE:
+            self._refuse(event.stream_id, request, 431)
+        else:
+            self._incoming[event.stream_id] = request
+
+    def _receive_body(self, event):
+        try:
+            self.conn.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id
+            )
+        except h2.exceptions.StreamClosedError:
+            pass
+        request = self._incoming.get(event.stream_id)
+        if request is None:
+            return
+        request["body"] += event.data
+        if len(request["body"]) > request_parser.MAX_BODY_SIZE:
+            del self._incoming[event.stream_id]
+            request["size"] += len(request["body"])
+            request["body"] = b""
+            self._refuse(event.stream_id, request, 413)
+
+    def _refuse(self, stream_id, request, status):
+        response = Response(status, error_page(status), "text/html")
+        self.respond(stream_id, request, response)
+
+    def _refill(self, stream_id, stream):
+        """Load the next chunk; False if the body failed and the stream was reset."""
+        try:
+            stream.pending = _next_chunk(stream.chunks)
+        except BodyError:
+            try:
+                self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+            except h2.exceptions.StreamClosedError:
+                pass
+            self._flush(stream)
+            self._finish(stream_id)
+            return False
+        return True
+
+    def _send_data(self, stream_id, stream, piece):
+        end = stream.pending is None
+        try:
+            self.conn.send_data(stream_id, piece, end_stream=end)
+        except h2.exceptions.StreamClosedError:
+            self._finish(stream_id)
+            return
+        if stream.response.stream is not None:
+            stream.response.count += len(piece)
+        self._flush(stream)
+        if end:
+            self._finish(stream_id)
+
+    def _flush(self, stream):
+        data = self.conn.data_to_send()
+        stream.response.bytes_sent += len(data)
+        self._out += data
+
+    def _finish(self, stream_id):
+        stream = self._outgoing.pop(stream_id, None)
+        if stream is not None:
+            stream.response.close()
+            self._finished.append(stream)
+
+
+def _body_chunks(response):
+    if response.segments is not None:
+        for segment in response.segments:
+            if isinstance(segment, tuple):
+                yield from _file_chunks(response.file, *segment)
+            else:
+                yield segment
+    elif response.file is not None:
+        yield from _file_chunks(response.file, response.offset, response.count)
+    elif response.stream is not None:
+        yield from response.stream
+    else:
+        yield response.body
+
+
+def _file_chunks(file, offset, count):
+    file.seek(offset)
+    while count > 0:
+        data = file.read(min(count, FILE_CHUNK_SIZE))
+        if not data:
+            return
+        count -= len(data)
+        yield data
+
+
+def _next_chunk(chunks):
+    """The next chunk as a memoryview, empty if it is not ready, None at the end."""
+    for chunk in chunks:
+        if chunk is None:
+            return memoryview(b"")
+        if len(chunk):
+            return memoryview(chunk)
+    return None
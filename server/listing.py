@@ -0,0 +1,244 @@
+import html
+import json
+import os
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+from .utils import parse_path
+
+PAGE_SIZE = 1000
+# Entries rendered per piece of a streamed page.
+STREAM_BATCH = 100
+MAX_CACHED_DIRECTORIES = 256
+# Rendered pages kept per directory, for the different page/sort/format mixes.
+MAX_CACHED_PAGES = 32
+SORT_KEYS = ("name", "size", "mtime")
+# Set by configure() when --uploads is on, to put an upload form on HTML pages.
+UPLOAD_FORM = False
+
+
+class Listing:
+    """One directory's entries, read with a single scandir pass.
+
+    ``entries`` holds ``(name, is_dir)`` pairs straight from scandir's d_type.
+    Sizes and modification times cost a stat() per entry, so they are only
+    fetched the first time a page needs them.
+    """
+
+    def __init__(self, path, mtime_ns):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        with os.scandir(path) as it:
+            self.entries = [(entry.name, _is_dir(entry)) for entry in it]
+        self._stats = None
+        self._orders = {}
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def stats(self):
+        if self._stats is None:
+            stats = {}
+            for name, _ in self.entries:
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                    stats[name] = (st.st_size, st.st_mtime)
+                except OSError:
+                    stats[name] = (0, 0)
+            self._stats = stats
+        return self._stats
+
+    def ordered(self, sort, reverse):
+        """Entries sorted by ``sort``, directories first."""
+        key = (sort, reverse)
+        if key not in self._orders:
+            if sort == "name":
+                order = sorted(self.entries, key=lambda e: e[0].lower())
+            else:
+                index = SORT_KEYS.index(sort) - 1
+                stats = self.stats()
+                order = sorted(self.entries, key=lambda e: stats[e[0]][index])
+            if reverse:
+                order.reverse()
+            order.sort(key=lambda e: not e[1])
+            self._orders[key] = order
+        return self._orders[key]
+
+
+class ListingCache:
+    """Thread-safe LRU of directory listings, revalidated by directory mtime.
+
+    Adding, removing or renaming a file bumps its directory's mtime, which
+    drops the cached entries and every page rendered from them. A file that
+    only changes in place keeps its old size and date until then.
+    """
+
+    def __init__(self, max_directories=MAX_CACHED_DIRECTORIES):
+        self.max_directories = max_directories
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """The listing of ``path``. Raises OSError if it can't be read."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self.listings.move_to_end(path)
+                return listing
+        listing = Listing(path, mtime_ns)
+        with self.lock:
+            self.listings[path] = listing
+            self.listings.move_to_end(path)
+            while len(self.listings) > self.max_directories:
+                self.listings.popitem(last=False)
+        return listing
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+
+def parse_listing_query(query):
+    """Read ``page``, ``sort``, ``order`` and ``format`` out of a query string.
+
+    Returns None when a value is not one the listing understands.
+    """
+    params = urllib.parse.parse_qs(query)
+    options = {
+        "page": params.get("page", ["1"])[-1],
+        "sort": params.get("sort", ["name"])[-1],
+        "order": params.get("order", ["asc"])[-1],
+        "format": params.get("format", ["html"])[-1],
+    }
+    if (
+        not options["page"].isdigit()
+        or int(options["page"]) < 1
+        or options["sort"] not in SORT_KEYS
+        or options["order"] not in ("asc", "desc")
+        or options["format"] not in ("html", "json")
+    ):
+        return None
+    options["page"] = int(options["page"])
+    return options
+
+
+def render_listing(listing, url_path, options):
+    """Render one page of ``listing``, reusing an earlier rendering if cached.
+
+    Returns ``(body, content_type)``, or None when the page is past the end.
+    A cached page's body is bytes. Otherwise it is a generator yielding the
+    page STREAM_BATCH entries at a time, which caches the whole page once the
+    last piece has been produced.
+    """
+    key = (url_path, *options.values())
+    with listing.lock:
+        cached = listing.pages.get(key)
+    if cached is not None:
+        return cached
+
+    order = listing.ordered(options["sort"], options["order"] == "desc")
+    pages = max(1, -(-len(order) // PAGE_SIZE))
+    if options["page"] > pages:
+        return None
+    start = (options["page"] - 1) * PAGE_SIZE
+    entries = order[start : start + PAGE_SIZE]
+    if options["format"] == "json":
+        pieces = _render_json(listing, entries, url_path, options, pages, len(order))
+        content_type = "application/json"
+    else:
+        pieces = _render_html(entries, url_path, options, pages)
+        content_type = "text/html; charset=utf-8"
+    return _cache_page(listing, key, pieces, content_type), content_type
+
+
+def _cache_page(listing, key, pieces, content_type):
+    parts = []
+    for piece in pieces:
+        data = piece.encode("utf-8")
+        parts.append(data)
+        yield data
+    # A racing thread may render the same page; either copy is correct.
+    with listing.lock:
+        listing.pages[key] = (b"".join(parts), content_type)
+        while len(listing.pages) > MAX_CACHED_PAGES:
+            listing.pages.popitem(last=False)
+
+
+def _render_html(entries, url_path, options, pages):
+    title = html.escape(f"/{url_path}")
+    yield (
+        '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>Directory Listing</title></head>'
+        f"<body><h1>Directory Listing for {title}</h1><hr><ul>"
+    )
+    for start in range(0, len(entries), STREAM_BATCH):
+        parts = []
+        for name, is_dir in entries[start : start + STREAM_BATCH]:
+            slash = "/" if is_dir else ""
+            parts.append(
+                f'<li><a href="{html.escape(parse_path(name))}{slash}">'
+                f"{html.escape(name)}{slash}</a></li>"
+            )
+        yield "".join(parts)
+    tail = "</ul><hr>"
+    if pages > 1:
+        tail += _render_pager(options, pages)
+    if UPLOAD_FORM:
+        tail += (
+            '<form method="post" enctype="multipart/form-data">'
+            '<input type="file" name="file" multiple> <button>Upload</button></form>'
+        )
+    yield tail + "</body></html>"
+
+
+def _render_pager(options, pages):
+    def link(page, text):
+        query = urllib.parse.urlencode(
+            {"page": page, "sort": options["sort"], "order": options["order"]}
+        )
+        return f'<a href="?{html.escape(query)}">{text}</a>'
+
+    page = options["page"]
+    parts = ["<p>"]
+    if page > 1:
+        parts.append(link(page - 1, "&laquo; Previous") + " ")
+    parts.append(f"Page {page} of {pages}")
+    if page < pages:
+        parts.append(" " + link(page + 1, "Next &raquo;"))
+    parts.append("</p>")
+    return "".join(parts)
+
+
+def _render_json(listing, entries, url_path, options, pages, total):
+    """The same text json.dumps gives for the whole page, in pieces."""
+    stats = listing.stats()
+    head = json.dumps(
+        {
+            "path": f"/{url_path}",
+            "page": options["page"],
+            "pages": pages,
+            "total": total,
+        }
+    )
+    yield head[:-1] + ', "entries": ['
+    for start in range(0, len(entries), STREAM_BATCH):
+        batch = [
+            json.dumps(
+                {
+                    "name": name,
+                    "type": "directory" if is_dir else "file",
+                    "size": stats[name][0],
+                    "mtime": stats[name][1],
+                }
+            )
+            for name, is_dir in entries[start : start + STREAM_BATCH]
+        ]
+        yield (", " if start else "") + ", ".join(batch)
+    yield "]}"
+
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
@@ -0,0 +1,185 @@
+import threading
+from bisect import bisect_left
+
+# Latency buckets in seconds, fine grained at the low end because the parse
+# and file phases of a cached request take microseconds.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# name -> (type, help)
+METRICS = {
+    "http_requests_total": ("counter", "Requests served, by method, route and status."),
+    "http_request_phase_seconds": (
+        "histogram",
+        "Time spent per request in the parse, file and send phases.",
+    ),
+    "http_request_bytes_total": ("counter", "Bytes of requests received."),
+    "http_response_bytes_total": ("counter", "Bytes of responses sent."),
+    "http_active_connections": ("gauge", "Client connections currently open."),
+    "http_connections_cut_total": (
+        "counter",
+        "Connections closed for being too slow or idle, by reason.",
+    ),
+    "http_rejected_total": (
+        "counter",
+        "Connections and requests turned away by admission control, by reason.",
+    ),
+    "upstream_requests_total": (
+        "counter",
+        "Requests proxied to each upstream backend, by status or error.",
+    ),
+    "tls_handshakes_total": (
+        "counter",
+        "Completed TLS handshakes, by whether the session was resumed.",
+    ),
+    "tls_handshake_failures_total": (
+        "counter",
+        "TLS handshakes that failed or timed out.",
+    ),
+}
+
+
+class _Shard:
+    """One thread's private counters. Only that thread ever writes to it."""
+
+    __slots__ = ("counters", "gauges", "histograms")
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+
+class Metrics:
+    """Prometheus style metrics with per-thread shards merged on scrape.
+
+    Recording a value only touches the calling thread's own dicts, so the
+    request path never takes a lock. ``render`` adds the shards up when
+    /metrics is scraped, and collectors registered with ``add_collector``
+    contribute values that are cheaper to read at scrape time, like queue
+    depths and cache statistics.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._collectors = []
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def add(self, name, value, labels=()):
+        """Move a gauge up or down."""
+        gauges = self._shard().gauges
+        key = (name, labels)
+        gauges[key] = gauges.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[1] += value
+
+    def add_collector(self, name, kind, help_text, collect):
+        """Register ``collect() -> {labels: value}``, called on every scrape."""
+        self._collectors.append((name, kind, help_text, collect))
+
+    def remove_collector(self, name):
+        self._collectors = [c for c in self._collectors if c[0] != name]
+
+    def _merge(self):
+        counters, gauges, histograms = {}, {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, value in list(shard.gauges.items()):
+                gauges[key] = gauges.get(key, 0) + value
+            for key, (buckets, total) in list(shard.histograms.items()):
+                merged = histograms.setdefault(
+                    key, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+                )
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+        return counters, gauges, histograms
+
+    def render(self):
+        """The merged metrics in the Prometheus text exposition format."""
+        counters, gauges, histograms = self._merge()
+        samples = {}
+        for (name, labels), value in {**counters, **gauges}.items():
+            samples.setdefault(name, []).append(
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+            )
+        for (name, labels), (buckets, total) in histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                le = labels + (("le", str(bound)),)
+                lines.append(f"{name}_bucket{_format_labels(le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        out = []
+        for name, (kind, help_text) in METRICS.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples.get(name, []))
+        for name, kind, help_text, collect in list(self._collectors):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in collect().items():
+                out.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(out) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+metrics = Metrics()
@@ -0,0 +1,147 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from .utils import get_validator_headers
+
+MMAP_POOL_BYTES = 256 * 1024 * 1024
+
+
+class MappedFile:
+    """A static file mapped read-only, shared by every response sending it.
+
+    ``view`` is a memoryview of the whole map; responses send slices of it.
+    ``refs`` counts the responses still holding it, and the map is only
+    closed once it has been dropped from the pool and the count is back to
+    zero.
+    """
+
+    def __init__(self, pool, path, file, st):
+        self.pool = pool
+        self.path = path
+        self.ino = st.st_ino
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.headers = {"Content-Length": st.st_size, **get_validator_headers(st)}
+        self.refs = 0
+        self.pooled = True
+
+    def release(self):
+        self.pool.release(self)
+
+    def is_fresh(self, st):
+        return (
+            self.ino == st.st_ino
+            and self.mtime_ns == st.st_mtime_ns
+            and self.size == st.st_size
+        )
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A slice is still referenced somewhere; the map is closed when
+            # it is garbage collected instead.
+            pass
+
+
+class MmapPool:
+    """Thread-safe LRU pool of memory-mapped files, keyed by resolved path.
+
+    Each entry remembers the inode, mtime and size it was mapped with, and a
+    lookup revalidates them with one stat(). A file replaced on disk, e.g.
+    renamed over by an upload, gets a fresh map while responses still
+    sending the old one keep it until they finish. Once the mapped bytes
+    exceed ``max_bytes``, the least recently used maps that no response is
+    using are unmapped.
+
+    Files must be replaced, not truncated in place: reading a map past the
+    new end of its file kills the process with SIGBUS.
+    """
+
+    def __init__(self, max_bytes=MMAP_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        """Return a fresh MappedFile for ``path`` with one more reference.
+
+        Returns None when the file is empty or larger than the pool. Raises
+        OSError when the file cannot be opened, like open() would. Every
+        acquired map must be given back with ``release``.
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.is_fresh(st):
+                self.entries.move_to_end(path)
+                entry.refs += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if entry is not None:
+                self._remove(path)
+
+        if not 0 < st.st_size <= self.max_bytes:
+            return None
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if not 0 < st.st_size <= self.max_bytes:
+                return None
+            entry = MappedFile(self, path, f, st)
+
+        with self.lock:
+            if path in self.entries:
+                self._remove(path)
+            self.entries[path] = entry
+            self.total_bytes += entry.size
+            entry.refs += 1
+            self._evict()
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.refs or entry.pooled:
+                return
+        entry.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "maps": len(self.entries),
+                "bytes": self.total_bytes,
+            }
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.entries):
+                self._remove(path)
+
+    def _remove(self, path):
+        """Drop ``path`` from the pool; its map closes once nothing uses it."""
+        entry = self.entries.pop(path)
+        self.total_bytes -= entry.size
+        entry.pooled = False
+        if not entry.refs:
+            entry.close()
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for path, entry in list(self.entries.items()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if not entry.refs:
+                self._remove(path)
@@ -0,0 +1,414 @@
+import re
+import time
+from collections.abc import Mapping
+
+MAX_HEADER_SIZE = 16 * 1024
+MAX_URI_LENGTH = 8 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+BYTES_RECV_AMT = 2048
+
+_CONTENT_LENGTH = re.compile(rb"^content-length:[ \t]*([^\r\n]*)", re.I | re.M)
+_TRANSFER_ENCODING = re.compile(rb"^transfer-encoding:[ \t]*([^\r\n]*)", re.I | re.M)
+# A field name followed by whitespace before its colon (RFC 9112, 5.1).
+_SPACE_BEFORE_COLON = re.compile(rb"^[^:\s]+[ \t]+:", re.M)
+_EXPECT_CONTINUE = re.compile(rb"^expect[ \t]*:[ \t]*100-continue", re.I | re.M)
+# Longest chunk size line or trailer field accepted in a chunked body.
+MAX_CHUNK_LINE = 1024
+# A chunk size is hex digits only: no sign, 0x prefix or underscores, which
+# int(..., 16) would accept and another parser might read differently.
+_CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}")
+
+
+def parse_chunk_size(line):
+    """The size in a chunk size line, ignoring extensions; None if malformed."""
+    size = line.split(b";", 1)[0].rstrip(b" \t")
+    if _CHUNK_SIZE.fullmatch(size) is None:
+        return None
+    return int(size, 16)
+
+
+class HTTPError(Exception):
+    """A request the parser refuses, carrying the status code to answer with."""
+
+    def __init__(self, status_code, message=""):
+        super().__init__(message or str(status_code))
+        self.status_code = status_code
+
+
+class RequestTimeout(HTTPError):
+    """The client took too long to send the request ``phase`` (header or body)."""
+
+    def __init__(self, phase):
+        super().__init__(408, f"Timed out receiving the request {phase}")
+        self.reason = f"{phase}_timeout"
+
+
+class LazyHeaders(Mapping):
+    """Request header fields, split out of the raw header block on first use.
+
+    Names are lower-cased and repeated fields are joined with ", ".
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._fields = None
+
+    def _parse(self):
+        fields = {}
+        for line in self._raw.split(b"\r\n"):
+            name, sep, value = line.partition(b":")
+            if not sep or not name:
+                continue
+            name = name.strip().lower().decode("latin-1")
+            value = value.strip().decode("latin-1")
+            fields[name] = f"{fields[name]}, {value}" if name in fields else value
+        self._fields = fields
+        return fields
+
+    def _get_fields(self):
+        return self._parse() if self._fields is None else self._fields
+
+    def __getitem__(self, name):
+        return self._get_fields()[name]
+
+    def __iter__(self):
+        return iter(self._get_fields())
+
+    def __len__(self):
+        return len(self._get_fields())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser for one connection.
+
+    Bytes are appended to a single bytearray, either by ``recv_into`` straight
+    from a socket or by ``feed``. ``next_request`` returns one request at a time
+    and leaves pipelined bytes in place. The header terminator search resumes
+    where the previous one stopped, so a slowly arriving header is scanned
+    once rather than once per recv.
+
+    ``stream_body(headers)`` may pick requests whose body is not buffered: it
+    returns the largest body allowed for them, or None to buffer as usual.
+    Such requests are returned as soon as their head is complete, with a
+    BodyStream under ``"body_stream"`` for the engine to read the body through.
+    It is only asked about requests that have a body.
+    """
+
+    def __init__(
+        self,
+        max_header_size=None,
+        max_uri_length=None,
+        max_body_size=None,
+        stream_body=None,
+    ):
+        self.max_header_size = max_header_size or MAX_HEADER_SIZE
+        self.max_uri_length = max_uri_length or MAX_URI_LENGTH
+        self.max_body_size = max_body_size or MAX_BODY_SIZE
+        self.stream_body = stream_body
+        self.buffer = bytearray()
+        self._chunk = bytearray(BYTES_RECV_AMT)
+        self._reset()
+
+    def _reset(self):
+        self._scan_from = 0
+        self._request = None
+        self._body_start = 0
+        self._content_length = None
+        self._chunked = None
+        self._consumed = 0
+        self._parse_seconds = 0.0
+        self._expect_continue = False
+
+    def has_data(self):
+        return bool(self.buffer)
+
+    def body_received(self):
+        """Bytes of body buffered so far, or None while the head is incomplete."""
+        if self._request is None:
+            return None
+        return len(self.buffer) - self._body_start
+
+    def recv_into(self, sock):
+        """Receive from ``sock`` into the buffer. Returns 0 at end of stream."""
+        view = memoryview(self._chunk)
+        count = sock.recv_into(view)
+        self.buffer += view[:count]
+        return count
+
+    def feed(self, data):
+        self.buffer += data
+
+    def expects_continue(self):
+        """True, once per request, if the client waits for 100 Continue.
+
+        Only asked while the body is incomplete, so a client that sent it
+        without waiting is not answered.
+        """
+        expect, self._expect_continue = self._expect_continue, False
+        return expect and self._request is not None
+
+    def next_request(self):
+        """Return the next complete request, or None until more bytes arrive.
+
+        Raises HTTPError with 400, 413, 414 or 431 for requests that must be
+        refused.
+        """
+        started = time.perf_counter()
+        try:
+            if self._request is None and not self._parse_head():
+                return None
+            has_body = self._content_length or self._chunked is not None
+            if self.stream_body is not None and has_body:
+                limit = self.stream_body(self._request["headers"])
+                if limit is not None:
+                    return self._detach_body(limit)
+            if (
+                self._content_length is not None
+                and self._content_length > self.max_body_size
+            ):
+                raise HTTPError(413, "Request body too large")
+            if self._chunked is not None:
+                body = self._parse_chunked()
+            else:
+                body = self._parse_fixed()
+            if body is None:
+                return None
+        finally:
+            self._parse_seconds += time.perf_counter() - started
+
+        request = self._request
+        request["body"] = body
+        request["size"] = self._consumed
+        request["parse_seconds"] = self._parse_seconds
+        self._reset()
+        return request
+
+    def _parse_head(self):
+        buffer = self.buffer
+        header_end = buffer.find(b"\r\n\r\n", max(self._scan_from - 3, 0))
+        if header_end == -1:
+            # Neither "\r\n\r\n" nor a CRLF line contains "\n\n": the head
+            # ends in bare LFs, which are refused rather than waited on.
+            if buffer.find(b"\n\n", max(self._scan_from - 1, 0)) != -1:
+                raise HTTPError(400, "Bare LF line endings")
+            self._scan_from = len(buffer)
+            if len(buffer) > self.max_header_size:
+                if buffer.find(b"\r\n", 0, self.max_header_size) == -1:
+                    raise HTTPError(414, "Request line too long")
+                raise HTTPError(431, "Request header too large")
+            return False
+        if header_end + 4 > self.max_header_size:
+            raise HTTPError(431, "Request header too large")
+
+        line_end = buffer.find(b"\r\n", 0, header_end + 2)
+        try:
+            request_line = buffer[:line_end].decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPError(400, "Error Decoding request line to utf-8")
+        parts = request_line.split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HTTPError(400, "Incorrect http request format")
+        method, target, http_version = parts
+        if len(target) > self.max_uri_length:
+            raise HTTPError(414, "Request URI too long")
+        path, _, query = target.partition("?")
+
+        raw_headers = bytes(buffer[line_end + 2 : header_end])
+        self._body_start = header_end + 4
+
+        # Requests are forwarded upstream, so any doubt about where the body
+        # ends is refused rather than resolved one way.
+        if _SPACE_BEFORE_COLON.search(raw_headers):
+            raise HTTPError(400, "Whitespace before a header colon")
+        encodings = _TRANSFER_ENCODING.findall(raw_headers)
+        lengths = _CONTENT_LENGTH.findall(raw_headers)
+        if encodings and lengths:
+            raise HTTPError(400, "Both Content-Length and Transfer-Encoding")
+        if encodings:
+            codings = b",".join(encodings).split(b",")
+            if codings[-1].strip().lower() != b"chunked":
+                raise HTTPError(400, "Transfer-Encoding must end with chunked")
+            self._chunked = {"pos": self._body_start, "body": bytearray()}
+        elif lengths:
+            values = {v.strip() for line in lengths for v in line.split(b",")}
+            if len(values) != 1:
+                raise HTTPError(400, "Conflicting Content-Length values")
+            value = values.pop()
+            if not value.isdigit():
+                raise HTTPError(400, "Invalid Content-Length")
+            self._content_length = int(value)
+        self._expect_continue = (
+            http_version == "HTTP/1.1"
+            and bool(self._content_length or self._chunked)
+            and _EXPECT_CONTINUE.search(raw_headers) is not None
+        )
+
+        self._request = {
+            "headers": {
+                "method": method,
+                "path": path,
+                "query": query,
+                "http_version": http_version,
+                "metadata": LazyHeaders(raw_headers),
+            },
+            "body": b"",
+        }
+        return True
+
+    def _detach_body(self, limit):
+        if self._content_length is not None and self._content_length > limit:
+            raise HTTPError(413, "Request body too large")
+        request = self._request
+        request["body"] = b""
+        request["body_stream"] = BodyStream(
+            self._content_length,
+            self._chunked is not None,
+            limit,
+            bytes(self.buffer[self._body_start :]),
+        )
+        request["size"] = self._body_start
+        request["parse_seconds"] = self._parse_seconds
+        request["expect_continue"] = self._expect_continue
+        self.buffer.clear()
+        self._reset()
+        return request
+
+    def _parse_fixed(self):
+        end = self._body_start + (self._content_length or 0)
+        if len(self.buffer) < end:
+            return None
+        body = bytes(self.buffer[self._body_start : end])
+        del self.buffer[:end]
+        self._consumed = end
+        return body
+
+    def _parse_chunked(self):
+        state = self._chunked
+        buffer = self.buffer
+        while True:
+            pos = state["pos"]
+            line_end = buffer.find(b"\r\n", pos)
+            if line_end == -1:
+                if len(buffer) - pos > MAX_CHUNK_LINE:
+                    raise HTTPError(400, "Chunk size line too long")
+                return None
+
+            if "trailers" in state:
+                # After the last chunk: skip trailer fields up to an empty line.
+                state["pos"] = line_end + 2
+                if line_end == pos:
+                    del buffer[: line_end + 2]
+                    self._consumed = line_end + 2
+                    return bytes(state["body"])
+                continue
+
+            size = parse_chunk_size(bytes(buffer[pos:line_end]))
+            if size is None:
+                raise HTTPError(400, "Malformed chunk")
+            if size == 0:
+                state["trailers"] = True
+                state["pos"] = line_end + 2
+                continue
+            if len(state["body"]) + size > self.max_body_size:
+                raise HTTPError(413, "Request body too large")
+
+            data_start = line_end + 2
+            if len(buffer) < data_start + size + 2:
+                return None
+            if buffer[data_start + size : data_start + size + 2] != b"\r\n":
+                raise HTTPError(400, "Malformed chunk")
+            state["body"] += buffer[data_start : data_start + size]
+            state["pos"] = data_start + size + 2
+
+
+class BodyStream:
+    """Incremental decoder for a request body that is not buffered whole.
+
+    ``buffered`` holds the bytes the parser had already read past the head.
+    The engine passes them and then every further read to ``feed``, which
+    returns the body bytes among them, until ``done``. Bytes past the end of
+    the body are left in ``leftover`` for the parser. Raises HTTPError with
+    400 for broken chunked framing and 413 once the body exceeds ``max_size``.
+    """
+
+    def __init__(self, content_length, chunked, max_size, buffered=b""):
+        self.content_length = content_length
+        self.chunked = chunked
+        self.max_size = max_size
+        self.buffered = buffered
+        self.received = 0
+        self.consumed = 0
+        self.done = not chunked and not content_length
+        self.leftover = b""
+        self._remaining = 0 if chunked else content_length or 0
+        self._state = "size"
+        self._line = bytearray()
+
+    def feed(self, data):
+        self.consumed += len(data)
+        if not self.chunked:
+            body = data[: self._remaining]
+            self._remaining -= len(body)
+            self.received += len(body)
+            if not self._remaining:
+                self._finish(data, len(body))
+            return body
+
+        pieces = []
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self._state == "data":
+                piece = data[pos : pos + self._remaining]
+                pieces.append(piece)
+                pos += len(piece)
+                self._remaining -= len(piece)
+                if not self._remaining:
+                    self._state = "data_end"
+                continue
+            line, pos = self._take_line(data, pos)
+            if line is None:
+                break
+            if self._state == "size":
+                self._start_chunk(line)
+            elif self._state == "data_end":
+                if line:
+                    raise HTTPError(400, "Malformed chunk")
+                self._state = "size"
+            elif not line:
+                # The empty line after the trailer fields ends the body.
+                self._finish(data, pos)
+        return b"".join(pieces)
+
+    def _start_chunk(self, line):
+        size = parse_chunk_size(line)
+        if size is None:
+            raise HTTPError(400, "Malformed chunk")
+        if size == 0:
+            self._state = "trailers"
+            return
+        if self.received + size > self.max_size:
+            raise HTTPError(413, "Request body too large")
+        self.received += size
+        self._remaining = size
+        self._state = "data"
+
+    def _take_line(self, data, pos):
+        end = data.find(b"\n", pos)
+        if end == -1:
+            self._line += data[pos:]
+            if len(self._line) > MAX_CHUNK_LINE:
+                raise HTTPError(400, "Chunk size line too long")
+            return None, len(data)
+        line = bytes(self._line + data[pos:end]).rstrip(b"\r")
+        self._line.clear()
+        if len(line) > MAX_CHUNK_LINE:
+            raise HTTPError(400, "Chunk size line too long")
+        return line, end + 1
+
+    def _finish(self, data, end):
+        self.done = True
+        self.leftover = bytes(data[end:])
+        self.consumed -= len(self.leftover)
@@ -0,0 +1,176 @@
+import os
+import signal
+import time
+
+from . import server as engine
+from .handoff import spawn_successor
+
+logger = engine.logger
+
+# Workers get the engine's GRACEFUL_TIMEOUT to drain, plus this, before they
+# are killed.
+KILL_GRACE = 5
+RESPAWN_BACKOFF = 1
+REAP_INTERVAL = 0.2
+
+
+def run_worker(sock, tls_sock, args):
+    """Body of a forked worker: serve from the socket until told to stop.
+
+    SIGTERM is turned into KeyboardInterrupt so both engines take their
+    normal shutdown path: stop accepting, then let in-flight requests finish.
+    SIGINT is left to the master, which passes Ctrl-C on as that SIGTERM; a
+    second signal would cut the drain short.
+    """
+    signal.signal(signal.SIGTERM, engine.raise_interrupt)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    # Pick up route and file edits on every (re)spawn. Afterwards each worker
+    # watches for changes itself, and a SIGHUP sent to one reloads it in place.
+    engine.load_site(args.directory or engine.ROOT_PATH)
+
+    if args.reuseport:
+        if not args.tls_only:
+            sock = engine.create_listener(args.host, args.port, reuseport=True)
+        if engine.tls_context is not None:
+            tls_sock = engine.create_listener(
+                args.host, args.tls_port, reuseport=True
+            )
+
+    if args.engine == "asyncio":
+        from .async_engine import serve_asyncio
+
+        serve_asyncio(sock, args.directory, tls_sock)
+    else:
+        engine.serve_threaded(sock, args.directory, tls_sock)
+
+
+class Master:
+    """Pre-fork process manager.
+
+    Keeps ``workers`` children serving the same port, either all accepting on
+    one inherited listening socket or, with ``reuseport``, each binding its
+    own socket with SO_REUSEPORT so the kernel balances between them.
+
+    SIGTERM/SIGINT stop the workers gracefully. SIGHUP starts a fresh
+    generation of workers and then retires the old one, so the port is never
+    left without an acceptor. SIGUSR2 starts a whole new server from the code
+    on disk, handing it the listening sockets; it stops this one once it is up.
+    """
+
+    def __init__(self, args, sock=None, tls_sock=None):
+        self.args = args
+        self.sock = sock
+        self.tls_sock = tls_sock
+        self.workers = {}
+        self.retiring = set()
+        self.stopping = False
+        self.reload_requested = False
+        self.handoff_requested = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.sock, self.tls_sock, self.args)
+            except Exception as e:
+                logger.error(f"Worker {os.getpid()} crashed: {e}")
+                status = 1
+            finally:
+                os._exit(status)
+        self.workers[pid] = time.monotonic()
+        logger.info(f"Started worker {pid}")
+        return pid
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def handle_handoff(self, signum, frame):
+        self.handoff_requested = True
+
+    def reload(self):
+        self.reload_requested = False
+        old = set(self.workers) - self.retiring
+        logger.info(f"Reloading {len(old)} workers")
+        for _ in range(self.args.workers):
+            self.spawn()
+        for pid in old:
+            self.retiring.add(pid)
+            self.signal_worker(pid, signal.SIGTERM)
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                # The server spawned to take over from this one.
+                logger.error(
+                    f"New server {pid} exited with status {os.waitstatus_to_exitcode(status)}, still serving"
+                )
+                continue
+            started = self.workers.pop(pid)
+            if pid in self.retiring or self.stopping:
+                self.retiring.discard(pid)
+                continue
+            logger.warning(
+                f"Worker {pid} exited unexpectedly with status {os.waitstatus_to_exitcode(status)}, restarting"
+            )
+            if time.monotonic() - started < RESPAWN_BACKOFF:
+                time.sleep(RESPAWN_BACKOFF)
+            self.spawn()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGUSR2, self.handle_handoff)
+
+        for _ in range(self.args.workers):
+            self.spawn()
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload()
+            if self.handoff_requested:
+                self.handoff_requested = False
+                spawn_successor(
+                    [s for s in (self.sock, self.tls_sock) if s is not None]
+                )
+            self.reap()
+            time.sleep(REAP_INTERVAL)
+
+        self.shutdown()
+
+    def shutdown(self):
+        logger.info(f"Stopping {len(self.workers)} workers")
+        for pid in self.workers:
+            self.signal_worker(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + engine.GRACEFUL_TIMEOUT + KILL_GRACE
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(REAP_INTERVAL)
+
+        for pid in self.workers:
+            logger.warning(f"Worker {pid} did not exit in time, killing it")
+            self.signal_worker(pid, signal.SIGKILL)
+        for sock in (self.sock, self.tls_sock):
+            if sock is not None:
+                sock.close()
+        logger.info("Server terminated")
@@ -0,0 +1,479 @@
+import itertools
+import os
+import select
+import socket
+import threading
+import time
+import urllib.parse
+import weakref
+
+from .error_pages import error_page
+from .metrics import metrics
+from .parser import parse_chunk_size
+from .response import LAST_CHUNK, BodyError, Response, encode_chunk
+from .utils import logger
+
+BALANCERS = ("round_robin", "least_conn")
+# Idle keep-alive connections kept per backend, and how long one may sit idle
+# before it is closed rather than reused.
+POOL_SIZE = 32
+POOL_IDLE_TIMEOUT = 30
+UPSTREAM_TIMEOUT = 10
+HEALTH_INTERVAL = 5
+HEALTH_TIMEOUT = 2
+READ_CHUNK = 64 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+# Connection-specific headers, never forwarded in either direction.
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+# Also dropped from upstream responses: Response adds its own framing.
+FRAMING_HEADERS = HOP_BY_HOP_HEADERS | {"content-length"}
+# Only these are sent again when a reused connection fails (RFC 9110, 9.2.2).
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"}
+
+# Every live Upstream, for the health checker and the metrics. Reloading the
+# routes drops the old ones.
+_upstreams = weakref.WeakSet()
+_checker_pid = None
+_checker_lock = threading.Lock()
+
+
+class Backend:
+    """One upstream server and its pool of idle keep-alive connections."""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError(f"Upstream {url!r} must be an http:// URL")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.name = f"{self.host}:{self.port}"
+        self.healthy = True
+        self.active = 0
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return ``(sock, reused)``: a pooled connection if one is usable."""
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                sock, since = self.idle.pop()
+            # A readable idle connection has been closed by the backend.
+            if now - since < POOL_IDLE_TIMEOUT and not _readable(sock):
+                return sock, True
+            sock.close()
+        sock = socket.create_connection((self.host, self.port), UPSTREAM_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, False
+
+    def release(self, sock):
+        with self.lock:
+            if len(self.idle) < POOL_SIZE:
+                self.idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def set_health(self, healthy):
+        if healthy != self.healthy:
+            state = "up" if healthy else "down"
+            logger.warning(f"Upstream backend {self.name} is {state}")
+        self.healthy = healthy
+
+
+class Upstream:
+    """Route target that forwards requests to a group of HTTP/1.1 backends.
+
+    ``balance`` is ``round_robin`` or ``least_conn``. Unhealthy backends are
+    skipped until a health check passes again; a check is a GET of
+    ``health_path`` every ``health_interval`` seconds, failing on a 5xx or
+    no answer. If every backend is down they are all tried anyway.
+
+    A request body the engine streams (``"body_chunks"``) is copied to the
+    backend as it arrives, chunked if the client sent it chunked. The
+    response body is streamed back as it arrives, and the connection goes
+    back to the backend's pool once the whole response has been read.
+    """
+
+    def __init__(
+        self,
+        *urls,
+        balance="round_robin",
+        health_path="/",
+        health_interval=HEALTH_INTERVAL,
+    ):
+        if not urls:
+            raise ValueError("Upstream needs at least one backend URL")
+        if balance not in BALANCERS:
+            raise ValueError(f"Unknown balance {balance!r}, use one of {BALANCERS}")
+        self.backends = [Backend(url) for url in urls]
+        self.balance = balance
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self._turn = itertools.count()
+        self.lock = threading.Lock()
+        _upstreams.add(self)
+
+    def pick(self):
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        with self.lock:
+            if self.balance == "least_conn":
+                start = next(self._turn)
+                # Rotate first so ties don't always land on the same backend.
+                split = start % len(candidates)
+                candidates = candidates[split:] + candidates[:split]
+                backend = min(candidates, key=lambda b: b.active)
+            else:
+                backend = candidates[next(self._turn) % len(candidates)]
+            backend.active += 1
+        return backend
+
+    def done(self, backend):
+        with self.lock:
+            backend.active -= 1
+
+    def forward(self, request_data, client_address):
+        """Send the request to a backend and return its response.
+
+        Answers 502 when no backend can be reached or it sends garbage, and
+        504 when it does not answer in time. An error reading a streamed body
+        from the client (HTTPError, ConnectionError) is raised for the engine.
+        """
+        chunks = request_data.get("body_chunks")
+        if chunks is not None:
+            # Read the start of the body before picking a backend, so one
+            # malformed from the outset is refused without reaching it.
+            first = next(chunks, None)
+            chunks = iter(()) if first is None else itertools.chain((first,), chunks)
+        _start_health_checks()
+        backend = self.pick()
+        method = request_data["headers"].get("method")
+        if chunks is None:
+            body = request_data["body"]
+            request = _request_head(request_data, client_address, len(body)) + body
+        else:
+            stream = request_data["body_stream"]
+            length = None if stream.chunked else stream.content_length
+            request = _request_head(request_data, client_address, length)
+        # A pooled connection may have been closed by the backend just as it
+        # was reused, so one failed attempt on a reused connection is retried
+        # on a fresh one, if the request can safely be sent twice. A backend
+        # that refuses the connection never saw the request, so it goes to
+        # the next healthy backend instead.
+        replayable = chunks is None and method in IDEMPOTENT_METHODS
+        retried = False
+        refused = 0
+        while True:
+            try:
+                sock, reused = backend.acquire()
+            except OSError as e:
+                backend.set_health(False)
+                refused += 1
+                if refused >= len(self.backends) or not any(
+                    b.healthy for b in self.backends
+                ):
+                    return self._fail(backend, 502, f"connect failed: {e}")
+                logger.error(f"Upstream {backend.name}: connect failed: {e}")
+                self.done(backend)
+                backend = self.pick()
+                continue
+            reader = _Reader(sock)
+            try:
+                sock.sendall(request)
+                if chunks is not None:
+                    _send_body(sock, chunks, length is None)
+                status, headers = reader.read_head()
+                while 100 <= status < 200:
+                    status, headers = reader.read_head()
+                break
+            except _ClientBodyError as e:
+                # The client's fault, for the engine to answer.
+                sock.close()
+                self.done(backend)
+                raise e.__cause__
+            except socket.timeout:
+                sock.close()
+                return self._fail(backend, 504, "timed out")
+            except (OSError, ValueError) as e:
+                sock.close()
+                if replayable and reused and not retried and not reader.received:
+                    retried = True
+                    continue
+                return self._fail(backend, 502, str(e))
+
+        response = Response(status)
+        response.headers = {}
+        # HTTP/1.0 backends close after every response unless told otherwise.
+        connection = {"close"} if reader.version == "HTTP/1.0" else set()
+        for name, value in headers:
+            lower = name.lower()
+            if lower == "connection":
+                connection.update(t.strip().lower() for t in value.split(","))
+                if "keep-alive" in connection:
+                    connection.discard("close")
+            if lower not in FRAMING_HEADERS:
+                response.headers[name] = value
+        fields = {name.lower(): value for name, value in headers}
+        lengths = {
+            v.strip()
+            for name, value in headers
+            if name.lower() == "content-length"
+            for v in value.split(",")
+        }
+
+        chunked = "chunked" in fields.get("transfer-encoding", "").lower()
+        length = None
+        if not chunked and lengths:
+            if len(lengths) != 1 or not next(iter(lengths)).isdigit():
+                sock.close()
+                return self._fail(backend, 502, "invalid Content-Length")
+            length = int(lengths.pop())
+        if length is not None and status not in (204, 304):
+            # For HEAD, the length the body would have had.
+            response.headers["Content-Length"] = length
+        if method == "HEAD" or status in (204, 304):
+            length = 0
+            chunked = False
+        metrics.inc(
+            "upstream_requests_total", (("backend", backend.name), ("status", status))
+        )
+        reusable = "close" not in connection and (chunked or length is not None)
+        if length == 0:
+            if reusable:
+                backend.release(sock)
+            else:
+                sock.close()
+            self.done(backend)
+            return response
+        # Without a length the body is re-framed for the client, see
+        # server.delimit_stream.
+        response.stream = self._relay(backend, sock, reader, length, chunked, reusable)
+        response.stream_blocks = True
+        return response
+
+    def _relay(self, backend, sock, reader, length, chunked, reusable):
+        finished = False
+        try:
+            if chunked:
+                yield from reader.read_chunked()
+            else:
+                yield from reader.read_body(length)
+            finished = True
+        except (OSError, ValueError) as e:
+            raise BodyError(f"Upstream {backend.name} failed mid-response: {e}")
+        finally:
+            if finished and reusable:
+                backend.release(sock)
+            else:
+                sock.close()
+            self.done(backend)
+
+    def _fail(self, backend, status, reason):
+        self.done(backend)
+        logger.error(f"Upstream {backend.name}: {reason}")
+        metrics.inc(
+            "upstream_requests_total", (("backend", backend.name), ("status", "error"))
+        )
+        return Response(status, error_page(status), "text/html")
+
+
+def upstream(*urls, **options):
+    """Route target proxying to ``urls``, e.g. ``route("/api/*", upstream(...))``."""
+    return Upstream(*urls, **options)
+
+
+class _Reader:
+    """Buffered reads of an upstream HTTP/1.1 response."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.received = 0
+        self.version = None
+
+    def _fill(self):
+        data = self.sock.recv(READ_CHUNK)
+        if not data:
+            raise ConnectionError("upstream closed the connection")
+        self.received += len(data)
+        self.buffer += data
+
+    def read_head(self):
+        while True:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end != -1:
+                break
+            if len(self.buffer) > MAX_HEAD_SIZE:
+                raise ValueError("response head too large")
+            self._fill()
+        lines = bytes(self.buffer[:end]).decode("latin-1").split("\r\n")
+        del self.buffer[: end + 4]
+        parts = lines[0].split(" ", 2)
+        if (
+            len(parts) < 2
+            or not parts[0].startswith("HTTP/")
+            or not parts[1].isdigit()
+        ):
+            raise ValueError(f"malformed status line {lines[0]!r}")
+        self.version = parts[0]
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers.append((name.strip(), value.strip()))
+        return int(parts[1]), headers
+
+    def read_body(self, length):
+        """Yield ``length`` bytes of body, or everything up to EOF if None."""
+        remaining = length
+        while remaining is None or remaining > 0:
+            if not self.buffer:
+                try:
+                    self._fill()
+                except ConnectionError:
+                    if remaining is None:
+                        return
+                    raise
+            data = bytes(self.buffer[:remaining] if remaining else self.buffer)
+            del self.buffer[: len(data)]
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def read_chunked(self):
+        """Yield the decoded data of a chunked body, skipping any trailers."""
+        while True:
+            size_line = self._read_line()
+            size = parse_chunk_size(size_line)
+            if size is None:
+                raise ValueError(f"invalid chunk size {size_line!r}")
+            if size == 0:
+                while self._read_line():
+                    pass
+                return
+            yield from self.read_body(size)
+            if self._read_line():
+                raise ValueError("malformed chunk")
+
+    def _read_line(self):
+        while True:
+            end = self.buffer.find(b"\r\n")
+            if end != -1:
+                line = bytes(self.buffer[:end])
+                del self.buffer[: end + 2]
+                return line
+            if len(self.buffer) > MAX_HEAD_SIZE:
+                raise ValueError("chunk line too long")
+            self._fill()
+
+
+class _ClientBodyError(Exception):
+    """Reading the request body from the client failed, see ``__cause__``."""
+
+
+def _send_body(sock, chunks, chunked):
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except Exception as e:
+            raise _ClientBodyError() from e
+        sock.sendall(encode_chunk(chunk) if chunked else chunk)
+    if chunked:
+        sock.sendall(LAST_CHUNK)
+
+
+def _request_head(request_data, client_address, length):
+    """The request head for the backend; a ``length`` of None sends it chunked."""
+    req_headers = request_data["headers"]
+    metadata = req_headers.get("metadata", {})
+    target = req_headers.get("path")
+    if req_headers.get("query"):
+        target += "?" + req_headers["query"]
+    dropped = HOP_BY_HOP_HEADERS | {"content-length", "expect", "x-forwarded-for"}
+    dropped.update(t.strip().lower() for t in metadata.get("connection", "").split(","))
+    method = req_headers.get("method")
+    lines = [f"{method} {target} HTTP/1.1"]
+    for name, value in metadata.items():
+        if name not in dropped:
+            lines.append(f"{name}: {value}")
+    forwarded_for = client_address[0]
+    if "x-forwarded-for" in metadata:
+        forwarded_for = f"{metadata['x-forwarded-for']}, {forwarded_for}"
+    lines.append(f"x-forwarded-for: {forwarded_for}")
+    if length is None:
+        lines.append("transfer-encoding: chunked")
+    elif length or method in ("POST", "PUT", "PATCH"):
+        lines.append(f"content-length: {length}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def _readable(sock):
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+def _start_health_checks():
+    """Start this process's health check thread, once per process."""
+    global _checker_pid
+    if _checker_pid == os.getpid():
+        return
+    with _checker_lock:
+        if _checker_pid == os.getpid():
+            return
+        _checker_pid = os.getpid()
+        threading.Thread(
+            target=_check_forever, name="upstream-health", daemon=True
+        ).start()
+
+
+def _check_forever():
+    while True:
+        upstreams = list(_upstreams)
+        for group in upstreams:
+            for backend in group.backends:
+                backend.set_health(_probe(backend, group.health_path))
+        time.sleep(
+            min((u.health_interval for u in upstreams), default=HEALTH_INTERVAL)
+        )
+
+
+def _probe(backend, path):
+    try:
+        with socket.create_connection(
+            (backend.host, backend.port), HEALTH_TIMEOUT
+        ) as sock:
+            sock.sendall(
+                f"GET {path} HTTP/1.1\r\nHost: {backend.name}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+            )
+            status, _ = _Reader(sock).read_head()
+    except (OSError, ValueError):
+        return False
+    return status < 500
+
+
+metrics.add_collector(
+    "upstream_backend_healthy",
+    "gauge",
+    "Whether each upstream backend passed its last health check.",
+    lambda: {
+        (("backend", backend.name),): int(backend.healthy)
+        for group in list(_upstreams)
+        for backend in group.backends
+    },
+)
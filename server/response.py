@@ -0,0 +1,201 @@
+import os
+import uuid
+
+from .utils import STATUS_TEXTS, get_status_texts, get_validator_headers
+
+# Status lines for every known status code, encoded once.
+STATUS_LINES = {
+    code: f"HTTP/1.1 {code} {text}\r\n".encode("latin-1")
+    for code, text in STATUS_TEXTS.items()
+}
+CONNECTION_LINES = {
+    True: b"Connection: keep-alive\r\n\r\n",
+    False: b"Connection: close\r\n\r\n",
+}
+# Encoded header blocks keyed by status code and header items. Error pages and
+# cached files go out with identical headers request after request, so their
+# heads are formatted once and then only looked up.
+HEAD_CACHE_SIZE = 4096
+_head_cache = {}
+# Ends a body sent with chunked transfer-encoding.
+LAST_CHUNK = b"0\r\n\r\n"
+# Interim response asking a client that sent Expect: 100-continue for the body.
+CONTINUE = STATUS_LINES[100] + b"\r\n"
+
+
+class BodyError(Exception):
+    """A streamed body failed part way; the client can't get the rest of it."""
+
+
+class Response:
+    """An HTTP response built by a request handler and written by the engine.
+
+    Handlers no longer write to the socket themselves, so the connection loop
+    can decide on keep-alive and add the ``Connection`` header in one place.
+    """
+
+    def __init__(
+        self,
+        status_code,
+        body="",
+        content_type="text/plain",
+        headers=None,
+        encoding="utf-8",
+    ):
+        if isinstance(body, str):
+            body = body.encode(encoding)
+        self.status_code = status_code
+        self.body = body
+        # An open binary file streamed after the headers, see file_response.
+        self.file = None
+        self.offset = 0
+        self.count = 0
+        # multipart/byteranges bodies: bytes, or (offset, count) runs of file.
+        self.segments = None
+        # An iterator of byte chunks produced while the response is sent, see
+        # stream_response. It may raise BodyError. The engine adds the bytes it
+        # sends to count. stream_blocks marks iterators that wait on I/O, which
+        # the asyncio engine only advances on a worker thread.
+        self.stream = None
+        self.stream_blocks = False
+        # A MappedFile that body is a view into, released by close().
+        self.mapping = None
+        # Set by the engine when the stream goes out with chunked framing.
+        self.chunked = False
+        # Metrics label naming what served the request, and what the engine wrote.
+        self.route = None
+        self.bytes_sent = 0
+        self.headers = {
+            "Content-Length": len(body),
+            "Content-Type": content_type,
+        }
+        if headers:
+            self.headers.update(headers)
+
+    def body_length(self):
+        if self.segments is not None:
+            return sum(s[1] if isinstance(s, tuple) else len(s) for s in self.segments)
+        # count outlives close(), so the length is still known once sent.
+        return self.count or len(self.body)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.stream is not None:
+            close = getattr(self.stream, "close", None)
+            if close is not None:
+                close()
+            self.stream = None
+        if self.mapping is not None:
+            self.mapping.release()
+            self.mapping = None
+
+    @property
+    def status_message(self):
+        return get_status_texts(self.status_code)
+
+    def head(self, keep_alive=True):
+        """Serialize the status line and headers to bytes."""
+        key = (self.status_code, tuple(self.headers.items()))
+        block = _head_cache.get(key)
+        if block is None:
+            lines = "".join(f"{name}: {value}\r\n" for name, value in key[1])
+            block = STATUS_LINES[self.status_code] + lines.encode("latin-1")
+            # Partial responses carry per-request ranges and boundaries.
+            if self.status_code != 206:
+                if len(_head_cache) >= HEAD_CACHE_SIZE:
+                    _head_cache.clear()
+                _head_cache[key] = block
+        return block + CONNECTION_LINES[keep_alive]
+
+
+def file_response(path, content_type, status_code=200, headers=None):
+    """Build a response whose body is streamed straight from ``path``.
+
+    The file is only opened and measured here, never read, so the engine can
+    hand it to sendfile after writing the headers.
+    """
+    file = open(path, "rb")
+    try:
+        st = os.fstat(file.fileno())
+    except OSError:
+        file.close()
+        raise
+    response = Response(status_code, content_type=content_type, headers=headers)
+    response.headers["Content-Length"] = st.st_size
+    response.headers.update(get_validator_headers(st))
+    response.file = file
+    response.count = st.st_size
+    return response
+
+
+def stream_response(chunks, content_type="text/plain", status_code=200, headers=None):
+    """Build a response whose body is produced by iterating ``chunks``.
+
+    The first chunk goes out as soon as it is yielded. Unless ``headers``
+    carries a Content-Length, HTTP/1.1 clients get the body with chunked
+    transfer-encoding and HTTP/1.0 clients get it delimited by closing the
+    connection.
+    """
+    response = Response(status_code, content_type=content_type, headers=headers)
+    if not headers or "Content-Length" not in headers:
+        del response.headers["Content-Length"]
+    response.stream = iter(chunks)
+    return response
+
+
+def encode_chunk(chunk):
+    """Frame one non-empty chunk for chunked transfer-encoding."""
+    return b"%x\r\n%b\r\n" % (len(chunk), chunk)
+
+
+def range_response(response, ranges, size):
+    """Turn a full 200 response into a 206 for the given byte ranges.
+
+    File bodies become offsets into the same open file and in-memory bodies
+    become memoryview slices, so nothing is copied or read up front.
+    """
+    content_type = response.headers["Content-Type"]
+    partial = Response(206)
+    for name in ("ETag", "Last-Modified", "Cache-Control", "Accept-Ranges"):
+        if name in response.headers:
+            partial.headers[name] = response.headers[name]
+    partial.file, response.file = response.file, None
+    partial.mapping, response.mapping = response.mapping, None
+    partial.route = response.route
+    body = memoryview(response.body)
+
+    def piece(start, end):
+        if partial.file is not None:
+            return (response.offset + start, end - start + 1)
+        return body[start : end + 1]
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        partial.headers["Content-Type"] = content_type
+        partial.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        partial.headers["Content-Length"] = end - start + 1
+        if partial.file is not None:
+            partial.offset, partial.count = piece(start, end)
+        else:
+            partial.body = piece(start, end)
+        return partial
+
+    boundary = uuid.uuid4().hex
+    segments = []
+    for start, end in ranges:
+        segments.append(
+            (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode("latin-1")
+        )
+        segments.append(piece(start, end))
+    segments.append(f"\r\n--{boundary}--\r\n".encode("latin-1"))
+
+    partial.segments = segments
+    partial.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    partial.headers["Content-Length"] = partial.body_length()
+    return partial
@@ -0,0 +1,114 @@
+class RouteConflictError(ValueError):
+    pass
+
+
+class _Node:
+    __slots__ = ("children", "param", "param_name", "wildcard", "target")
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_name = None
+        self.wildcard = None
+        self.target = None
+
+
+class Router:
+    """Route table compiled once from ``routes.routes``.
+
+    Plain paths such as ``/about`` live in a dict and are found with a single
+    lookup. Patterns with ``{param}`` segments or a trailing ``*`` go into a
+    tree keyed by path segment, where literal segments win over parameters and
+    parameters win over the wildcard.
+
+    A target is either a file name under the static root or a callable taking
+    ``(request_headers, params)`` and returning a Response.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.root = _Node()
+
+    def add(self, pattern, target):
+        if not pattern.startswith("/"):
+            raise ValueError(f"Route {pattern!r} must start with '/'")
+        segments = _split(pattern)
+        if not any(_is_dynamic(segment) for segment in segments):
+            if pattern in self.exact:
+                raise RouteConflictError(f"Duplicate route {pattern!r}")
+            self.exact[pattern] = (target, pattern)
+            return
+
+        node = self.root
+        for i, segment in enumerate(segments):
+            if segment == "*":
+                if i != len(segments) - 1:
+                    raise ValueError(f"'*' must be the last segment in {pattern!r}")
+                if node.wildcard is not None:
+                    raise RouteConflictError(f"Duplicate route {pattern!r}")
+                node.wildcard = (target, pattern)
+                return
+            if segment.startswith("{") and segment.endswith("}"):
+                name = segment[1:-1]
+                if node.param is None:
+                    node.param = _Node()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise RouteConflictError(
+                        f"Route {pattern!r} names parameter {{{name}}} where another "
+                        f"route uses {{{node.param_name}}}"
+                    )
+                node = node.param
+            else:
+                node = node.children.setdefault(segment, _Node())
+
+        if node.target is not None:
+            raise RouteConflictError(f"Route {pattern!r} conflicts with another route")
+        node.target = (target, pattern)
+
+    def match(self, path):
+        """Return ``(target, params, pattern)`` for ``path``, or None."""
+        found = self.exact.get(path)
+        if found is not None:
+            return found[0], {}, found[1]
+        return _match(self.root, _split(path), 0, {})
+
+
+def _split(path):
+    return [segment for segment in path.split("/") if segment]
+
+
+def _is_dynamic(segment):
+    return segment == "*" or (segment.startswith("{") and segment.endswith("}"))
+
+
+def _match(node, segments, index, params):
+    if index == len(segments):
+        if node.target is not None:
+            return node.target[0], params, node.target[1]
+    else:
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            found = _match(child, segments, index + 1, params)
+            if found is not None:
+                return found
+        if node.param is not None:
+            found = _match(
+                node.param, segments, index + 1, {**params, node.param_name: segment}
+            )
+            if found is not None:
+                return found
+    if node.wildcard is not None and index < len(segments):
+        target, pattern = node.wildcard
+        return target, {**params, "*": "/".join(segments[index:])}, pattern
+    return None
+
+
+def compile_routes(route_list):
+    """Build a Router from ``route_list``, raising on conflicting routes."""
+    router = Router()
+    for route in route_list:
+        for pattern, target in route.items():
+            router.add(pattern, target)
+    return router
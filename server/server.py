@@ -1,27 +1,110 @@
 import socket
+import errno
+import importlib
 import logging
+import select
+import selectors
+import signal
+import ssl
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 import sys
-from routes.routes import routes
+import routes.routes
 import os
+from . import (
+    compression,
+    http2,
+    listing as dir_listing,
+    parser as request_parser,
+    upload,
+)
+from .access_log import access_log
+from .admission import admission, rejection_response
+from .cache import FileCache
+from .drain import Drain
+from .error_pages import error_page, load_error_pages
+from .handoff import inherited_listeners, retire_predecessor, spawn_successor
+from .listing import ListingCache, parse_listing_query, render_listing
+from .metrics import metrics
+from .mmap_pool import MmapPool
+from .proxy import Upstream
+from .compression import (
+    MIN_COMPRESS_SIZE,
+    accepted_codings,
+    compress,
+    find_precompressed,
+    is_compressible,
+    precompress_tree,
+)
+from .response import (
+    CONTINUE,
+    LAST_CHUNK,
+    BodyError,
+    Response,
+    encode_chunk,
+    file_response,
+    range_response,
+    stream_response,
+)
+from .parser import HTTPError, RequestParser, RequestTimeout
+from .router import compile_routes
+from .static_index import StaticIndex
+from .tls import TLSHandshaker, create_tls_context
+from .upload import UPLOAD_CHUNK_SIZE, UPLOAD_METHODS, accept_upload, store_upload
 from .utils import (
+    check_preconditions,
+    if_range_matches,
+    parse_range,
     get_allowed_headers,
-    get_res_content_length,
     get_status_texts,
     commandline_parser,
     get_mime_type,
-    get_req_content_length,
-    is_binary_mime_type,
-    parse_request,
-    create_dirlist_page,
-    create_error_page,
     parse_path,
 )
 
 ROOT_PATH = "./static/"
 MAX_THREADS = 10
-TIMEOUT_VAL = 10
-BYTES_RECV_AMT = 2048
+KEEPALIVE_TIMEOUT = 5
+# Slow client limits. The head of a request must arrive within HEADER_TIMEOUT
+# seconds of its first byte. The body gets BODY_TIMEOUT seconds plus one more
+# per MIN_RECV_RATE bytes received, and a response SEND_TIMEOUT seconds plus
+# one per MIN_SEND_RATE bytes, so large transfers only have to keep moving.
+HEADER_TIMEOUT = 10
+BODY_TIMEOUT = 10
+MIN_RECV_RATE = 1024
+SEND_TIMEOUT = 10
+MIN_SEND_RATE = 1024
+MAX_KEEPALIVE_REQUESTS = 100
+LINGER_TIMEOUT = 1
+# Seconds in-flight requests get to finish once the server is told to stop.
+GRACEFUL_TIMEOUT = 30
+LINGER_MAX_BYTES = 1024 * 1024
+FILE_CHUNK_SIZE = 64 * 1024
+SENDFILE_SLICE = 4 * 1024 * 1024
+# Bodies up to this size are sent in the same write as the headers.
+COALESCE_MAX_BYTES = 16 * 1024
+METRICS_PATH = "/metrics"
+HTTP2 = False
+# Accept PUT and multipart POST uploads into the --sdir directory.
+UPLOADS = False
+# Seconds between checks of routes.py and the served tree for changes; 0 only
+# reloads on SIGHUP.
+RELOAD_INTERVAL = 2
+# Methods counted under their own label; anything else is counted as "other"
+# so a client can't grow the label set without bound.
+METRIC_METHODS = {"GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"}
+
+# Cache-Control sent with static files by extension, unless the route has its
+# own policy in routes.cache_control.
+DEFAULT_CACHE_CONTROL = "no-cache"
+CACHE_CONTROL_BY_EXT = {
+    "css": "public, max-age=86400",
+    "js": "public, max-age=86400",
+    "png": "public, max-age=604800",
+    "svg": "public, max-age=604800",
+    "webp": "public, max-age=604800",
+}
 
 
 logger = logging.getLogger(__name__)
@@ -36,22 +119,375 @@ console_handler.setFormatter(formatter)
 
 logger.addHandler(console_handler)
 
+file_cache = FileCache()
+mmap_pool = MmapPool()
+drain = Drain()
+listing_cache = ListingCache()
+tls_context = None
+_reload_requested = threading.Event()
+_watcher_pid = None
+
+
+def metrics_endpoint(req_headers, params):
+    return Response(200, metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+
+
+def build_router(route_list):
+    """Compile ``route_list``, adding the metrics endpoint when it is enabled."""
+    compiled = compile_routes(route_list)
+    if METRICS_PATH:
+        compiled.add(METRICS_PATH, metrics_endpoint)
+    return compiled
+
+
+class Site:
+    """The routes and static file index that requests are served from.
+
+    A reload builds a whole new Site and swaps it in with one assignment.
+    Each request reads ``site`` once, so requests in flight during a swap
+    finish against the routes and files they started with.
+    """
+
+    def __init__(self, routes_module, static_root, previous=None):
+        if routes_module is not None:
+            self.router = build_router(routes_module.routes)
+            # Optional, so a routes.py written before it existed still loads.
+            self.cache_control = getattr(routes_module, "cache_control", {})
+            self.routes_mtime = _routes_mtime()
+        else:
+            self.router = previous.router
+            self.cache_control = previous.cache_control
+            self.routes_mtime = previous.routes_mtime
+        self.static = StaticIndex(static_root)
+
+    def routes_changed(self):
+        return _routes_mtime() != self.routes_mtime
+
+
+def _routes_mtime():
+    try:
+        return os.stat(routes.routes.__file__).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_site(static_root=ROOT_PATH, reload_routes=True):
+    """Swap in a fresh Site, re-importing routes.py when ``reload_routes``.
+
+    Returns False and keeps serving the current Site if routes.py fails to
+    import or its routes conflict.
+    """
+    global site
+    try:
+        if reload_routes:
+            new_site = Site(importlib.reload(routes.routes), static_root, site)
+        else:
+            new_site = Site(None, static_root, site)
+    except Exception as e:
+        logger.error(f"Reload failed, keeping the current routes and files: {e}")
+        return False
+    site = new_site
+    return True
+
+
+def watch_site():
+    """Reload the Site on SIGHUP or on changes; started once per process."""
+    global _watcher_pid
+    if _watcher_pid == os.getpid():
+        return
+    _watcher_pid = os.getpid()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: _reload_requested.set())
+    threading.Thread(target=_watch_forever, name="site-reload", daemon=True).start()
+
+
+def _watch_forever():
+    # A broken routes.py is reported once, not on every check until it's fixed.
+    failed_mtime = None
+    while True:
+        requested = _reload_requested.wait(RELOAD_INTERVAL or None)
+        _reload_requested.clear()
+        current = site
+        reload_routes = requested or (
+            current.routes_changed() and _routes_mtime() != failed_mtime
+        )
+        if reload_routes or current.static.changed():
+            if load_site(current.static.root, reload_routes):
+                if requested:
+                    # Fresh entries are revalidated anyway; this frees the
+                    # memory held for files that have since been deleted.
+                    file_cache.clear()
+                    mmap_pool.clear()
+                    listing_cache.clear()
+                logger.info(
+                    f"Reloaded {'routes and ' if reload_routes else ''}"
+                    f"{len(site.static)} files under {site.static.root}"
+                )
+            else:
+                failed_mtime = _routes_mtime()
+
+
+site = Site(routes.routes, ROOT_PATH)
+
+metrics.add_collector(
+    "file_cache_requests_total",
+    "counter",
+    "File cache lookups, by result.",
+    lambda: {
+        (("result", "hit"),): file_cache.hits,
+        (("result", "miss"),): file_cache.misses,
+    },
+)
+metrics.add_collector(
+    "mmap_pool_requests_total",
+    "counter",
+    "Memory-mapped file lookups, by result.",
+    lambda: {
+        (("result", "hit"),): mmap_pool.hits,
+        (("result", "miss"),): mmap_pool.misses,
+    },
+)
+metrics.add_collector(
+    "mmap_pool_bytes",
+    "gauge",
+    "Bytes of static files currently memory-mapped.",
+    lambda: {(): mmap_pool.stats()["bytes"]},
+)
+metrics.add_collector(
+    "access_log_dropped_total",
+    "counter",
+    "Access log records dropped because the writer fell behind.",
+    lambda: {(): access_log.dropped},
+)
+metrics.add_collector(
+    "file_cache_entries",
+    "gauge",
+    "Files held in the file cache.",
+    lambda: {(): file_cache.stats()["entries"]},
+)
+metrics.add_collector(
+    "file_cache_bytes",
+    "gauge",
+    "Bytes held in the file cache.",
+    lambda: {(): file_cache.stats()["bytes"]},
+)
+
 
 def start_server():
-    host, port, directory = commandline_parser()
+    args = commandline_parser()
+    if args.tls_only and not args.certfile:
+        logger.error("--tls-only needs --certfile")
+        return
+    if args.http2 and not http2.available():
+        logger.error("--http2 needs the h2 package (pip install h2)")
+        return
+    try:
+        configure(args)
+    except (OSError, ssl.SSLError) as e:
+        logger.error(f"Could not load the TLS certificate: {e}")
+        return
+    sock = tls_sock = None
+    try:
+        inherited = inherited_listeners()
+        if not (args.workers and args.reuseport):
+            if not args.tls_only:
+                sock = inherited.pop(args.port, None) or create_listener(
+                    args.host, args.port
+                )
+            if tls_context is not None:
+                tls_sock = inherited.pop(args.tls_port, None) or create_listener(
+                    args.host, args.tls_port
+                )
+    except (OSError, ValueError) as e:
+        logger.error(e)
+        return
+    for port, unused in inherited.items():
+        logger.warning(f"Closing the inherited listener on port {port}, not in use")
+        unused.close()
+    if not args.tls_only:
+        logger.info(
+            f"Server Listening on {args.host} port {args.port} (http://{args.host}:{args.port}/) using the {args.engine} engine"
+        )
+    if tls_context is not None:
+        logger.info(
+            f"Server Listening on {args.host} port {args.tls_port} (https://{args.host}:{args.tls_port}/) using the {args.engine} engine"
+        )
+    if args.pid_file:
+        write_pid_file(args.pid_file)
+    retire_predecessor()
+    try:
+        if args.workers:
+            from .prefork import Master
+
+            Master(args, sock, tls_sock).run()
+        elif args.engine == "asyncio":
+            from .async_engine import serve_asyncio
+
+            serve_asyncio(sock, args.directory, tls_sock, handoff=True)
+        else:
+            signal.signal(signal.SIGTERM, raise_interrupt)
+            serve_threaded(sock, args.directory, tls_sock, handoff=True)
+    finally:
+        if args.pid_file:
+            remove_pid_file(args.pid_file)
+
+
+def raise_interrupt(signum, frame):
+    """SIGTERM handler: stop the way Ctrl-C does, draining connections."""
+    raise KeyboardInterrupt
+
+
+def write_pid_file(path):
+    try:
+        with open(path, "w") as f:
+            f.write(f"{os.getpid()}\n")
+    except OSError as oe:
+        logger.error(f"Could not write the pid file: {oe}")
+
+
+def remove_pid_file(path):
+    """Remove ``path`` unless a successor has written its own pid there."""
+    try:
+        with open(path) as f:
+            if f.read().strip() == str(os.getpid()):
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def configure(args):
+    """Apply command line options to the module level settings."""
+    global METRICS_PATH, HEADER_TIMEOUT, BODY_TIMEOUT, MIN_RECV_RATE
+    global SEND_TIMEOUT, MIN_SEND_RATE, HTTP2, RELOAD_INTERVAL, UPLOADS, tls_context
+    global GRACEFUL_TIMEOUT
+    file_cache.max_bytes = args.cache_size * 1024 * 1024
+    file_cache.max_entry_bytes = args.cache_max_entry * 1024
+    mmap_pool.max_bytes = args.mmap_pool_size * 1024 * 1024
+    compression.COMPRESSION_LEVEL = args.compression_level
+    request_parser.MAX_HEADER_SIZE = args.max_header_size
+    request_parser.MAX_URI_LENGTH = args.max_uri_length
+    request_parser.MAX_BODY_SIZE = args.max_body_size
+    METRICS_PATH = args.metrics_path
+    HEADER_TIMEOUT = args.header_timeout
+    BODY_TIMEOUT = args.body_timeout
+    MIN_RECV_RATE = args.min_recv_rate
+    SEND_TIMEOUT = args.send_timeout
+    MIN_SEND_RATE = args.min_send_rate
+    admission.max_connections = args.max_connections
+    admission.max_queue = args.max_queue
+    admission.max_per_ip = args.max_conn_per_ip
+    admission.rate = args.rate_limit
+    admission.burst = args.rate_burst
+    admission.retry_after = args.retry_after
+    access_log.path = args.access_log
+    access_log.fmt = args.access_log_format
+    access_log.max_bytes = args.access_log_max_size * 1024 * 1024
+    access_log.rotate_interval = args.access_log_rotate * 3600
+    access_log.backups = args.access_log_backups
+    access_log.sample_rate = args.access_log_sample
+    HTTP2 = args.http2
+    RELOAD_INTERVAL = args.reload_interval
+    GRACEFUL_TIMEOUT = args.graceful_timeout
+    UPLOADS = args.uploads and bool(args.directory)
+    dir_listing.UPLOAD_FORM = UPLOADS
+    upload.MAX_UPLOAD_SIZE = args.max_upload_size * 1024 * 1024
+    upload.UPLOAD_RESERVE = args.upload_reserve * 1024 * 1024
+    if args.certfile:
+        tls_context = create_tls_context(args.certfile, args.keyfile, HTTP2)
+    if args.error_pages:
+        load_error_pages(args.error_pages)
+    if args.precompress:
+        precompress_tree(args.directory or ROOT_PATH)
+    # Last, so the metrics path is routed and precompressed siblings indexed.
+    load_site(args.directory or ROOT_PATH)
+
+
+def create_listener(host, port, reuseport=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind((host, port))
+        sock.listen(1024)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def serve_threaded(sock, directory=None, tls_sock=None, handoff=False):
+    """Accept on the plaintext and/or TLS listener and serve from a thread pool.
+
+    TLS handshakes run on a TLSHandshaker thread before the connection is
+    queued for a worker. KeyboardInterrupt closes the listeners and drains
+    the open connections. With ``handoff``, SIGUSR2 passes the listeners to a
+    new server process.
+    """
+    listeners = [(s, s is tls_sock) for s in (sock, tls_sock) if s is not None]
+    selector = selectors.DefaultSelector()
+    for listener, is_tls in listeners:
+        # Workers may share these sockets, so a ready listener can already be
+        # empty by the time accept() runs.
+        listener.setblocking(False)
+        selector.register(listener, selectors.EVENT_READ, is_tls)
+    drain.open()
+    if handoff:
+        handoff_r, handoff_w = socket.socketpair()
+        handoff_r.setblocking(False)
+        handoff_w.setblocking(False)
+        selector.register(handoff_r, selectors.EVENT_READ, None)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: handoff_w.send(b"\0"))
+
     with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            sock.bind((host, port))
-            sock.listen()
-            logger.info(
-                f"Server Listening on {host} port {port} (http://{host}:{port}/)"
+        metrics.add_collector(
+            "threadpool_queue_depth",
+            "gauge",
+            "Accepted connections waiting for a free worker thread.",
+            lambda: {(): executor._work_queue.qsize()},
+        )
+        handshaker = None
+        if tls_sock is not None:
+            handshaker = TLSHandshaker(
+                tls_context,
+                lambda c_socket, c_address: executor.submit(
+                    handle_request, c_socket, c_address, directory
+                ),
+                lambda c_address: admission.release(c_address[0]),
             )
-
+            handshaker.start()
+        access_log.start()
+        watch_site()
+        try:
             while True:
-                c_socket, c_address = sock.accept()
-                # logger.info(f"Connected to {c_address}")
-                executor.submit(handle_request, c_socket, c_address, directory)
+                for key, _ in selector.select():
+                    if key.data is None:
+                        key.fileobj.recv(64)
+                        spawn_successor([listener for listener, _ in listeners])
+                        continue
+                    try:
+                        c_socket, c_address = key.fileobj.accept()
+                    except BlockingIOError:
+                        continue
+                    refused = admission.admit(
+                        c_address[0], executor._work_queue.qsize()
+                    )
+                    if refused is not None:
+                        if key.data:
+                            # No response is possible before a handshake.
+                            metrics.inc(
+                                "http_rejected_total", (("reason", refused[1]),)
+                            )
+                            c_socket.close()
+                        else:
+                            reject_connection(c_socket, *refused)
+                        continue
+                    c_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    # logger.info(f"Connected to {c_address}")
+                    if key.data:
+                        handshaker.submit(c_socket, c_address)
+                    else:
+                        executor.submit(handle_request, c_socket, c_address, directory)
         except KeyboardInterrupt:
             logger.info("Server terminated by user")
         except OSError as oe:
@@ -60,345 +496,938 @@ def start_server():
         #         print(f"Error: {e}")
         finally:
             logger.info("Connection Closed")
-            sock.close()
+            logger.info(f"File cache stats: {file_cache.stats()}")
+            metrics.remove_collector("threadpool_queue_depth")
+            if handshaker is not None:
+                handshaker.stop()
+            selector.close()
+            for listener, _ in listeners:
+                listener.close()
+            drain_connections(executor)
+    access_log.stop()
+
+
+def drain_connections(executor):
+    """Let open connections finish for up to GRACEFUL_TIMEOUT, then cut the rest.
+
+    Idle keep-alive connections close at once. Another interrupt cuts the
+    remaining ones straight away.
+    """
+    drain.start()
+    queued = executor._work_queue.qsize
+    if len(drain) or queued():
+        logger.info(f"Draining {len(drain) + queued()} connections")
+    try:
+        drain.wait(GRACEFUL_TIMEOUT, queued)
+    except KeyboardInterrupt:
+        pass
+    cut = drain.cut()
+    if cut:
+        logger.warning(f"Closed {cut} connections that were still open")
+    # Connections still queued are closed without a response.
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def wait_for_request(client_socket):
+    """Wait for the next keep-alive request; False once the server is draining.
+
+    Raises socket.timeout after KEEPALIVE_TIMEOUT.
+    """
+    if isinstance(client_socket, ssl.SSLSocket) and client_socket.pending():
+        return True
+    return drain.wait_readable(client_socket, KEEPALIVE_TIMEOUT)
+
+
+def reject_connection(client_socket, status, reason, retry_after):
+    """Answer an over-limit connection from the accept loop without blocking it."""
+    metrics.inc("http_rejected_total", (("reason", reason),))
+    with client_socket:
+        client_socket.setblocking(False)
+        try:
+            # Read what the client already sent, so closing doesn't reset the
+            # connection before the reply is read.
+            client_socket.recv(64 * 1024)
+        except OSError:
+            pass
+        try:
+            client_socket.send(admission.rejection(status, retry_after))
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
 
 
 def send_http_response(
-    client_socket,
-    client_address,
-    response_body,
-    status_code,
-    status_message,
-    content_len,
-    content_type="text/plain",
-    encoding="utf-8",
+    client_socket, client_address, response, keep_alive=True, head_only=False
 ):
     try:
-        if is_binary_mime_type(content_type):
-            response_header = f"HTTP/1.1 {status_code} {status_message}\r\nContent-Length: {content_len}\r\nContent-Type: {content_type}\r\n\r\n"
-            client_socket.sendall(response_header.encode(encoding))
-            client_socket.sendall(response_body)
+        head = response.head(keep_alive)
+        response.bytes_sent = len(head) + (0 if head_only else response.body_length())
+        deadline = send_deadline(response.bytes_sent)
+        if head_only:
+            send_bytes(client_socket, head, deadline)
+        elif response.segments is not None:
+            send_bytes(client_socket, head, deadline)
+            for segment in response.segments:
+                if isinstance(segment, tuple):
+                    send_file_body(client_socket, response.file, *segment, deadline)
+                else:
+                    send_bytes(client_socket, segment, deadline)
+        elif response.file is not None:
+            send_bytes(client_socket, head, deadline)
+            send_file_body(
+                client_socket, response.file, response.offset, response.count, deadline
+            )
+        elif response.stream is not None:
+            send_bytes(client_socket, head, deadline)
+            # Time spent waiting for the next chunk isn't the client's fault,
+            # so each chunk gets its own deadline.
+            for chunk in response.stream:
+                if not chunk:
+                    continue
+                response.count += len(chunk)
+                if response.chunked:
+                    chunk = encode_chunk(chunk)
+                send_bytes(client_socket, chunk, send_deadline(len(chunk)))
+                response.bytes_sent += len(chunk)
+            if response.chunked:
+                send_bytes(client_socket, LAST_CHUNK, send_deadline(len(LAST_CHUNK)))
+                response.bytes_sent += len(LAST_CHUNK)
+        elif len(response.body) <= COALESCE_MAX_BYTES:
+            send_bytes(client_socket, head + response.body, deadline)
         else:
-            response = f"HTTP/1.1 {status_code} {status_message}\r\nContent-Length: {content_len}\r\nContent-Type: {content_type}\r\n\r\n{response_body}"
-            client_socket.sendall(response.encode(encoding))
+            send_bytes(client_socket, head, deadline)
+            send_bytes(client_socket, response.body, deadline)
+        return True
+
+    except socket.timeout:
+        count_cut("send_timeout")
+        logger.info(f"Send timeout for client {client_address[0]}")
+        return False
+
+    except BodyError as body_error:
+        logger.error(f"Response to {client_address[0]} cut short: {body_error}")
+        return False
 
     except BrokenPipeError as pipe_error:
         alt_message = f"Connection has been Terminated with client {client_address}"
         if hasattr(pipe_error, "args") and pipe_error.args:
             alt_message += f"\nAdditional Details: {', '.join(str(args) for args in pipe_error.args)}"
         logger.warning(alt_message)
+        return False
+    except ConnectionError:
+        raise
+    except Exception:
+        logger.exception(f"Response to {client_address[0]} failed")
+        return False
+    finally:
+        response.close()
 
 
-def handle_unsupported_request(client_socket):
-    err_page = create_error_page(501)
-    send_http_response(
-        client_socket,
-        err_page,
-        501,
-        get_status_texts(501),
-        get_res_content_length(err_page),
-        "text/html",
-    )
+def delimit_stream(response, req_headers):
+    """Decide how a streamed body without a Content-Length ends.
+
+    HTTP/1.1 clients get it with chunked transfer-encoding, so the connection
+    stays open afterwards. Returns False when only closing the connection can
+    end the body, as for HTTP/1.0 clients.
+    """
+    if response.stream is None or "Content-Length" in response.headers:
+        return True
+    if req_headers.get("http_version") == "HTTP/1.1":
+        response.headers["Transfer-Encoding"] = "chunked"
+        response.chunked = True
+        return True
+    return False
+
+
+def send_deadline(nbytes):
+    """When sending ``nbytes`` must be finished by, at MIN_SEND_RATE."""
+    if not MIN_SEND_RATE:
+        return float("inf")
+    return time.monotonic() + SEND_TIMEOUT + nbytes / MIN_SEND_RATE
+
+
+def arm_send_timeout(client_socket, deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("send deadline passed")
+    client_socket.settimeout(min(SEND_TIMEOUT, remaining))
+
+
+def send_bytes(client_socket, data, deadline):
+    """sendall() in slices, giving up when the client stops keeping up.
+
+    A sendall() timeout covers the whole call, so the data goes out in slices
+    the client must take at no less than MIN_SEND_RATE.
+    """
+    if MIN_SEND_RATE:
+        step = max(int(MIN_SEND_RATE * SEND_TIMEOUT), 4096)
+    else:
+        step = max(len(data), 1)
+    view = memoryview(data)
+    for start in range(0, len(view), step):
+        arm_send_timeout(client_socket, deadline)
+        client_socket.sendall(view[start : start + step])
+
+
+def send_file_body(client_socket, file, offset, count, deadline):
+    """Stream part of a file to the client without loading it into memory.
+
+    Uses the zero-copy os.sendfile path where the platform has it, otherwise
+    falls back to reading FILE_CHUNK_SIZE blocks.
+    """
+    if hasattr(os, "sendfile"):
+        # sendfile() times out only when a single write makes no progress, so
+        # the overall deadline is checked between slices.
+        while count > 0:
+            arm_send_timeout(client_socket, deadline)
+            sent = client_socket.sendfile(file, offset, min(count, SENDFILE_SLICE))
+            if not sent:
+                break
+            offset += sent
+            count -= sent
+        return
+
+    file.seek(offset)
+    while count > 0:
+        chunk = file.read(min(count, FILE_CHUNK_SIZE))
+        if not chunk:
+            break
+        send_bytes(client_socket, chunk, deadline)
+        count -= len(chunk)
+
+
+def handle_unsupported_request():
+    return error_response(501)
+
+
+def is_keep_alive(req_headers):
+    """Apply the HTTP/1.0 and HTTP/1.1 defaults to the Connection header."""
+    connection = req_headers.get("metadata", {}).get("connection", "").lower()
+    tokens = [token.strip() for token in connection.split(",")]
+    if "close" in tokens:
+        return False
+    if req_headers.get("http_version") == "HTTP/1.1":
+        return True
+    return "keep-alive" in tokens
+
+
+class RequestClock:
+    """Deadlines for the request being read, by phase.
+
+    The head phase starts with the request's first byte and the body phase
+    once the head is complete. Before either the connection is idle and only
+    KEEPALIVE_TIMEOUT applies.
+    """
+
+    __slots__ = ("header_started", "body_started")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.header_started = None
+        self.body_started = None
+
+    def remaining(self, parser):
+        """Return ``(phase, seconds_left)``, or ``(None, None)`` while idle."""
+        received = parser.body_received()
+        if received is not None:
+            return "body", self.body_remaining(received)
+        if not parser.has_data():
+            return None, None
+        now = time.monotonic()
+        if self.header_started is None:
+            self.header_started = now
+        return "header", self.header_started + HEADER_TIMEOUT - now
+
+    def body_remaining(self, received):
+        """Seconds left to receive the rest of a body, ``received`` bytes in."""
+        now = time.monotonic()
+        if self.body_started is None:
+            self.body_started = now
+        if not MIN_RECV_RATE:
+            # No overall deadline, only BODY_TIMEOUT between reads.
+            return BODY_TIMEOUT
+        return self.body_started + BODY_TIMEOUT + received / MIN_RECV_RATE - now
+
+
+def read_request(client_socket, parser, clock):
+    """Read one request off the socket.
+
+    Bytes past the end of the request stay in the parser, so pipelined
+    requests are handled in order on the next call. Returns None when the
+    client closed the connection, and raises RequestTimeout when the request
+    misses its deadline.
+    """
+    request_data = parser.next_request()
+    while request_data is None:
+        if parser.expects_continue():
+            client_socket.sendall(CONTINUE)
+        phase, remaining = clock.remaining(parser)
+        if phase is not None:
+            if remaining <= 0:
+                raise RequestTimeout(phase)
+            client_socket.settimeout(remaining)
+        try:
+            count = parser.recv_into(client_socket)
+        except socket.timeout:
+            if phase is None:
+                raise
+            raise RequestTimeout(phase)
+        if count == 0:
+            return None
+        request_data = parser.next_request()
+    clock.reset()
+    return request_data
+
+
+def lingering_close(client_socket):
+    """Drain what the client is still sending before closing.
+
+    Closing with unread data makes the kernel send a reset, which can destroy
+    an error response the client has not read yet.
+    """
+    try:
+        client_socket.shutdown(socket.SHUT_WR)
+        client_socket.settimeout(LINGER_TIMEOUT)
+        drained = 0
+        while drained < LINGER_MAX_BYTES:
+            data = client_socket.recv(64 * 1024)
+            if not data:
+                break
+            drained += len(data)
+    except OSError:
+        pass
+
+
+def receive_upload(client_socket, client_address, request_data, clock):
+    """Stream a PUT or multipart POST body to disk as it arrives.
+
+    The upload is checked before any of the body is read, and only then is a
+    waiting client sent 100 Continue. Returns ``(response, complete)``;
+    ``complete`` is False when the body was not read to its end, so the
+    connection can't carry another request.
+    """
+    response = rate_limited(client_address)
+    if response is not None:
+        return response, False
+    body = request_data["body_stream"]
+    destination, response = accept_upload(request_data["headers"], site.static)
+    if response is not None:
+        return response, False
+    try:
+        for chunk in read_body(client_socket, request_data, clock):
+            destination.write(chunk)
+        return destination.finish(), True
+    except HTTPError as err:
+        destination.abort()
+        logger.error(
+            f"{client_address[0]} {err.status_code} {get_status_texts(err.status_code)}, message: {err}"
+        )
+        if isinstance(err, RequestTimeout):
+            count_cut(err.reason)
+        return error_response(err.status_code), False
+    except ConnectionError:
+        destination.abort()
+        raise
+    except OSError as oe:
+        destination.abort()
+        logger.error(f"Upload from {client_address[0]} failed: {oe}")
+        return error_response(507 if oe.errno == errno.ENOSPC else 500), False
+    finally:
+        request_data["size"] += body.consumed
+
+
+def read_body(client_socket, request_data, clock):
+    """Yield the pieces of a streamed request body as they arrive.
+
+    A waiting client is sent 100 Continue first. Raises RequestTimeout when
+    the body misses its deadline and ConnectionResetError if the client
+    closes before its end.
+    """
+    body = request_data["body_stream"]
+    if request_data["expect_continue"]:
+        client_socket.sendall(CONTINUE)
+    data = body.buffered
+    while True:
+        if data:
+            chunk = body.feed(data)
+            if chunk:
+                yield chunk
+        if body.done:
+            return
+        remaining = clock.body_remaining(body.consumed)
+        if remaining <= 0:
+            raise RequestTimeout("body")
+        client_socket.settimeout(remaining)
+        try:
+            data = client_socket.recv(UPLOAD_CHUNK_SIZE)
+        except socket.timeout:
+            raise RequestTimeout("body")
+        if not data:
+            raise ConnectionResetError("Connection closed during the request body")
+
+
+def forward_body(client_socket, client_address, request_data, clock):
+    """Dispatch a proxied request, copying its body upstream as it arrives.
+
+    Returns ``(response, complete)`` as receive_upload does.
+    """
+    body = request_data["body_stream"]
+    request_data["body_chunks"] = read_body(client_socket, request_data, clock)
+    try:
+        response = dispatch_request(request_data, client_address)
+    except HTTPError as err:
+        logger.error(
+            f"{client_address[0]} {err.status_code} {get_status_texts(err.status_code)}, message: {err}"
+        )
+        if isinstance(err, RequestTimeout):
+            count_cut(err.reason)
+        return error_response(err.status_code), False
+    finally:
+        request_data["size"] += body.consumed
+    return response, body.done
+
+
+def body_limit(req_headers):
+    """The size limit for a request whose body is streamed, else None.
+
+    Proxied bodies are copied to the backend and uploads written to disk as
+    they arrive; every other body is buffered.
+    """
+    if proxy_target(req_headers["path"]) is not None:
+        return request_parser.MAX_BODY_SIZE
+    if UPLOADS and req_headers["method"] in UPLOAD_METHODS:
+        return upload.MAX_UPLOAD_SIZE
+    return None
 
 
 def handle_request(client_socket: socket.socket, client_address, directory=None):
-    buffer = b""
-    client_socket.settimeout(TIMEOUT_VAL)
+    parser = RequestParser(stream_body=body_limit)
+    clock = RequestClock()
+    served = 0
+    metrics.add("http_active_connections", 1)
+    drain.add(client_socket)
     try:
-        body_buffer = None
         with client_socket:
-            while True:
-                data = client_socket.recv(BYTES_RECV_AMT)
-                if not data:
+            if HTTP2 and negotiated_http2(client_socket):
+                handle_http2(client_socket, client_address, directory)
+                return
+            while served < MAX_KEEPALIVE_REQUESTS:
+                if served and not parser.has_data():
+                    if not wait_for_request(client_socket):
+                        break
+                client_socket.settimeout(KEEPALIVE_TIMEOUT)
+                try:
+                    request_data = read_request(client_socket, parser, clock)
+                except HTTPError as err:
+                    logger.error(
+                        f"{client_address[0]} {err.status_code} {get_status_texts(err.status_code)}, message: {err}"
+                    )
+                    if isinstance(err, RequestTimeout):
+                        count_cut(err.reason)
+                    response = error_response(err.status_code)
+                    send_http_response(
+                        client_socket, client_address, response, keep_alive=False
+                    )
+                    access_log.log(
+                        client_address, None, err.status_code, response.bytes_sent, 0
+                    )
+                    lingering_close(client_socket)
                     break
-                buffer += data
-
-                if b"\r\n\r\n" in buffer:
-                    header_index = buffer.find(b"\r\n\r\n") + len(b"\r\n\r\n")
-                    header_buffer = buffer[:header_index]
-                    body_buffer = buffer[header_index:]
-
-                    has_contentlength = get_req_content_length(header_buffer)
-                    if has_contentlength:
-                        while len(body_buffer) < has_contentlength:
-                            body_data = client_socket.recv(BYTES_RECV_AMT)
-                            if not body_data:
-                                break
-                            body_buffer += body_data
-                            buffer += body_buffer
+                if request_data is None:
                     break
+                if HTTP2 and not served and http2.is_preface(request_data):
+                    preface = http2.PREFACE[: http2.PREFACE_REQUEST_LENGTH]
+                    handle_http2(
+                        client_socket,
+                        client_address,
+                        directory,
+                        preface + bytes(parser.buffer),
+                    )
+                    break
+                served += 1
 
-            # print(buffer)
-            # print("body buffer: ", body_buffer)
-            # parsed_header = parse_header(header_buffer)
-
-            # parsed_body = parse_body(body_buffer)
-
-            request_data = parse_request(buffer)
-            if len(request_data) == 0:
-                message = "Incorrect http request format"
-                send_http_response(
-                    client_socket,
-                    client_address,
-                    message,
-                    400,
-                    get_status_texts(400),
-                    get_res_content_length(message),
-                )
-                logger.error(
-                    f"{client_address[0]} 400 {get_status_texts(400)}, message: Incorrect http request format"
+                req_headers = request_data["headers"]
+                keep_alive = (
+                    is_keep_alive(req_headers) and served < MAX_KEEPALIVE_REQUESTS
                 )
-            # print(request_data)
-
-            if request_data["headers"].get("method") == "GET":
-                handle_get_request(
+                started = time.perf_counter()
+                complete = True
+                if "body_stream" in request_data:
+                    if proxy_target(req_headers["path"]) is not None:
+                        response, complete = forward_body(
+                            client_socket, client_address, request_data, clock
+                        )
+                    else:
+                        response, complete = receive_upload(
+                            client_socket, client_address, request_data, clock
+                        )
+                        response.route = "upload"
+                    parser.feed(request_data["body_stream"].leftover)
+                else:
+                    response = dispatch_request(
+                        request_data, client_address, directory
+                    )
+                dispatched = time.perf_counter()
+                if not (complete and delimit_stream(response, req_headers)):
+                    keep_alive = False
+                if drain.draining():
+                    keep_alive = False
+                sent = send_http_response(
                     client_socket,
                     client_address,
-                    request_data.get("headers"),
-                    directory,
+                    response,
+                    keep_alive,
+                    head_only=req_headers.get("method") == "HEAD",
                 )
-            elif request_data["headers"].get("method") == "HEAD":
-                handle_head_request(
-                    client_socket, client_address, request_data.get("headers")
-                )
-            else:
-                logger.error(
-                    f"{client_address[0]} - {request_data['headers'].get('method')} {request_data['headers'].get('path')} 501"
+                record_request(
+                    client_address,
+                    request_data,
+                    response,
+                    dispatched - started,
+                    time.perf_counter() - dispatched,
                 )
-                handle_unsupported_request(client_socket)
+                if not complete:
+                    lingering_close(client_socket)
+                if not (sent and keep_alive):
+                    break
+
+    except socket.timeout:
+        if not served:
+            count_cut("idle")
+            logger.info(f"Connection Timeout for client {client_address[0]}")
 
-    except KeyError:
-        logger.error("Failed to Parse request")
+    except ConnectionResetError:
+        logger.info(f"Connection reset by client {client_address[0]}")
 
+    finally:
+        drain.discard(client_socket)
+        metrics.add("http_active_connections", -1)
+        admission.release(client_address[0])
+
+
+def negotiated_http2(client_socket):
+    return (
+        isinstance(client_socket, ssl.SSLSocket)
+        and client_socket.selected_alpn_protocol() == "h2"
+    )
+
+
+def handle_http2(client_socket, client_address, directory=None, data=b""):
+    """Serve an HTTP/2 connection until it closes or goes idle.
+
+    ``data`` holds bytes already read past the HTTP/1 parser. Requests are
+    dispatched on this thread as their streams complete, and their responses
+    are written interleaved, in turns with reading so window updates and new
+    requests are picked up while a large body is still going out.
+    """
+    session = http2.HTTP2Session()
+    try:
+        while True:
+            if data:
+                for stream_id, request_data in session.receive(data):
+                    started = time.perf_counter()
+                    response = dispatch_request(request_data, client_address, directory)
+                    session.respond(
+                        stream_id,
+                        request_data,
+                        response,
+                        time.perf_counter() - started,
+                    )
+            client_socket.settimeout(SEND_TIMEOUT)
+            while True:
+                out = session.pump()
+                if out:
+                    client_socket.sendall(out)
+                for stream in session.take_finished():
+                    record_request(
+                        client_address,
+                        stream.request,
+                        stream.response,
+                        stream.file_seconds,
+                        stream.send_seconds(),
+                    )
+                if not out or readable(client_socket):
+                    break
+            if session.closed:
+                break
+            busy = session.busy()
+            client_socket.settimeout(SEND_TIMEOUT if busy else KEEPALIVE_TIMEOUT)
+            try:
+                # Idle when draining: closing sends GOAWAY.
+                if not busy and not wait_for_request(client_socket):
+                    break
+                data = client_socket.recv(http2.FILE_CHUNK_SIZE)
+            except socket.timeout:
+                count_cut("send_timeout" if busy else "idle")
+                break
+            if not data:
+                break
     except socket.timeout:
-        logger.info(f"Connection Timeout for client {client_address[0]}")
+        count_cut("send_timeout")
+    except (BrokenPipeError, ConnectionResetError):
+        logger.info(f"Connection reset by client {client_address[0]}")
+    finally:
+        session.close()
+        try:
+            client_socket.settimeout(LINGER_TIMEOUT)
+            client_socket.sendall(session.pump())
+        except OSError:
+            pass
+
+
+def readable(client_socket):
+    """True if a recv() would return at once, counting bytes held by TLS."""
+    if isinstance(client_socket, ssl.SSLSocket) and client_socket.pending():
+        return True
+    return bool(select.select([client_socket], [], [], 0)[0])
+
+
+def count_cut(reason):
+    metrics.inc("http_connections_cut_total", (("reason", reason),))
+
+
+def record_request(
+    client_address, request_data, response, file_seconds, send_seconds
+):
+    """Record a served request in the metrics and the access log."""
+    req_headers = request_data["headers"]
+    access_log.log(
+        client_address,
+        req_headers,
+        response.status_code,
+        response.body_length(),
+        request_data["parse_seconds"] + file_seconds + send_seconds,
+    )
+    method = req_headers.get("method")
+    if method not in METRIC_METHODS:
+        method = "other"
+    route = response.route or "unmatched"
+    metrics.inc(
+        "http_requests_total",
+        (("method", method), ("route", route), ("status", response.status_code)),
+    )
+    metrics.observe(
+        "http_request_phase_seconds",
+        request_data["parse_seconds"],
+        (("phase", "parse"),),
+    )
+    metrics.observe("http_request_phase_seconds", file_seconds, (("phase", "file"),))
+    metrics.observe("http_request_phase_seconds", send_seconds, (("phase", "send"),))
+    metrics.inc("http_request_bytes_total", value=request_data["size"])
+    metrics.inc("http_response_bytes_total", value=response.bytes_sent)
+
+
+def dispatch_request(request_data, client_address, directory=None):
+    response = rate_limited(client_address)
+    if response is not None:
+        return response
+    req_headers = request_data["headers"]
+    current = site
+    proxied = proxy_target(req_headers.get("path"), current)
+    if proxied is not None:
+        upstream, pattern = proxied
+        response = upstream.forward(request_data, client_address)
+        response.route = pattern
+        return response
+    if UPLOADS and directory and req_headers.get("method") in UPLOAD_METHODS:
+        # Bodies that arrived whole, over HTTP/2.
+        response = store_upload(request_data, current.static)
+        response.route = "upload"
+        return response
+    if req_headers.get("method") in ("GET", "HEAD"):
+        # HEAD goes through the same negotiation as GET, so its headers match;
+        # the engine leaves out the body.
+        response = handle_get_request(client_address, req_headers, directory, current)
+    else:
+        return handle_unsupported_request()
+    route = response.route
+    response = apply_preconditions(req_headers, response)
+    if req_headers.get("method") == "GET":
+        response = apply_range(req_headers, response)
+    response.route = route
+    return response
+
+
+def rate_limited(client_address):
+    """A 429 response if the client is over its request rate, else None."""
+    retry_after = admission.allow_request(client_address[0])
+    if not retry_after:
+        return None
+    metrics.inc("http_rejected_total", (("reason", "rate_limit"),))
+    response = rejection_response(429, retry_after)
+    response.route = "rejected"
+    return response
+
+
+def proxy_target(path, current=None):
+    """``(upstream, pattern)`` if ``path`` is routed to an upstream, else None."""
+    match = (current or site).router.match(path)
+    if match is not None and isinstance(match[0], Upstream):
+        return match[0], match[2]
+    return None
+
+
+def apply_preconditions(req_headers, response):
+    """Swap a 200 for a 304 or 412 when the request's validators say so."""
+    if response.status_code != 200 or "ETag" not in response.headers:
+        return response
+    status = check_preconditions(
+        req_headers.get("metadata", {}),
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+    if status is None:
+        return response
+
+    response.close()
+    if status == 412:
+        return error_response(412)
+    not_modified = Response(304)
+    del not_modified.headers["Content-Length"]
+    del not_modified.headers["Content-Type"]
+    for name in ("ETag", "Last-Modified", "Cache-Control", "Vary"):
+        if name in response.headers:
+            not_modified.headers[name] = response.headers[name]
+    return not_modified
+
+
+def apply_range(req_headers, response):
+    """Answer a Range request on a static file with 206 or 416."""
+    metadata = req_headers.get("metadata", {})
+    if (
+        response.status_code != 200
+        or "range" not in metadata
+        or response.headers.get("Accept-Ranges") != "bytes"
+    ):
+        return response
+    if "if-range" in metadata and not if_range_matches(
+        metadata["if-range"],
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    ):
+        return response
+
+    size = response.headers["Content-Length"]
+    ranges = parse_range(metadata["range"], size)
+    if ranges is None:
+        return response
+    if not ranges:
+        response.close()
+        unsatisfiable = error_response(416)
+        unsatisfiable.headers["Content-Range"] = f"bytes */{size}"
+        return unsatisfiable
+    return range_response(response, ranges, size)
+
+
+def get_cache_control(url_path, file_path, overrides):
+    if url_path in overrides:
+        return overrides[url_path]
+    extension = file_path.split(".")[-1]
+    return CACHE_CONTROL_BY_EXT.get(extension, DEFAULT_CACHE_CONTROL)
 
 
-def handle_get_request(client_socket, client_address, getreq_data, directory):
+def handle_get_request(client_address, getreq_data, directory, current):
     # print(f"\nMetadata dictionary: {getreq_data.get('metadata')}\n")
     path = getreq_data.get("path")
     method = getreq_data.get("method")
+    accept_encoding = getreq_data.get("metadata").get("accept-encoding", "")
     if directory:
-        handle_directory_listing(client_socket, client_address, directory, path)
-    else:
-        allowed_headers = get_allowed_headers()
-        accept_headers = getreq_data.get("metadata").get("accept")
-        request_mime_type = get_mime_type(path)
-        if any(header in accept_headers for header in allowed_headers):
-            clean_path = os.path.normpath(
-                os.path.join(ROOT_PATH, parse_path(path, encode=False).lstrip("/"))
+        if METRICS_PATH and path == METRICS_PATH:
+            response = metrics_endpoint(getreq_data, {})
+            response.route = METRICS_PATH
+            return response
+        response = handle_directory_listing(
+            client_address,
+            current,
+            path,
+            accept_encoding,
+            getreq_data.get("query", ""),
+        )
+        if response.status_code != 404:
+            response.route = "sdir"
+        return response
+
+    allowed_headers = get_allowed_headers()
+    accept_headers = getreq_data.get("metadata").get("accept", "*/*")
+    if any(header in accept_headers for header in allowed_headers):
+        file_path = current.static.file(path)
+        if file_path is not None:
+            # logger.info(
+            #     f"{client_address} {method} {parse_path(path, encode=False)}"
+            # )
+            response = serve_file(
+                client_address,
+                file_path,
+                path,
+                True,
+                accept_encoding,
+                current,
             )
-            if os.path.isfile(clean_path):
+            response.route = "static"
+            return response
+        match = current.router.match(path)
+        if match is not None:
+            target, params, pattern = match
+            if callable(target):
+                response = target(getreq_data, params)
+                response.route = pattern
+                return response
+            route_file = resolve_route_file(target, params)
+            if route_file is not None:
                 # logger.info(
                 #     f"{client_address} {method} {parse_path(path, encode=False)}"
                 # )
-                serve_file(
-                    client_socket,
+                response = serve_file(
                     client_address,
-                    parse_path(path, encode=False),
-                    parse_path(path, encode=False),
+                    route_file,
+                    path,
+                    accept_encoding=accept_encoding,
+                    current=current,
                 )
-            else:
-                if any(path in route for route in routes):
-                    for route in routes:
-                        if route.get(path, ""):
-                            # logger.info(
-                            #     f"{client_address} {method} {parse_path(path, encode=False)}"
-                            # )
-                            serve_file(
-                                client_socket,
-                                client_address,
-                                route[path],
-                                parse_path(path, encode=False),
-                            )
-                else:
-                    logger.info(
-                        f"{client_address[0]} - {method} {parse_path(path, encode=False)} 404"
-                    )
-                    serve_error_page(client_socket, client_address, 404)
-        else:
-            message = "415 Unsupported Media Type"
-            send_http_response(
-                client_socket,
-                client_address,
-                message,
-                415,
-                get_status_texts(415),
-                get_res_content_length(message),
-            )
-            logger.error("415 Unsupported Media Type")
+                response.route = pattern
+                return response
+        return error_response(404)
+    else:
+        return Response(415, "415 Unsupported Media Type")
 
 
-def handle_head_request(client_socket, client_address, req_headers):
-    resource_path = req_headers.get("path")
-    resource_method = req_headers.get("method")
-    if any(resource_path in route for route in routes):
-        for route in routes:
-            if route.get(resource_path, ""):
-                file_path = os.path.normpath(
-                    os.path.join(ROOT_PATH, route[resource_path].lstrip("/"))
-                )
-                content_type = get_mime_type(file_path)
-                content_length = get_res_content_length(file_path, is_path=True)
-                response_header = f"HTTP/1.1 200 {get_status_texts(200)}\r\nContent-Length: {content_length}\r\nContent-Type: {content_type}\r\n\r\n"
-                client_socket.sendall(response_header.encode("utf-8"))
-                logger.info(
-                    f"{client_address[0]} - {resource_method} {parse_path(resource_path, encode=False)}"
-                )
-    else:
-        serve_error_page(client_socket, client_address, 404)
-        logger.info(
-            f"{client_address[0]} - {resource_method} {parse_path(resource_path, encode=False)} 404"
-        )
+def resolve_route_file(target, params):
+    """The static file a route points at; a ``*`` route maps into a directory."""
+    if "*" not in params:
+        return target
+    tail = parse_path(params["*"], encode=False)
+    if ".." in tail.split("/"):
+        return None
+    return os.path.join(target, tail)
 
 
-def handle_directory_listing(client_socket, client_address, directory_path, url_path):
+def handle_directory_listing(
+    client_address, current, url_path, accept_encoding="", query=""
+):
     stripped_urL_path = url_path.lstrip("/")
-    combined_path = os.path.normpath(os.path.join(directory_path, stripped_urL_path))
-    decoded_path = parse_path(combined_path, False)
-    if os.path.isdir(combined_path):
-        page = create_dirlist_page(combined_path, stripped_urL_path)
-        if not page:
-            logger.info(
-                f"{client_address[0]} - GET {parse_path(url_path, encode=False)} 404"
-            )
-            serve_error_page(client_socket, client_address, 404)
-        else:
-            send_http_response(
-                client_socket,
-                client_address,
-                page,
-                200,
-                get_status_texts(200),
-                get_res_content_length(page),
-                "text/html",
-            )
-            logger.info(
-                f"{client_address[0]} - GET {parse_path(url_path, encode=False)} 200"
-            )
-    elif os.path.isfile(decoded_path):
+    dir_path = current.static.directory(url_path)
+    file_path = None if dir_path is not None else current.static.file(url_path)
+    if dir_path is not None:
+        options = parse_listing_query(query)
+        if options is None:
+            return error_response(400)
+        try:
+            listing = listing_cache.get(dir_path)
+        except OSError:
+            return error_response(404)
+        page = render_listing(
+            listing, parse_path(stripped_urL_path, encode=False), options
+        )
+        if page is None:
+            return error_response(404)
+        body, content_type = page
+        if isinstance(body, bytes):
+            return Response(200, body, content_type)
+        return stream_response(body, content_type)
+    elif file_path is not None:
         # logger.info(f"{client_address} - GET {parse_path(url_path, encode=False)}")
-        serve_file(
-            client_socket,
+        return serve_file(
             client_address,
-            decoded_path,
-            parse_path(url_path, encode=False),
+            file_path,
+            url_path,
             True,
+            accept_encoding,
+            current,
         )
     else:
         # message = "Directory or file not found"
-        serve_error_page(client_socket, client_address, 404)
-        logger.info(
-            f"{client_address[0]} - GET {parse_path(url_path, encode=False)} 404"
-        )
+        return error_response(404)
 
 
 def serve_file(
-    client_socket, client_address, file_path: str, request_line, directory_serve=False
+    client_address,
+    file_path: str,
+    request_line,
+    directory_serve=False,
+    accept_encoding="",
+    current=None,
 ):
     if not directory_serve:
         norm_path = os.path.normpath(os.path.join(ROOT_PATH, file_path.lstrip("/")))
-        mime_type = get_mime_type(norm_path)
-        if os.path.isfile(norm_path):
-            try:
-                with open(norm_path, "r") as f:
-                    data = f.read()
-                    send_http_response(
-                        client_socket,
-                        client_address,
-                        data,
-                        200,
-                        get_status_texts(200),
-                        get_res_content_length(data),
-                        mime_type,
-                    )
-                    logger.info(
-                        f"{client_address[0]} - GET {parse_path(request_line, encode=False)} 200"
-                    )
-            except FileNotFoundError:
-                # print("File does not exist")
-                logger.warning(
-                    f"{client_address[0]} - GET {parse_path(norm_path, encode=False)} 404 {get_status_texts(404)}"
-                )
-                serve_error_page(client_socket, client_address, 404)
-            except UnicodeDecodeError:
-                logger.error(
-                    f"{client_address[0]} - GET {parse_path(norm_path, encode=False)} 500 {get_status_texts(500)}"
-                )
-                logger.error(f"UnicodeDecodeError on file {norm_path}")
-                serve_error_page(client_socket, client_address, 500)
-            except UnicodeEncodeError:
-                logger.error(
-                    f"{client_address[0]} - GET {parse_path(norm_path, encode=False)} 500 {get_status_texts(500)}"
-                )
-                logger.error(f"UnicodeEncodeError on file {norm_path}")
-                serve_error_page(client_socket, client_address, 500)
-        else:
-            # print("File does not exist")
-            logger.info(
-                f"{client_address[0]} - GET {parse_path(norm_path, encode=False)} 404 {get_status_texts(404)}"
-            )
-            serve_error_page(client_socket, client_address, 404)
     else:
-        norm_path_d = os.path.normpath(file_path)
-        mime_type = get_mime_type(norm_path_d)
-        try:
-            if is_binary_mime_type(mime_type):
-                with open(norm_path_d, "rb") as f:
-                    data = f.read()
-                    send_http_response(
-                        client_socket,
-                        client_address,
-                        data,
-                        200,
-                        get_status_texts(200),
-                        get_res_content_length(data),
-                        mime_type,
-                    )
-                    logger.info(
-                        f"{client_address[0]} - GET {parse_path(request_line, encode=False)} 200"
-                    )
-            else:
-                with open(norm_path_d, "r") as f:
-                    data = f.read()
-                    send_http_response(
-                        client_socket,
-                        client_address,
-                        data,
-                        200,
-                        get_status_texts(200),
-                        get_res_content_length(data),
-                        mime_type,
-                    )
-                    logger.info(
-                        f"{client_address[0]} - GET {parse_path(request_line, encode=False)} 200"
-                    )
-        except FileNotFoundError:
-            # print("File does not exist")
-            logger.warning(
-                f"{client_address[0]} - GET {parse_path(norm_path_d, encode=False)} 404 {get_status_texts(404)}"
-            )
-            serve_error_page(client_socket, client_address, 404)
-        except UnicodeDecodeError:
-            logger.error(
-                f"{client_address[0]} - GET {parse_path(norm_path_d, encode=False)} 500 {get_status_texts(500)}"
-            )
-            logger.error(f"UnicodeDecodeError on file {norm_path_d}")
-            # print(f"UnicodeDecodeError on file {norm_path_d}")
-            serve_error_page(client_socket, client_address, 500)
-
+        norm_path = os.path.normpath(file_path)
+    mime_type = get_mime_type(norm_path)
+    compressible = is_compressible(mime_type)
+    try:
+        codings = accepted_codings(accept_encoding) if compressible else []
+        response = load_file(norm_path, mime_type, codings)
+    except (FileNotFoundError, IsADirectoryError):
+        # print("File does not exist")
+        logger.warning(
+            f"{client_address[0]} - GET {parse_path(norm_path, encode=False)} 404 {get_status_texts(404)}"
+        )
+        return error_response(404)
+    except OSError as oe:
+        logger.error(
+            f"{client_address[0]} - GET {parse_path(norm_path, encode=False)} 500 {get_status_texts(500)}"
+        )
+        logger.error(f"{oe} on file {norm_path}")
+        return error_response(500)
 
-def serve_error_page(client_socket, client_address, error_code):
-    err_page = create_error_page(error_code)
-    send_http_response(
-        client_socket,
-        client_address,
-        err_page,
-        error_code,
-        get_status_texts(error_code),
-        get_res_content_length(err_page),
-        "text/html",
+    response.headers["Cache-Control"] = get_cache_control(
+        request_line, norm_path, (current or site).cache_control
     )
+    response.headers["Accept-Ranges"] = "bytes"
+    if compressible:
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def load_file(path, mime_type, codings=()):
+    """Build the 200 response for a file in the best coding the client accepts.
+
+    A fresh pre-compressed sibling (style.css.gz) wins. Otherwise cached files
+    are compressed on the fly once and the result is kept next to the cache
+    entry. Files too large for the cache are sent uncompressed, as a view
+    into the mmap pool or, failing that, streamed from an open file.
+    """
+    coding = None
+    precompressed = find_precompressed(path, codings) if codings else None
+    if precompressed is not None:
+        coding, path = precompressed
+
+    entry = file_cache.get(path)
+    mapped = None if entry is not None else mmap_pool.acquire(path)
+    if mapped is not None:
+        response = Response(200, mapped.view, mime_type, headers=mapped.headers)
+        response.mapping = mapped
+        response.count = mapped.size
+    elif entry is None:
+        response = file_response(path, mime_type)
+    else:
+        response = Response(200, entry.body, headers=entry.headers)
+        if (
+            coding is None
+            and codings
+            and compression.COMPRESSION_LEVEL > 0
+            and len(entry.body) >= MIN_COMPRESS_SIZE
+        ):
+            body = entry.variants.get(codings[0])
+            if body is None:
+                body = compress(entry.body, codings[0])
+                file_cache.add_variant(entry, codings[0], body)
+            if len(body) < len(entry.body):
+                coding = codings[0]
+                response.body = body
+                response.headers["Content-Length"] = len(body)
+                # Each coding is a different representation and needs its own tag.
+                response.headers["ETag"] = f'{entry.headers["ETag"][:-1]}-{coding}"'
+
+    if coding is not None:
+        response.headers["Content-Type"] = mime_type
+        response.headers["Content-Encoding"] = coding
+    return response
+
+
+def error_response(error_code):
+    return Response(error_code, error_page(error_code), "text/html")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import os
+import posixpath
+import urllib.parse
+
+# Trees with more files and directories than this are not indexed; lookups
+# then fall back to checking the file system on every request.
+MAX_INDEXED_ENTRIES = 100_000
+
+
+class StaticIndex:
+    """Every file and directory under ``root``, keyed by URL path.
+
+    Built with one walk of the tree, so finding the file behind a request is
+    a dict lookup instead of a normpath, an unquote and a stat(). The index is
+    a snapshot: ``changed`` compares the directories' modification times,
+    which move whenever an entry is added, removed or renamed, and the owner
+    builds a fresh index when it returns True.
+    """
+
+    def __init__(self, root, max_entries=MAX_INDEXED_ENTRIES):
+        self.root = root
+        self.files = {}
+        self.dirs = {}
+        self.complete = True
+        self._mtimes = {}
+        entries = 0
+        for dir_path, dir_names, file_names in os.walk(root, followlinks=True):
+            entries += 1 + len(file_names)
+            if entries > max_entries:
+                self.complete = False
+                self.files.clear()
+                self.dirs.clear()
+                self._mtimes.clear()
+                return
+            try:
+                self._mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            relative = os.path.relpath(dir_path, root).replace(os.sep, "/")
+            prefix = "/" if relative == "." else f"/{relative}/"
+            self.dirs[prefix.rstrip("/") or "/"] = os.path.normpath(dir_path)
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if os.path.isfile(path):
+                    self.files[prefix + name] = os.path.normpath(path)
+
+    def file(self, url_path):
+        """The path of the file ``url_path`` names, or None."""
+        return self._find(self.files, url_path, os.path.isfile)
+
+    def directory(self, url_path):
+        """The path of the directory ``url_path`` names, or None."""
+        return self._find(self.dirs, url_path, os.path.isdir)
+
+    def add(self, path):
+        """Index a file written under the root since the walk, e.g. an upload."""
+        if self.complete:
+            relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+            self.files["/" + relative] = os.path.normpath(path)
+
+    def changed(self):
+        """True if an indexed directory was modified or removed since the walk."""
+        for dir_path, mtime_ns in self._mtimes.items():
+            try:
+                if os.stat(dir_path).st_mtime_ns != mtime_ns:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.files)
+
+    def _find(self, table, url_path, exists):
+        # Most request paths are already in their indexed form.
+        if "%" not in url_path:
+            found = table.get(url_path)
+            if found is not None:
+                return found
+        key = url_key(url_path)
+        if self.complete:
+            return table.get(key)
+        path = os.path.normpath(os.path.join(self.root, key.lstrip("/")))
+        return path if exists(path) else None
+
+
+def url_key(url_path):
+    """Decode ``url_path`` and collapse empty, ``.`` and ``..`` segments."""
+    if "%" in url_path:
+        url_path = urllib.parse.unquote(url_path)
+    return posixpath.normpath("/" + url_path.lstrip("/"))
@@ -0,0 +1,159 @@
+import queue
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+from .metrics import metrics
+
+HANDSHAKE_TIMEOUT = 10
+ALPN_PROTOCOLS = ["http/1.1"]
+ALPN_PROTOCOLS_HTTP2 = ["h2", "http/1.1"]
+
+
+def create_tls_context(certfile, keyfile=None, http2=False):
+    """Server-side SSLContext for the TLS listener.
+
+    OpenSSL's session cache and session tickets are both left on, so returning
+    clients resume instead of repeating the full handshake. The context is
+    built once in the parent process, which lets pre-forked workers share its
+    ticket keys and resume each other's sessions. With ``http2`` ALPN offers
+    h2 ahead of http/1.1.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.set_alpn_protocols(ALPN_PROTOCOLS_HTTP2 if http2 else ALPN_PROTOCOLS)
+    return context
+
+
+def count_handshake(ssl_object):
+    resumed = "true" if ssl_object.session_reused else "false"
+    metrics.inc("tls_handshakes_total", (("resumed", resumed),))
+
+
+class TLSHandshaker:
+    """Runs TLS handshakes for the threaded engine on one background thread.
+
+    Accepted sockets are made non-blocking and driven through do_handshake()
+    from a selector loop, so a slow or stalled handshake ties up neither the
+    accept loop nor a worker thread. Finished connections are switched back to
+    blocking and passed to ``on_ready(sock, address)``; failed or timed out
+    ones are closed and passed to ``on_failed(address)``.
+    """
+
+    def __init__(self, context, on_ready, on_failed, timeout=HANDSHAKE_TIMEOUT):
+        self.context = context
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        self._incoming = queue.SimpleQueue()
+        self._pending = {}
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self.selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(
+            target=self._run, name="tls-handshake", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, sock, address):
+        self._incoming.put((sock, address))
+        self._wake()
+
+    def stop(self):
+        self._stopping = True
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+        for ssl_sock, (address, _) in list(self._pending.items()):
+            self._fail(ssl_sock, address)
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self):
+        while not self._stopping:
+            for key, _ in self.selector.select(timeout=1):
+                if key.fileobj is self._wake_r:
+                    self._take_incoming()
+                else:
+                    self._step(key.fileobj)
+            now = time.monotonic()
+            for ssl_sock, (address, deadline) in list(self._pending.items()):
+                if now >= deadline:
+                    self._fail(ssl_sock, address)
+
+    def _take_incoming(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                sock, address = self._incoming.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ssl_sock = self.context.wrap_socket(
+                    sock, server_side=True, do_handshake_on_connect=False
+                )
+                ssl_sock.setblocking(False)
+            except (ssl.SSLError, OSError):
+                sock.close()
+                metrics.inc("tls_handshake_failures_total")
+                self.on_failed(address)
+                continue
+            self._pending[ssl_sock] = (address, time.monotonic() + self.timeout)
+            self._step(ssl_sock)
+
+    def _step(self, ssl_sock):
+        address, _ = self._pending[ssl_sock]
+        try:
+            ssl_sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._watch(ssl_sock, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self._watch(ssl_sock, selectors.EVENT_WRITE)
+            return
+        except (ssl.SSLError, OSError):
+            self._fail(ssl_sock, address)
+            return
+        self._forget(ssl_sock)
+        ssl_sock.setblocking(True)
+        count_handshake(ssl_sock)
+        self.on_ready(ssl_sock, address)
+
+    def _watch(self, ssl_sock, events):
+        try:
+            self.selector.modify(ssl_sock, events)
+        except KeyError:
+            self.selector.register(ssl_sock, events)
+
+    def _forget(self, ssl_sock):
+        del self._pending[ssl_sock]
+        try:
+            self.selector.unregister(ssl_sock)
+        except KeyError:
+            pass
+
+    def _fail(self, ssl_sock, address):
+        self._forget(ssl_sock)
+        ssl_sock.close()
+        metrics.inc("tls_handshake_failures_total")
+        self.on_failed(address)
@@ -0,0 +1,307 @@
+import json
+import os
+import re
+import tempfile
+import urllib.parse
+
+from .error_pages import error_page
+from .parser import HTTPError
+from .response import Response
+from .static_index import url_key
+from .utils import logger
+
+UPLOAD_METHODS = ("PUT", "POST")
+# Bytes read off the connection and written to disk at a time.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Largest upload accepted, and the free space one must leave on the disk.
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+UPLOAD_RESERVE = 64 * 1024 * 1024
+MAX_PART_HEADER_SIZE = 16 * 1024
+MAX_FORM_FILES = 100
+
+_BOUNDARY = re.compile(r'boundary=(?:"([^"]{1,70})"|([^\s;]{1,70}))', re.I)
+_DISPOSITION_PARAM = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"|(\w+)=([^\s;]+)')
+
+
+def accept_upload(req_headers, index):
+    """Check a PUT or multipart POST before its body is read.
+
+    Returns ``(upload, None)`` when the body may be sent, or ``(None,
+    response)`` with the refusal. PUT stores the body at the request path.
+    POST stores each file of a multipart/form-data body in the directory the
+    request path names. Paths are under the root of the StaticIndex
+    ``index``, which learns about stored files straight away.
+    """
+    root = index.root
+    metadata = req_headers["metadata"]
+    try:
+        length = int(metadata.get("content-length", 0))
+    except ValueError:
+        return None, _refuse(400)
+    if length > MAX_UPLOAD_SIZE:
+        return None, _refuse(413)
+    try:
+        st = os.statvfs(root)
+    except OSError:
+        return None, _refuse(500)
+    if st.f_bavail * st.f_frsize - length < UPLOAD_RESERVE:
+        return None, _refuse(507)
+
+    path = _resolve(root, req_headers["path"])
+    if path is None:
+        return None, _refuse(403)
+    if req_headers["method"] == "PUT":
+        if os.path.isdir(path):
+            return None, _refuse(409)
+        if not os.path.isdir(os.path.dirname(path)):
+            return None, _refuse(409)
+        try:
+            return FileUpload(path, req_headers["path"], index), None
+        except PermissionError:
+            return None, _refuse(403)
+        except OSError as oe:
+            logger.error(f"Upload to {path} failed: {oe}")
+            return None, _refuse(500)
+
+    if not os.path.isdir(path):
+        return None, _refuse(404)
+    content_type = metadata.get("content-type", "")
+    boundary = _BOUNDARY.search(content_type)
+    if not content_type.lower().startswith("multipart/form-data") or not boundary:
+        return None, _refuse(415)
+    boundary = (boundary.group(1) or boundary.group(2)).encode()
+    return FormUpload(path, boundary, index), None
+
+
+def store_upload(request_data, index):
+    """Handle an upload whose body has already been received in full."""
+    upload, refused = accept_upload(request_data["headers"], index)
+    if refused is not None:
+        return refused
+    try:
+        upload.write(request_data["body"])
+        return upload.finish()
+    except HTTPError as err:
+        upload.abort()
+        return _refuse(err.status_code)
+    except OSError as oe:
+        upload.abort()
+        logger.error(f"Upload failed: {oe}")
+        return _refuse(500)
+
+
+class FileUpload:
+    """A PUT body written to a temporary file, renamed over the target at the end."""
+
+    def __init__(self, path, url_path, index):
+        self.url_path = url_path
+        self.index = index
+        self.pending = _PendingFile(os.path.dirname(path), os.path.basename(path))
+
+    def write(self, data):
+        self.pending.write(data)
+
+    def finish(self):
+        replaced = self.pending.commit()
+        self.index.add(self.pending.path)
+        if replaced:
+            # A 204 has no body, so no Content-Length or Content-Type either.
+            no_content = Response(204)
+            del no_content.headers["Content-Length"]
+            del no_content.headers["Content-Type"]
+            return no_content
+        # Headers go out as latin-1, and the decoded path may hold any character.
+        location = urllib.parse.quote(url_key(self.url_path))
+        return Response(201, headers={"Location": location})
+
+    def abort(self):
+        self.pending.discard()
+
+
+class FormUpload:
+    """The files of a multipart/form-data POST, stored in ``directory``.
+
+    Fields that are not files are skipped. Every file goes to its own
+    temporary file, and all of them are renamed into place once the closing
+    boundary has arrived, so a cut-off form stores nothing.
+    """
+
+    def __init__(self, directory, boundary, index):
+        self.directory = directory
+        self.index = index
+        self.parser = MultipartParser(boundary)
+        self.files = []
+        self.current = None
+
+    def write(self, data):
+        for event, value in self.parser.feed(data):
+            if event == "part":
+                self.current = self._open(value)
+            elif self.current is not None:
+                self.current.write(value)
+
+    def finish(self):
+        if not self.parser.done or not self.files:
+            self.abort()
+            return _refuse(400)
+        stored = []
+        for pending in self.files:
+            pending.commit()
+            self.index.add(pending.path)
+            stored.append({"name": pending.name, "size": pending.size})
+        body = json.dumps({"files": stored})
+        return Response(201, body, "application/json")
+
+    def abort(self):
+        for pending in self.files:
+            pending.discard()
+
+    def _open(self, headers):
+        params = _disposition_params(headers.get("content-disposition", ""))
+        name = _safe_name(params.get("filename"))
+        if name is None:
+            return None
+        if len(self.files) >= MAX_FORM_FILES:
+            raise HTTPError(400, "Too many files in the form")
+        pending = _PendingFile(self.directory, name)
+        self.files.append(pending)
+        return pending
+
+
+class MultipartParser:
+    """Incremental multipart/form-data parser.
+
+    ``feed`` returns ``("part", headers)`` as each part starts and ``("data",
+    bytes)`` for its content. Only a possible partial boundary is held back
+    between calls, so memory stays bounded however large the parts are.
+    """
+
+    def __init__(self, boundary):
+        self.delimiter = b"\r\n--" + boundary
+        self.buffer = bytearray(b"\r\n")
+        self.state = "preamble"
+        self.done = False
+
+    def feed(self, data):
+        self.buffer += data
+        events = []
+        while not self.done:
+            if self.state == "headers":
+                if self.buffer.startswith(b"\r\n"):
+                    end = -2
+                else:
+                    end = self.buffer.find(b"\r\n\r\n")
+                if end == -1:
+                    if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                        raise HTTPError(400, "Multipart header too large")
+                    break
+                events.append(("part", _part_headers(self.buffer[: max(end, 0)])))
+                del self.buffer[: end + 4]
+                self.state = "data"
+                continue
+
+            found = self.buffer.find(self.delimiter)
+            if found == -1:
+                keep = len(self.delimiter) - 1
+                if self.state == "data" and len(self.buffer) > keep:
+                    events.append(("data", bytes(self.buffer[:-keep])))
+                del self.buffer[: max(0, len(self.buffer) - keep)]
+                break
+            after = found + len(self.delimiter)
+            if len(self.buffer) < after + 2:
+                if self.state == "data" and found:
+                    events.append(("data", bytes(self.buffer[:found])))
+                    del self.buffer[:found]
+                break
+            if self.state == "data" and found:
+                events.append(("data", bytes(self.buffer[:found])))
+            marker = bytes(self.buffer[after : after + 2])
+            del self.buffer[: after + 2]
+            if marker == b"--":
+                self.done = True
+                self.buffer.clear()
+            elif marker == b"\r\n":
+                self.state = "headers"
+            else:
+                raise HTTPError(400, "Malformed multipart boundary")
+        return events
+
+
+class _PendingFile:
+    """A file being received, kept under a temporary name in its directory."""
+
+    def __init__(self, directory, name):
+        fd, self.temp_path = tempfile.mkstemp(
+            prefix=".upload-", suffix=".part", dir=directory
+        )
+        self.file = os.fdopen(fd, "wb")
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """Move the file into place; True if it replaced an existing one."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.chmod(self.temp_path, 0o644)
+        replaced = os.path.exists(self.path)
+        os.replace(self.temp_path, self.path)
+        return replaced
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+def _resolve(root, url_path):
+    """The file system path for ``url_path`` under ``root``, or None if outside it."""
+    relative = url_key(url_path).lstrip("/")
+    path = os.path.normpath(os.path.join(root, relative))
+    real_root = os.path.realpath(root)
+    real_parent = os.path.realpath(os.path.dirname(path) if relative else path)
+    if os.path.commonpath([real_root, real_parent]) != real_root:
+        return None
+    return path
+
+
+def _part_headers(block):
+    headers = {}
+    for line in bytes(block).split(b"\r\n"):
+        name, sep, value = line.partition(b":")
+        if sep:
+            headers[name.strip().lower().decode("latin-1")] = value.strip().decode(
+                "utf-8", "replace"
+            )
+    return headers
+
+
+def _disposition_params(value):
+    params = {}
+    for match in _DISPOSITION_PARAM.finditer(value):
+        if match.group(1):
+            params[match.group(1).lower()] = re.sub(r"\\(.)", r"\1", match.group(2))
+        else:
+            params[match.group(3).lower()] = match.group(4)
+    return params
+
+
+def _safe_name(filename):
+    """The last path component of a client's file name, or None if unusable."""
+    if not filename:
+        return None
+    name = filename.replace("\\", "/").rsplit("/", 1)[-1]
+    if name in ("", ".", "..") or "\0" in name or name.startswith(".upload-"):
+        return None
+    return name
+
+
+def _refuse(status):
+    return Response(status, error_page(status), "text/html")
@@ -1,9 +1,8 @@
 import argparse
-import re
-import os
 import sys
 import urllib.parse
 import logging
+from email.utils import formatdate, parsedate_to_datetime
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,124 +17,214 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
-def get_status_texts(status_code):
-    status_texts = {
-        100: "Continue",
-        101: "Switching Protocols",
-        102: "Processing",
-        103: "Early Hints",
-        200: "OK",
-        201: "Created",
-        202: "Accepted",
-        203: "Non-Authoritative Information",
-        204: "No Content",
-        205: "Reset Content",
-        206: "Partial Content",
-        207: "Multi-Status",
-        208: "Already Reported",
-        226: "IM Used",
-        300: "Multiple Choices",
-        301: "Moved Permanently",
-        302: "Found",
-        303: "See Other",
-        304: "Not Modified",
-        307: "Temporary Redirect",
-        308: "Permanent Redirect",
-        400: "Bad Request",
-        401: "Unauthorized",
-        402: "Payment Required",
-        403: "Forbidden",
-        404: "Not Found",
-        405: "Method Not Allowed",
-        406: "Not Acceptable",
-        407: "Proxy Authentication Required",
-        408: "Request Timeout",
-        409: "Conflict",
-        410: "Gone",
-        411: "Length Required",
-        412: "Precondition Failed",
-        413: "Content Too Large",
-        414: "URI Too Long",
-        415: "Unsupported Media Type",
-        416: "Range Not Satisfiable",
-        417: "Expectation Failed",
-        418: "I'm a teapot",
-        421: "Misdirected Request",
-        422: "Unprocessable Content",
-        423: "Locked",
-        424: "Failed Dependency",
-        425: "Too Early",
-        426: "Upgrade Required",
-        428: "Precondition Required",
-        429: "Too Many Requests",
-        431: "Request Header Fields Too Large",
-        451: "Unavailable For Legal Reasons",
-        500: "Internal Server Error",
-        501: "Not Implemented",
-        502: "Bad Gateway",
-        503: "Service Unavailable",
-        504: "Gateway Timeout",
-        505: "HTTP Version Not Supported",
-        506: "Variant Also Negotiates",
-        507: "Insufficient Storage",
-        508: "Loop Detected",
-        510: "Not Extended",
-        511: "Network Authentication Required",
-    }
+STATUS_TEXTS = {
+    100: "Continue",
+    101: "Switching Protocols",
+    102: "Processing",
+    103: "Early Hints",
+    200: "OK",
+    201: "Created",
+    202: "Accepted",
+    203: "Non-Authoritative Information",
+    204: "No Content",
+    205: "Reset Content",
+    206: "Partial Content",
+    207: "Multi-Status",
+    208: "Already Reported",
+    226: "IM Used",
+    300: "Multiple Choices",
+    301: "Moved Permanently",
+    302: "Found",
+    303: "See Other",
+    304: "Not Modified",
+    307: "Temporary Redirect",
+    308: "Permanent Redirect",
+    400: "Bad Request",
+    401: "Unauthorized",
+    402: "Payment Required",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+    407: "Proxy Authentication Required",
+    408: "Request Timeout",
+    409: "Conflict",
+    410: "Gone",
+    411: "Length Required",
+    412: "Precondition Failed",
+    413: "Content Too Large",
+    414: "URI Too Long",
+    415: "Unsupported Media Type",
+    416: "Range Not Satisfiable",
+    417: "Expectation Failed",
+    418: "I'm a teapot",
+    421: "Misdirected Request",
+    422: "Unprocessable Content",
+    423: "Locked",
+    424: "Failed Dependency",
+    425: "Too Early",
+    426: "Upgrade Required",
+    428: "Precondition Required",
+    429: "Too Many Requests",
+    431: "Request Header Fields Too Large",
+    451: "Unavailable For Legal Reasons",
+    500: "Internal Server Error",
+    501: "Not Implemented",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+    505: "HTTP Version Not Supported",
+    506: "Variant Also Negotiates",
+    507: "Insufficient Storage",
+    508: "Loop Detected",
+    510: "Not Extended",
+    511: "Network Authentication Required",
+}
+
+MIME_TYPES = {
+    "html": "text/html",
+    "css": "text/css",
+    "js": "application/javascript",
+    "json": "application/json",
+    "pdf": "application/pdf",
+    "xml": "text/xml",
+    "png": "image/png",
+    "py": "text/plain",
+    "svg": "image/svg+xml",
+    "svg+xml": "image/svg+xml",
+    "c": "text/plain",
+    "cpp": "text/plain",
+    "csv": "text/csv",
+    "webp": "image/webp",
+    "txt": "text/plain",
+}
+
+# Accept header values that get a response, see handle_get_request.
+ALLOWED_HEADERS = (
+    "text/css",
+    "*/*",
+    "text/html",
+    "application/json",
+    "application/javascript",
+)
 
-    return status_texts[status_code]
 
+def get_status_texts(status_code):
+    return STATUS_TEXTS[status_code]
 
-def get_req_content_length(headers):
-    has_cl = re.search(b"Content-Length: (\\d+)", headers, re.IGNORECASE)
-    if has_cl:
-        return int(has_cl.group(1))
-    else:
-        return None
 
+def make_etag(st):
+    return f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
 
-def get_res_content_length(response, is_path=False):
-    if is_path:
-        try:
-            mime_type = get_mime_type(response)
-            is_binary = is_binary_mime_type(mime_type)
-            if is_binary:
-                with open(response, "rb") as f:
-                    return len(f.read())
-            else:
-                with open(response, "r") as f:
-                    return len(f.read())
 
-        except FileNotFoundError:
-            logger.warning("File not found")
-    else:
-        return len(response)
+def get_validator_headers(st):
+    return {
+        "ETag": make_etag(st),
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+    }
 
 
-def create_dirlist_page(directory_path, url_path):
-    directory_contents = []
+def parse_http_date(value):
     try:
-        directory_contents = os.listdir(directory_path)
-    except FileNotFoundError:
-        logger.warning(f"{url_path} not found")
-        return
-
-    html_page = '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>Directory Listing</title></head>'
-    if url_path == "":
-        html_page += f"<body><h1>Directory Listing for / </h1><hr>"
-    else:
-        html_page += f"<body><h1>Directory Listing for /{url_path}</h1><hr>"
-    html_page += "<ul>"
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
 
-    for content in directory_contents:
-        encoded_content = parse_path(content)
-        if os.path.isdir(f"{directory_path}/{content}/"):
-            html_page += f'<li><a href="{encoded_content}/">{content}/</a></li>'
-        else:
-            html_page += f'<li><a href="{encoded_content}">{content}</a></li>'
-    html_page += "</ul><hr></body></html>"
 
-    return html_page
+def etag_matches(header_value, etag, weak=True):
+    """Check an If-None-Match / If-Match list against ``etag``.
+
+    Weak comparison ignores the W/ prefix and is what If-None-Match uses;
+    If-Match needs strong comparison, where weak tags never match.
+    """
+    if header_value.strip() == "*":
+        return True
+    if not weak and etag.startswith("W/"):
+        return False
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if weak:
+            candidate = candidate.removeprefix("W/")
+            if candidate == etag.removeprefix("W/"):
+                return True
+        elif candidate == etag:
+            return True
+    return False
+
+
+def check_preconditions(metadata, etag, last_modified):
+    """Evaluate conditional request headers in the order of RFC 9110 13.2.2.
+
+    Returns 412 or 304 when the request should get that status instead of the
+    representation, otherwise None.
+    """
+    modified = parse_http_date(last_modified) if last_modified else None
+
+    if "if-match" in metadata:
+        if not etag or not etag_matches(metadata["if-match"], etag, weak=False):
+            return 412
+    elif "if-unmodified-since" in metadata and modified is not None:
+        since = parse_http_date(metadata["if-unmodified-since"])
+        if since is not None and modified > since:
+            return 412
+
+    if "if-none-match" in metadata:
+        if etag and etag_matches(metadata["if-none-match"], etag):
+            return 304
+    elif "if-modified-since" in metadata and modified is not None:
+        since = parse_http_date(metadata["if-modified-since"])
+        if since is not None and modified <= since:
+            return 304
+
+    return None
+
+
+def parse_range(header_value, size, max_ranges=16):
+    """Parse a ``Range: bytes=...`` header against a representation of ``size``.
+
+    Returns a list of inclusive (start, end) pairs, an empty list when no range
+    is satisfiable (416), or None when the header is malformed or asks for too
+    many ranges and should be ignored (200).
+    """
+    unit, _, spec = header_value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first == "":
+                suffix = int(last)
+                if suffix == 0 or size == 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else None
+                if end is not None and end < start:
+                    return None
+                if start >= size:
+                    continue
+                end = size - 1 if end is None else min(end, size - 1)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+
+    if len(ranges) > max_ranges:
+        return None
+    return ranges
+
+
+def if_range_matches(header_value, etag, last_modified):
+    """If-Range holds either a strong ETag or the exact Last-Modified date."""
+    header_value = header_value.strip()
+    if header_value.startswith('"') or header_value.startswith("W/"):
+        return bool(etag) and etag_matches(header_value, etag, weak=False)
+    since = parse_http_date(header_value)
+    return since is not None and since == parse_http_date(last_modified or "")
 
 
 def create_error_page(error_code):
@@ -148,45 +237,10 @@ def create_error_page(error_code):
     return html_page
 
 
-def parse_body(request):
-    pass
-
-
-def parse_request(request):
-    try:
-        decoded_data: str = request.decode("utf-8")
-    except UnicodeDecodeError:
-        error = "Error Decoding response to utf-8"
-        logger.error(error)
-        return {}
-
-    decoded_data = decoded_data.replace("\r\n", "\n")
-    try:
-        header, *body = decoded_data.split("\n\n")
-        request_line, *metadata = header.split("\n")
-        method, path, http_version = request_line.split(" ")
-        metadata = {i.split(": ")[0].lower(): i.split(": ")[1] for i in metadata}
-    except ValueError:
-        logger.error("Incorrect http request format")
-        return {}
-    except IndexError:
-        logger.error("Incorrect http request format")
-        return {}
-
-    return {
-        "headers": {
-            "method": method,
-            "path": path,
-            "http_version": http_version,
-            "metadata": metadata,
-        },
-        "body": body,
-    }
-
-
 def commandline_parser():
     parser = argparse.ArgumentParser(
-        prog="Simple HTTP server", usage="script.py [-h <host>] [-p <port>]"
+        prog="Simple HTTP server",
+        usage="script.py [-h <host>] [-p <port>] [-e {threaded,asyncio}] [-w <workers>]",
     )
 
     parser.add_argument(
@@ -204,32 +258,297 @@ def commandline_parser():
     parser.add_argument(
         "-sd", "--sdir", dest="directory", required=False, type=str, nargs="?"
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        dest="engine",
+        default="threaded",
+        choices=["threaded", "asyncio"],
+        help="threaded hands each connection to a worker thread, asyncio "
+        "multiplexes all connections on one event loop",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        default=0,
+        type=int,
+        help="pre-fork this many worker processes (0 serves from a single process)",
+    )
+    parser.add_argument(
+        "--reuseport",
+        dest="reuseport",
+        action="store_true",
+        help="give each worker its own SO_REUSEPORT listener instead of sharing one",
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        dest="graceful_timeout",
+        default=30,
+        type=float,
+        help="seconds in-flight requests get to finish on SIGTERM/SIGINT before "
+        "their connections are closed",
+    )
+    parser.add_argument(
+        "--pid-file",
+        dest="pid_file",
+        default=None,
+        help="write the server's process id to this file, e.g. for SIGUSR2 "
+        "restarts",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        default=64,
+        type=int,
+        help="memory budget of the static file cache in MiB (0 disables it)",
+    )
+    parser.add_argument(
+        "--cache-max-entry",
+        dest="cache_max_entry",
+        default=1024,
+        type=int,
+        help="files larger than this many KiB are streamed instead of cached",
+    )
+    parser.add_argument(
+        "--mmap-pool-size",
+        dest="mmap_pool_size",
+        default=256,
+        type=int,
+        help="MiB of files too large for the cache kept memory-mapped (0 turns "
+        "the pool off)",
+    )
+    parser.add_argument(
+        "--compression-level",
+        dest="compression_level",
+        default=6,
+        type=int,
+        help="level for on-the-fly gzip/brotli/zstd compression (0 disables it)",
+    )
+    parser.add_argument(
+        "--precompress",
+        dest="precompress",
+        action="store_true",
+        help="write .gz/.br/.zst siblings for the served files before serving",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        dest="reload_interval",
+        default=2,
+        type=float,
+        help="seconds between checks of routes.py and the served files for "
+        "changes (0 reloads on SIGHUP only)",
+    )
+    parser.add_argument(
+        "--uploads",
+        dest="uploads",
+        action="store_true",
+        help="accept PUT and multipart/form-data POST uploads into the -sd "
+        "directory",
+    )
+    parser.add_argument(
+        "--max-upload-size",
+        dest="max_upload_size",
+        default=100,
+        type=int,
+        help="largest upload in MiB, above it 413 is sent",
+    )
+    parser.add_argument(
+        "--upload-reserve",
+        dest="upload_reserve",
+        default=64,
+        type=int,
+        help="free disk space in MiB that uploads must leave, else 507 is sent",
+    )
+    parser.add_argument(
+        "--max-header-size",
+        dest="max_header_size",
+        default=16 * 1024,
+        type=int,
+        help="largest request line plus headers in bytes, above it 431 is sent",
+    )
+    parser.add_argument(
+        "--max-uri-length",
+        dest="max_uri_length",
+        default=8 * 1024,
+        type=int,
+        help="longest request target in bytes, above it 414 is sent",
+    )
+    parser.add_argument(
+        "--max-body-size",
+        dest="max_body_size",
+        default=1024 * 1024,
+        type=int,
+        help="largest request body in bytes, above it 413 is sent",
+    )
+    parser.add_argument(
+        "--metrics-path",
+        dest="metrics_path",
+        default="/metrics",
+        help="route serving Prometheus metrics, an empty string turns it off",
+    )
+    parser.add_argument(
+        "--header-timeout",
+        dest="header_timeout",
+        default=10,
+        type=float,
+        help="seconds a client has to send the request line and headers",
+    )
+    parser.add_argument(
+        "--body-timeout",
+        dest="body_timeout",
+        default=10,
+        type=float,
+        help="seconds to send the body, plus one per --min-recv-rate bytes received",
+    )
+    parser.add_argument(
+        "--min-recv-rate",
+        dest="min_recv_rate",
+        default=1024,
+        type=int,
+        help="slowest accepted upload in bytes per second, 0 no minimum",
+    )
+    parser.add_argument(
+        "--send-timeout",
+        dest="send_timeout",
+        default=10,
+        type=float,
+        help="seconds a client may stop reading the response before it is cut off",
+    )
+    parser.add_argument(
+        "--min-send-rate",
+        dest="min_send_rate",
+        default=1024,
+        type=int,
+        help="slowest accepted download in bytes per second, 0 no minimum",
+    )
+    parser.add_argument(
+        "--max-connections",
+        dest="max_connections",
+        default=0,
+        type=int,
+        help="open connections per process above which new ones get 503, 0 no limit",
+    )
+    parser.add_argument(
+        "--max-queue",
+        dest="max_queue",
+        default=1024,
+        type=int,
+        help="connections waiting for a worker thread above which new ones get 503",
+    )
+    parser.add_argument(
+        "--max-conn-per-ip",
+        dest="max_conn_per_ip",
+        default=0,
+        type=int,
+        help="open connections per client address above which new ones get 429",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        dest="rate_limit",
+        default=0,
+        type=float,
+        help="requests per second allowed per client address, 0 no limit",
+    )
+    parser.add_argument(
+        "--rate-burst",
+        dest="rate_burst",
+        default=0,
+        type=int,
+        help="requests a client may send at once before --rate-limit applies",
+    )
+    parser.add_argument(
+        "--retry-after",
+        dest="retry_after",
+        default=1,
+        type=int,
+        help="Retry-After seconds sent when a connection is turned away",
+    )
+    parser.add_argument(
+        "--error-pages",
+        dest="error_pages",
+        default=None,
+        help="directory of custom error pages named by status code, e.g. 404.html",
+    )
+    parser.add_argument(
+        "--access-log",
+        dest="access_log",
+        default="-",
+        help="access log file, '-' for stdout and an empty string to turn it off",
+    )
+    parser.add_argument(
+        "--access-log-format",
+        dest="access_log_format",
+        default="combined",
+        choices=["common", "combined", "json"],
+    )
+    parser.add_argument(
+        "--access-log-max-size",
+        dest="access_log_max_size",
+        default=0,
+        type=int,
+        help="rotate the access log when it reaches this many MiB, 0 never",
+    )
+    parser.add_argument(
+        "--access-log-rotate",
+        dest="access_log_rotate",
+        default=0,
+        type=float,
+        help="rotate the access log every this many hours, 0 never",
+    )
+    parser.add_argument(
+        "--access-log-backups",
+        dest="access_log_backups",
+        default=5,
+        type=int,
+        help="rotated access logs to keep",
+    )
+    parser.add_argument(
+        "--access-log-sample",
+        dest="access_log_sample",
+        default=1.0,
+        type=float,
+        help="fraction of successful requests to log, errors are always logged",
+    )
+    parser.add_argument(
+        "--certfile",
+        dest="certfile",
+        default=None,
+        help="PEM certificate chain; serves HTTPS on --tls-port when given",
+    )
+    parser.add_argument(
+        "--keyfile",
+        dest="keyfile",
+        default=None,
+        help="PEM private key, if it is not in --certfile",
+    )
+    parser.add_argument(
+        "--tls-port",
+        dest="tls_port",
+        default=8443,
+        type=int,
+        help="port of the HTTPS listener",
+    )
+    parser.add_argument(
+        "--tls-only",
+        dest="tls_only",
+        action="store_true",
+        help="serve HTTPS only, without the plaintext listener",
+    )
+    parser.add_argument(
+        "--http2",
+        dest="http2",
+        action="store_true",
+        help="accept HTTP/2 via ALPN h2 over TLS and prior-knowledge h2c "
+        "(needs the h2 package)",
+    )
 
-    parsed_args = parser.parse_args()
-    return (parsed_args.host, parsed_args.port, parsed_args.directory)
+    return parser.parse_args()
 
 
 def get_mime_type(path_file_name):
-    extension = path_file_name.split(".")[-1]
-    mime_type_dict = {
-        "html": "text/html",
-        "css": "text/css",
-        "js": "application/javascript",
-        "json": "application/json",
-        "pdf": "application/pdf",
-        "xml": "text/xml",
-        "png": "image/png",
-        "py": "text/plain",
-        "svg": "image/svg+xml",
-        "svg+xml": "image/svg+xml",
-        "c": "text/plain",
-        "cpp": "text/plain",
-        "csv": "text/csv",
-        "webp": "image/webp",
-        "txt": "text/plain",
-    }
-
-    return mime_type_dict.get(extension, "application/octet-stream")
+    extension = path_file_name.rpartition(".")[2]
+    return MIME_TYPES.get(extension, "application/octet-stream")
 
 
 def parse_path(path, encode=True):
@@ -239,26 +558,8 @@ def parse_path(path, encode=True):
         return urllib.parse.unquote(path)
 
 
-def is_binary_mime_type(mime_type):
-    binary_mime_types = [
-        "application/octet-stream",
-        "image/jpeg",
-        "image/png",
-        "image/gif",
-        "application/pdf",
-        "application/zip",
-    ]
-    return mime_type in binary_mime_types
-
-
 def get_allowed_headers():
-    return [
-        "text/css",
-        "*/*",
-        "text/html",
-        "application/json",
-        "application/javascript",
-    ]
+    return ALLOWED_HEADERS
 
 
 def route(path, file):
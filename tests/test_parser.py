@@ -0,0 +1,32 @@
+import pytest
+
+from server.parser import BodyStream, HTTPError, RequestParser
+
+
+@pytest.mark.parametrize("size_line", [b"-5", b"0x5", b"+5", b"5_0", b" 5", b""])
+def test_body_stream_refuses_malformed_chunk_size(size_line):
+    body = BodyStream(None, True, 10**6)
+    with pytest.raises(HTTPError) as err:
+        body.feed(size_line + b"\r\nabcdefgh\r\n0\r\n\r\n")
+    assert err.value.status_code == 400
+
+
+def test_body_stream_decodes_chunks():
+    body = BodyStream(None, True, 10**6)
+    data = body.feed(b"5;ext=1\r\nhello\r\nA \r\n0123456789\r\n0\r\n\r\nGET")
+    assert data == b"hello0123456789"
+    assert body.done
+    assert body.leftover == b"GET"
+
+
+@pytest.mark.parametrize("size_line", [b"-5", b"0x5", b"+5", b"5_0"])
+def test_parser_refuses_malformed_chunk_size(size_line):
+    parser = RequestParser()
+    parser.feed(
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+        + size_line
+        + b"\r\nhello\r\n0\r\n\r\n"
+    )
+    with pytest.raises(HTTPError) as err:
+        parser.next_request()
+    assert err.value.status_code == 400
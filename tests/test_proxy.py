@@ -0,0 +1,45 @@
+import select
+import socket
+
+import pytest
+
+from server.parser import HTTPError, RequestParser
+from server.proxy import Upstream, _Reader
+
+
+def _streamed_request(raw):
+    parser = RequestParser(stream_body=lambda headers: 10**6)
+    parser.feed(raw)
+    request_data = parser.next_request()
+    body = request_data["body_stream"]
+
+    def chunks():
+        chunk = body.feed(body.buffered)
+        if chunk:
+            yield chunk
+
+    request_data["body_chunks"] = chunks()
+    return request_data
+
+
+def test_malformed_chunked_body_is_refused_before_connecting():
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        upstream = Upstream(f"http://127.0.0.1:{listener.getsockname()[1]}")
+        request_data = _streamed_request(
+            b"POST /api HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"-5\r\nabcdefgh\r\n0\r\n\r\n"
+        )
+        with pytest.raises(HTTPError) as err:
+            upstream.forward(request_data, ("127.0.0.1", 12345))
+        assert err.value.status_code == 400
+        # Nothing waiting to be accepted: the backend was never contacted.
+        assert not select.select([listener], [], [], 0.1)[0]
+
+
+@pytest.mark.parametrize("size_line", [b"-5", b"0x5", b"+5", b"5_0"])
+def test_upstream_chunk_size_must_be_hex(size_line):
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        theirs.sendall(size_line + b"\r\nhello\r\n0\r\n\r\n")
+        with pytest.raises(ValueError):
+            list(_Reader(ours).read_chunked())
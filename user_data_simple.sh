@@ -7,5 +7,6 @@ cd /opt
 git clone https://github.com/anant16-devops/simple-http-server.git simple-http-server
 cd simple-http-server
 
-# Start the application
-nohup python3 main.py -hs 0.0.0.0 -p 8000 > /var/log/simple-http-server.log 2>&1 &
\ No newline at end of file
+# Start the application. To deploy new code without refusing connections:
+#   git pull && kill -USR2 $(cat /var/run/simple-http-server.pid)
+nohup python3 main.py -hs 0.0.0.0 -p 8000 -w $(nproc) --pid-file /var/run/simple-http-server.pid --access-log /var/log/simple-http-server-access.log --access-log-max-size 100 > /var/log/simple-http-server.log 2>&1 &
\ No newline at end of file